@@ -0,0 +1,356 @@
+"""Serves the /query endpoint from an asyncio event loop that answers the concurrent queries in micro-batches.
+
+The event loop only parses the requests and writes the responses. The queries that arrive within batch_window of each
+other (or the first max_batch_size of them) are answered together by one vectorized k_nearest_neighbors_batch call,
+which runs in a single background thread so that the loop keeps accepting connections meanwhile. The queries that
+arrive while a batch is computed wait for it, and form the next batch. The batches are kept small enough for a query to
+be answered within latency_slo: the duration of a batch is estimated from the previous ones, and the batch size is
+capped accordingly.
+"""
+import asyncio
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from data_store.metrics import METRICS_CONTENT_TYPE
+from data_store.query_response import parse_query, encode_recommendation
+
+
+class QueryBatcher:
+    """Gathers the queries submitted on an event loop, and answers them in batches in a background thread"""
+
+    # weight of the last batch in the moving average of the duration of a query
+    duration_smoothing = 0.2
+
+    def __init__(self, store, k=10, age_proximity=5, batch_window=0.002, max_batch_size=256, latency_slo=0.05):
+        """
+        Args:
+            store: KDTreeDataStore. In compact mode, the batches use k_nearest_neighbors_batch, otherwise the queries
+                of a batch are answered one by one
+            k: number of neighbors of the queries that do not give it
+            age_proximity: maximum difference between a candidate neighbor's age and the target, for the queries that
+                do not give it
+            batch_window: maximum number of seconds a query waits for other queries before its batch starts
+            max_batch_size: maximum number of queries in a batch
+            latency_slo: number of seconds within which a query should be answered, which caps the batch window and
+                the batch size
+        """
+        self.store = store
+        self.k = k
+        self.age_proximity = age_proximity
+        self.batch_window = min(batch_window, latency_slo / 2)
+        self.max_batch_size = max_batch_size
+        self.latency_slo = latency_slo
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.query_duration = None
+        self.num_batches = 0
+        self.num_queries = 0
+        self._pending = []
+        self._timer = None
+        self._busy = False
+
+    def batch_size_limit(self):
+        """Largest batch that should be answered within the latency SLO, given the duration of the previous batches
+
+        Returns: number of queries
+
+        """
+        if not self.query_duration:
+            return self.max_batch_size
+        size = int((self.latency_slo - self.batch_window) / self.query_duration)
+        return max(1, min(self.max_batch_size, size))
+
+    def stats(self):
+        """Usage counters of the batcher
+
+        Returns: dictionary with the number of batches and queries, and the average duration of a query in a batch
+
+        """
+        return {'num_batches': self.num_batches, 'num_queries': self.num_queries,
+                'mean_batch_size': self.num_queries / self.num_batches if self.num_batches else 0,
+                'query_duration': self.query_duration, 'batch_size_limit': self.batch_size_limit()}
+
+    def recommend(self, latitude, longitude, age, k=None, age_proximity=None):
+        """Submits a query to the next batch. Must be called from the event loop
+
+        Args:
+            latitude: target's latitude
+            longitude: target's longitude
+            age: target's age
+            k: (optional) number of neighbors. Defaults to self.k
+            age_proximity: (optional) maximum difference between a candidate neighbor's age and the target. Defaults
+                to self.age_proximity
+
+        Returns: future of the recommendation, as returned by KDTreeDataStore.recommend
+
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        k = self.k if k is None else k
+        age_proximity = self.age_proximity if age_proximity is None else age_proximity
+        self._pending.append(({'name': 'bla bla', 'age': age, 'latitude': latitude, 'longitude': longitude}, k,
+                              age_proximity, future))
+        if len(self._pending) >= self.batch_size_limit():
+            self._flush()
+        elif self._timer is None and not self._busy:
+            self._timer = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def close(self):
+        """Stops the background thread once the current batch is answered
+
+        Returns: None
+
+        """
+        self.executor.shutdown(wait=True)
+
+    def _flush(self):
+        """Starts a batch with the pending queries, unless a batch is being answered: the pending queries then form
+        the next batch as soon as it is done
+
+        Returns: None
+
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._busy or not self._pending:
+            return
+        batch_size = self.batch_size_limit()
+        batch, self._pending = self._pending[:batch_size], self._pending[batch_size:]
+        self._busy = True
+        asyncio.get_running_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        """Answers a batch in the background thread, and resolves the futures of its queries
+
+        Args:
+            batch: list of (target item, k, age_proximity, future) tuples
+
+        Returns: None
+
+        """
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        try:
+            results = await loop.run_in_executor(self.executor, self._recommend_batch,
+                                                 [query[:3] for query in batch])
+        except Exception as e:
+            for query in batch:
+                if not query[3].done():
+                    query[3].set_exception(e)
+        else:
+            for (_, _, _, future), result in zip(batch, results):
+                # the client may have disconnected in the meantime
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._busy = False
+
+        duration = (time.perf_counter() - start_time) / len(batch)
+        self.query_duration = duration if self.query_duration is None else (
+            self.duration_smoothing * duration + (1 - self.duration_smoothing) * self.query_duration)
+        self.num_batches += 1
+        self.num_queries += len(batch)
+
+        if self._pending:
+            # these queries already waited for the whole batch
+            self._flush()
+
+    def _recommend_batch(self, queries):
+        """Answers a batch of queries, with one k_nearest_neighbors_batch call per value of k and age_proximity
+
+        Args:
+            queries: list of (target item, k, age_proximity) tuples
+
+        Returns: list of recommendations, as returned by KDTreeDataStore.recommend
+
+        """
+        # the batch search has no search budget, so the store's max_visits and time_budget are honored by answering the
+        # queries one by one
+        if not self.store.compact_mode or self.store.max_visits is not None or self.store.time_budget is not None:
+            return [self.store.recommend(item, k, age_proximity) for item, k, age_proximity in queries]
+
+        groups = {}
+        for position, (item, k, age_proximity) in enumerate(queries):
+            groups.setdefault((k, age_proximity), []).append(position)
+        results = [None] * len(queries)
+        for (k, age_proximity), positions in groups.items():
+            group_results = self._recommend_group([queries[position][0] for position in positions], k, age_proximity)
+            for position, result in zip(positions, group_results):
+                results[position] = result
+        return results
+
+    def _recommend_group(self, target_items, k, age_proximity):
+        """Answers queries with the same k and age_proximity. The targets that get k neighbors within the maximum radius
+        from the batch search are answered directly, the others go through recommend, which widens their age window
+
+        Args:
+            target_items: list of target user items
+            k: number of neighbors
+            age_proximity: maximum difference between a candidate neighbor's age and the target
+
+        Returns: list of recommendations, as returned by KDTreeDataStore.recommend
+
+        """
+        store = self.store
+        latitudes = [item['latitude'] for item in target_items]
+        longitudes = [item['longitude'] for item in target_items]
+        ages = [item['age'] for item in target_items]
+        indices, distances = store.k_nearest_neighbors_batch(latitudes, longitudes, ages, k, age_proximity)
+
+        results = []
+        for item, neighbor_indices, neighbor_distances in zip(target_items, indices, distances):
+            if k > 0 and (neighbor_indices[-1] < 0 or (
+                    store.max_radius is not None and neighbor_distances[-1] > store.max_radius)):
+                results.append(store.recommend(item, k, age_proximity))
+                continue
+            neighbors = []
+            for index, distance in zip(neighbor_indices, neighbor_distances):
+                node = store.node_store.get_node(index)
+                neighbors.append({'distance': float(distance), 'longitude': node['longitude'],
+                                  'latitude': node['latitude'], 'name': node['name'], 'age': node['age']})
+            results.append({'result': neighbors, 'exact': True, 'age_proximity': age_proximity, 'partial': False})
+        return results
+
+
+class AsyncQueryServer:
+    """Minimal HTTP/1.1 server for the /query endpoint, answering the queries through a QueryBatcher, and for the
+    /metrics endpoint of the store"""
+
+    _reasons = {200: 'OK', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+    def __init__(self, batcher):
+        """
+        Args:
+            batcher: QueryBatcher
+        """
+        self.batcher = batcher
+
+    async def start(self, host, port):
+        """Starts listening. Must be called from the event loop
+
+        Args:
+            host: host to serve on
+            port: port to serve on
+
+        Returns: asyncio server
+
+        """
+        return await asyncio.start_server(self._handle_connection, host, port, backlog=128)
+
+    async def _handle_connection(self, reader, writer):
+        """Answers the requests of a connection until the client closes it or asks to
+
+        Args:
+            reader: asyncio stream reader of the connection
+            writer: asyncio stream writer of the connection
+
+        Returns: None
+
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get('content-length', 0))
+                if content_length:
+                    await reader.readexactly(content_length)
+
+                start_time = time.perf_counter()
+                try:
+                    status, body, response_headers = await self._respond(method, target, headers.get('accept'))
+                except Exception as e:
+                    # the error of a failed batch, raised to each of its queries
+                    print('query failed: {!r}'.format(e))
+                    status, body, response_headers = 500, b'Error: the query failed', {
+                        'Content-Type': 'text/html; charset=UTF-8'}
+                path = urllib.parse.urlsplit(target).path
+                self.batcher.store.metrics.observe_request(path if path in ('/query', '/metrics') else 'unmatched',
+                                                           time.perf_counter() - start_time)
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                response_headers.update({'Content-Length': str(len(body)), 'Access-Control-Allow-Origin': '*',
+                                         'Connection': 'keep-alive' if keep_alive else 'close'})
+                writer.write('{} {} {}\r\n{}\r\n'.format(
+                    version, status, self._reasons[status],
+                    ''.join('{}: {}\r\n'.format(name, value) for name, value in response_headers.items()))
+                             .encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method, target, accept=None):
+        """Answers a request
+
+        Args:
+            method: HTTP method
+            target: request target, with the query string
+            accept: (optional) value of the Accept header
+
+        Returns: (status code, body bytes, headers dictionary) tuple
+
+        """
+        error_headers = {'Content-Type': 'text/html; charset=UTF-8'}
+        url = urllib.parse.urlsplit(target)
+        if url.path not in ('/query', '/metrics'):
+            return 404, b'Not found: ' + url.path.encode('utf-8'), error_headers
+        if method != 'GET':
+            return 405, b'Method not allowed', error_headers
+        metrics = self.batcher.store.metrics
+        if url.path == '/metrics':
+            return 200, metrics.to_prometheus().encode('utf-8'), {'Content-Type': METRICS_CONTENT_TYPE}
+        try:
+            params = parse_query(dict(urllib.parse.parse_qsl(url.query)), default_k=self.batcher.k,
+                                 default_age_proximity=self.batcher.age_proximity)
+        except ValueError as e:
+            return 404, ('Error: ' + str(e)).encode('utf-8'), error_headers
+        result = await self.batcher.recommend(params['latitude'], params['longitude'], params['age'], params['k'],
+                                              params['age_proximity'])
+        start_time = time.perf_counter()
+        body, headers = encode_recommendation(result, params['fields'], accept)
+        metrics.observe_stage('encode', time.perf_counter() - start_time)
+        return 200, body, headers
+
+
+def serve_async(store, port, host='0.0.0.0', batch_window=0.002, max_batch_size=256, latency_slo=0.05):
+    """Serves the store's /query endpoint from an asyncio event loop, answering the concurrent queries in micro-batches,
+    until SIGINT
+
+    Args:
+        store: KDTreeDataStore
+        port: port to serve on
+        host: host to serve on
+        batch_window: maximum number of seconds a query waits for other queries before its batch starts
+        max_batch_size: maximum number of queries in a batch
+        latency_slo: number of seconds within which a query should be answered
+
+    Returns: None
+
+    """
+    batcher = QueryBatcher(store, batch_window=batch_window, max_batch_size=max_batch_size, latency_slo=latency_slo)
+
+    async def serve():
+        server = await AsyncQueryServer(batcher).start(host, port)
+        print('serving on {}:{} with micro-batches of up to {} ms'.format(host, port, batcher.batch_window * 1000))
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batcher.close()
@@ -3,10 +3,18 @@ import json
 
 
 class BoundedPriorityQueue:
-    def __init__(self, bound):
+    def __init__(self, bound, max_priority=float('inf')):
+        """
+        Args:
+            bound: maximum number of items
+            max_priority: (optional) items with this priority or more are never queued
+        """
         self._queue = []
         self._index = 0
         self.bound = bound
+        self.max_priority = max_priority
+        # number of push calls, for the query instrumentation
+        self.num_pushes = 0
 
     def push(self, item, priority):
         """Push an item to the queue
@@ -18,6 +26,9 @@ class BoundedPriorityQueue:
         Returns:
 
         """
+        self.num_pushes += 1
+        if priority >= self.max_priority:
+            return
 
         if self.size() >= self.bound:
             if priority >= -self.peek()[0]:
@@ -70,6 +81,16 @@ class BoundedPriorityQueue:
         """
         return -self._queue[0][0]
 
+    def priority_bound(self):
+        """Priority that an item must be below to enter the queue
+
+        Returns: priority of the item that can be popped next when the queue is full, max_priority otherwise
+
+        """
+        if self.is_full():
+            return self.peek_item_priority()
+        return self.max_priority
+
     def size(self):
         """Queue size
 
@@ -90,16 +111,20 @@ class BoundedPriorityQueue:
         """
         return self.size() == self.bound
 
-    def get_as_list(self,with_dist=False):
+    def get_as_list(self,with_dist=False,item_getter=None):
         """Returns the queue with the items as a sorted list in increasing distance order
 
+        Args:
+            with_dist: include the distance in the returned items
+            item_getter: (optional) function mapping a queued item to its user dict, for queues holding node indices
+
         Returns: list of user items
 
         """
         list =[]
         while(self.size()>0):
             item = self.pop()
-            data_item = item[2]
+            data_item = item[2] if item_getter is None else item_getter(item[2])
             newitem={
                 'distance':-item[0],
                 'longitude':data_item['longitude'],
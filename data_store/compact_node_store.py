@@ -0,0 +1,804 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from data_store.index_builder import build_kd_tree
+
+_INT32_MAX = np.iinfo(np.int32).max
+
+# snapshot files start with the magic bytes, then the format version and the length of the json header (little-endian
+# uint32), the header, and the arrays, each aligned on _SNAPSHOT_ALIGNMENT bytes
+_SNAPSHOT_MAGIC = b'GEOKDSNP'
+_SNAPSHOT_PREFIX = struct.Struct('<II')
+_SNAPSHOT_ALIGNMENT = 64
+SNAPSHOT_VERSION = 1
+
+
+def _aligned(offset):
+    return -(-offset // _SNAPSHOT_ALIGNMENT) * _SNAPSHOT_ALIGNMENT
+
+
+class CompactNodeStore:
+    """Columnar storage for the k-d tree nodes.
+
+    Instead of keeping one dictionary per person, the node fields live in parallel typed arrays indexed by the node
+    position. A node id is simply its row index, and -1 marks a missing child. The names are stored in a single
+    utf-8 byte blob, with name_offsets[i]:name_offsets[i + 1] delimiting the name of node i.
+
+    Deleted nodes stay in the arrays and in the tree as tombstones, flagged in the deleted array, until compact drops
+    them. Once a person changes rows (when moved to another location or when the rows are compacted), the ids are no
+    longer the row indices, and the ids array keeps the id of each row.
+    """
+
+    def __init__(self, capacity=0, coord_dtype=np.float64):
+        """Allocates empty arrays for the given capacity
+
+        Args:
+            capacity: initial number of nodes that can be stored without growing the arrays
+            coord_dtype: numpy dtype of the latitude and longitude arrays (np.float32 or np.float64)
+        """
+        self.size = 0
+        self.root = -1
+        self.coord_dtype = np.dtype(coord_dtype)
+
+        index_dtype = self.index_dtype_for(capacity)
+        self.latitudes = np.empty(capacity, dtype=self.coord_dtype)
+        self.longitudes = np.empty(capacity, dtype=self.coord_dtype)
+        self.ages = np.empty(capacity, dtype=np.uint8)
+        self.left_ids = np.full(capacity, -1, dtype=index_dtype)
+        self.right_ids = np.full(capacity, -1, dtype=index_dtype)
+        self.name_offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self.name_bytes = np.empty(0, dtype=np.uint8)
+        # minimum and maximum age of each node's subtree, when the age index is enabled
+        self.subtree_age_min = None
+        self.subtree_age_max = None
+        # coordinates in radians and cosines of the latitudes for the distance kernels, computed on first use by
+        # get_kernel_columns
+        self.radian_latitudes = None
+        self.radian_longitudes = None
+        self.cos_latitudes = None
+        # number of nodes in the subtree of each node, when the rows are in in-order (see reorder_inorder). The
+        # subtrees changed by insertions are no longer contiguous and get NOT_CONTIGUOUS instead
+        self.subtree_sizes = None
+        # rows inserted below a contiguous subtree, by subtree root: the subtree is then its range of rows plus these
+        # rows, which get a subtree size of 0
+        self.appended_rows = {}
+        # tombstone flags, allocated by the first deletion, and their count
+        self.deleted = None
+        self.num_deleted = 0
+        # id of each row, allocated by assign_ids (None while the ids are the row indices), the next id to give, and
+        # the row of each id, built on demand by get_row
+        self.ids = None
+        self.next_id = 0
+        self._rows_by_id = None
+        # cached result of get_subtree_layout, reset whenever the tree changes
+        self._subtree_layout = None
+
+    NOT_CONTIGUOUS = np.iinfo(np.int64).max
+
+    @staticmethod
+    def index_dtype_for(capacity):
+        """Smallest integer dtype that can address the given number of nodes
+
+        Args:
+            capacity: number of nodes
+
+        Returns: np.int32 or np.int64
+
+        """
+        return np.int32 if capacity <= _INT32_MAX else np.int64
+
+    @classmethod
+    def from_arrays(cls, latitudes, longitudes, ages, names, coord_dtype=np.float64):
+        """Creates a store holding the given records. The child links are left empty (-1)
+
+        Args:
+            latitudes: array-like of latitudes
+            longitudes: array-like of longitudes
+            ages: array-like of ages
+            names: iterable of name strings
+            coord_dtype: numpy dtype of the coordinates
+
+        Returns: CompactNodeStore
+
+        """
+        size = len(latitudes)
+        store = cls(capacity=size, coord_dtype=coord_dtype)
+        store.latitudes[:] = latitudes
+        store.longitudes[:] = longitudes
+        store.ages[:] = ages
+
+        encoded_names = [name.encode('utf-8') for name in names]
+        store.name_offsets[1:] = np.cumsum([len(name) for name in encoded_names])
+        store.name_bytes = np.frombuffer(b''.join(encoded_names), dtype=np.uint8).copy()
+        store.size = size
+        return store
+
+    @classmethod
+    def from_items(cls, item_list, coord_dtype=np.float64):
+        """Creates a store from a list of item dictionaries (with name, age, latitude and longitude). The items keep
+        their ids, which should then be distinct non-negative integers (or their strings), as the ids are looked up in
+        an array indexed by id (see get_row). Without ids, the items get the indices of their rows
+
+        Args:
+            item_list: list of items representing people, with or without an id
+            coord_dtype: numpy dtype of the coordinates
+
+        Returns: CompactNodeStore
+
+        """
+        store = cls.from_arrays([item['latitude'] for item in item_list],
+                                [item['longitude'] for item in item_list],
+                                [item['age'] for item in item_list],
+                                [item['name'] for item in item_list],
+                                coord_dtype=coord_dtype)
+        if not any('id' in item for item in item_list):
+            return store
+        try:
+            ids = np.array([int(item['id']) for item in item_list], dtype=np.int64)
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('the ids of the items should be non-negative integers in compact mode')
+        if ids.min() < 0 or len(np.unique(ids)) != len(ids):
+            raise ValueError('the ids of the items should be distinct non-negative integers in compact mode')
+        if not np.array_equal(ids, np.arange(len(ids))):
+            store.assign_ids()
+            store.ids[:len(ids)] = ids
+            store.next_id = int(ids.max()) + 1
+        return store
+
+    @property
+    def capacity(self):
+        return len(self.latitudes)
+
+    def _grow(self, min_capacity):
+        """Grows the node arrays (by doubling) so that they can hold at least min_capacity nodes
+
+        Args:
+            min_capacity: required capacity
+
+        Returns: None
+
+        """
+        new_capacity = max(min_capacity, 2 * self.capacity, 16)
+        index_dtype = np.promote_types(self.left_ids.dtype, self.index_dtype_for(new_capacity))
+
+        def grown(array, fill=None, extra=0):
+            new_array = np.empty(new_capacity + extra, dtype=array.dtype)
+            if fill is not None:
+                new_array.fill(fill)
+            new_array[:len(array)] = array
+            return new_array
+
+        self.latitudes = grown(self.latitudes)
+        self.longitudes = grown(self.longitudes)
+        self.ages = grown(self.ages)
+        self.left_ids = grown(self.left_ids.astype(index_dtype, copy=False), fill=-1)
+        self.right_ids = grown(self.right_ids.astype(index_dtype, copy=False), fill=-1)
+        self.name_offsets = grown(self.name_offsets, fill=0, extra=1)
+        if self.subtree_age_min is not None:
+            self.subtree_age_min = grown(self.subtree_age_min)
+            self.subtree_age_max = grown(self.subtree_age_max)
+        if self.cos_latitudes is not None:
+            self.radian_latitudes = grown(self.radian_latitudes)
+            self.radian_longitudes = grown(self.radian_longitudes)
+            self.cos_latitudes = grown(self.cos_latitudes)
+        if self.subtree_sizes is not None:
+            self.subtree_sizes = grown(self.subtree_sizes)
+        if self.deleted is not None:
+            self.deleted = grown(self.deleted, fill=False)
+        if self.ids is not None:
+            self.ids = grown(self.ids)
+
+    def append(self, latitude, longitude, age, name, node_id=None):
+        """Appends a new (unlinked) node to the store
+
+        Args:
+            latitude:
+            longitude:
+            age:
+            name:
+            node_id: (optional) id of the node, to give a person who moved their former id. Defaults to a new id
+
+        Returns: index of the new node
+
+        """
+        if not 0 <= age <= 255:
+            raise ValueError('age should be between 0 and 255 in compact mode')
+        if node_id is not None:
+            self.assign_ids()
+
+        index = self.size
+        if index >= self.capacity:
+            self._grow(index + 1)
+
+        encoded_name = np.frombuffer(name.encode('utf-8'), dtype=np.uint8)
+        start = self.name_offsets[index]
+        end = start + len(encoded_name)
+        if end > len(self.name_bytes):
+            self.name_bytes = np.concatenate(
+                (self.name_bytes[:start], np.empty(max(end - start, start), dtype=np.uint8)))
+        self.name_bytes[start:end] = encoded_name
+
+        self.latitudes[index] = latitude
+        self.longitudes[index] = longitude
+        self.ages[index] = age
+        self.left_ids[index] = -1
+        self.right_ids[index] = -1
+        if self.subtree_age_min is not None:
+            self.subtree_age_min[index] = age
+            self.subtree_age_max[index] = age
+        self._update_kernel_columns(index, index + 1)
+        if self.subtree_sizes is not None:
+            self.subtree_sizes[index] = 1
+        if self.deleted is not None:
+            self.deleted[index] = False
+        if self.ids is not None:
+            node_id = self.next_id if node_id is None else node_id
+            self.ids[index] = node_id
+            self.next_id = max(self.next_id, node_id + 1)
+            if self._rows_by_id is not None:
+                if node_id >= len(self._rows_by_id):
+                    self._rows_by_id = np.concatenate(
+                        (self._rows_by_id, np.full(max(node_id + 1, 2 * len(self._rows_by_id)) -
+                                                   len(self._rows_by_id), -1, dtype=np.int64)))
+                self._rows_by_id[node_id] = index
+        self.name_offsets[index + 1] = end
+        self.size += 1
+        self.invalidate_subtree_layout()
+        return index
+
+    def extend(self, latitudes, longitudes, ages, names):
+        """Appends many new (unlinked) nodes at once
+
+        Args:
+            latitudes: array-like of latitudes
+            longitudes: array-like of longitudes
+            ages: array-like of ages
+            names: list of name strings
+
+        Returns: index of the first new node (the new nodes take the following rows)
+
+        """
+        ages = np.asarray(ages, dtype=np.int64)
+        if len(ages) and (ages.min() < 0 or ages.max() > 255):
+            raise ValueError('age should be between 0 and 255 in compact mode')
+
+        start, end = self.size, self.size + len(ages)
+        if end > self.capacity:
+            self._grow(end)
+
+        encoded_names = [name.encode('utf-8') for name in names]
+        name_start = self.name_offsets[start]
+        self.name_offsets[start + 1:end + 1] = name_start + np.cumsum([len(name) for name in encoded_names])
+        name_end = self.name_offsets[end]
+        if name_end > len(self.name_bytes):
+            self.name_bytes = np.concatenate(
+                (self.name_bytes[:name_start], np.empty(max(name_end - name_start, name_start), dtype=np.uint8)))
+        self.name_bytes[name_start:name_end] = np.frombuffer(b''.join(encoded_names), dtype=np.uint8)
+
+        self.latitudes[start:end] = latitudes
+        self.longitudes[start:end] = longitudes
+        self.ages[start:end] = ages
+        self.left_ids[start:end] = -1
+        self.right_ids[start:end] = -1
+        if self.subtree_age_min is not None:
+            self.subtree_age_min[start:end] = ages
+            self.subtree_age_max[start:end] = ages
+        self._update_kernel_columns(start, end)
+        if self.subtree_sizes is not None:
+            self.subtree_sizes[start:end] = 1
+        if self.deleted is not None:
+            self.deleted[start:end] = False
+        if self.ids is not None:
+            self.ids[start:end] = np.arange(self.next_id, self.next_id + len(ages))
+            self.next_id += len(ages)
+            # rebuilt on demand by get_row
+            self._rows_by_id = None
+        self.size = end
+        self.invalidate_subtree_layout()
+        return start
+
+    def assign_ids(self):
+        """Keeps the id of each row in the ids array from now on, starting from the row indices, so that the ids
+        survive a change of rows
+
+        Returns: None
+
+        """
+        if self.ids is None:
+            self.ids = np.arange(self.capacity, dtype=np.int64)
+            self.next_id = self.size
+
+    def get_id(self, index):
+        """Id of the node at index
+
+        Args:
+            index: node index
+
+        Returns: integer id
+
+        """
+        return int(self.ids[index]) if self.ids is not None else int(index)
+
+    def get_ids(self, indices):
+        """Ids of the nodes at indices, with -1 kept for the missing nodes
+
+        Args:
+            indices: numpy array of node indices
+
+        Returns: numpy array of ids
+
+        """
+        if self.ids is None:
+            return indices
+        return np.where(indices >= 0, self.ids[np.maximum(indices, 0)], -1)
+
+    def get_row(self, node_id):
+        """Index of the live node with the given id
+
+        Args:
+            node_id: integer id
+
+        Returns: node index, or -1 if there is no such node or it was deleted
+
+        """
+        if self.ids is None:
+            index = node_id if 0 <= node_id < self.size else -1
+        else:
+            if self._rows_by_id is None:
+                self._rows_by_id = np.full(max(self.next_id, 1), -1, dtype=np.int64)
+                live = np.arange(self.size) if self.deleted is None else np.flatnonzero(~self.deleted[:self.size])
+                self._rows_by_id[self.ids[live]] = live
+            index = int(self._rows_by_id[node_id]) if 0 <= node_id < len(self._rows_by_id) else -1
+        if index >= 0 and self.deleted is not None and self.deleted[index]:
+            return -1
+        return index
+
+    def delete(self, index):
+        """Turns the node at index into a tombstone: it keeps its place in the tree, but should be skipped by the
+        searches
+
+        Args:
+            index: node index
+
+        Returns: None
+
+        """
+        if self.deleted is None or not self.deleted.flags.writeable:
+            deleted = np.zeros(self.capacity, dtype=bool)
+            if self.deleted is not None:
+                deleted[:len(self.deleted)] = self.deleted
+            self.deleted = deleted
+        if not self.deleted[index]:
+            self.deleted[index] = True
+            self.num_deleted += 1
+            if self._rows_by_id is not None:
+                self._rows_by_id[self.get_id(index)] = -1
+
+    def compact(self):
+        """Drops the tombstones from the arrays. The remaining nodes keep their ids but move to other rows, and the
+        tree is emptied (root of -1 and no child links), to be built again
+
+        Returns: None
+
+        """
+        self.assign_ids()
+        live = np.arange(self.size) if self.deleted is None else np.flatnonzero(~self.deleted[:self.size])
+        self.reorder(live)
+        self.left_ids[:] = -1
+        self.right_ids[:] = -1
+        self.root = -1
+        self.deleted = None
+        self.num_deleted = 0
+        self.subtree_sizes = None
+        self.invalidate_subtree_layout()
+
+    def get_name(self, index):
+        """Decodes the name of the node at index
+
+        Args:
+            index: node index
+
+        Returns: name string
+
+        """
+        return self.name_bytes[self.name_offsets[index]:self.name_offsets[index + 1]].tobytes().decode('utf-8')
+
+    def get_node(self, index):
+        """Builds the dictionary representation of the node at index, as used by the dictionary-based store
+
+        Args:
+            index: node index
+
+        Returns: node dictionary, with string ids
+
+        """
+        left_id = int(self.left_ids[index])
+        right_id = int(self.right_ids[index])
+        return {'id': str(self.get_id(index)),
+                'name': self.get_name(index),
+                'age': int(self.ages[index]),
+                'latitude': float(self.latitudes[index]),
+                'longitude': float(self.longitudes[index]),
+                'left_id': str(self.get_id(left_id)) if left_id >= 0 else None,
+                'right_id': str(self.get_id(right_id)) if right_id >= 0 else None}
+
+    def get_kernel_columns(self):
+        """Node coordinates in radians and cosines of the node latitudes, used by the distance kernels (see
+        utilities.distance_kernels). They are computed on first use (24 bytes per node) and then kept up to date by
+        append
+
+        Returns: (latitudes in radians, longitudes in radians, cosines of the latitudes) numpy arrays indexed by node
+
+        """
+        if self.cos_latitudes is None:
+            self.radian_latitudes = np.empty(self.capacity)
+            self.radian_longitudes = np.empty(self.capacity)
+            self.cos_latitudes = np.empty(self.capacity)
+            self._update_kernel_columns(0, self.size)
+        return self.radian_latitudes, self.radian_longitudes, self.cos_latitudes
+
+    def _update_kernel_columns(self, start, end):
+        """Computes the kernel columns (see get_kernel_columns) of a range of rows, if they are used
+
+        Args:
+            start: first row
+            end: end of the range (excluded)
+
+        Returns: None
+
+        """
+        if self.cos_latitudes is None:
+            return
+        self.radian_latitudes[start:end] = np.radians(self.latitudes[start:end])
+        self.radian_longitudes[start:end] = np.radians(self.longitudes[start:end])
+        self.cos_latitudes[start:end] = np.cos(self.radian_latitudes[start:end])
+
+    def invalidate_subtree_layout(self):
+        """Drops the cached subtree layout. Should be called whenever the child links change
+
+        Returns: None
+
+        """
+        self._subtree_layout = None
+
+    def get_tree_levels(self, root=None):
+        """Lists the nodes of the tree level by level
+
+        Args:
+            root: (optional) index of the root of the subtree to list, or array of the roots of several subtrees.
+                Defaults to the root of the tree
+
+        Returns: list of arrays of node indices, starting with the root level
+
+        """
+        root = np.atleast_1d(self.root if root is None else root)
+        levels = []
+        level = root[root >= 0]
+        while len(level):
+            levels.append(level)
+            children = np.concatenate((self.left_ids[level], self.right_ids[level]))
+            level = children[children >= 0]
+        return levels
+
+    def build_age_index(self, root=None):
+        """Computes the minimum and maximum age in the subtree of each node, bottom-up with vectorized operations.
+        These summaries are then kept up to date by append and by the insertions
+
+        Args:
+            root: (optional) index of a subtree whose summaries are recomputed, the others being up to date (or array
+                of the roots of several subtrees)
+
+        Returns: None
+
+        """
+        levels = self.get_tree_levels(root)
+        if root is None:
+            self.subtree_age_min = self.ages.copy()
+            self.subtree_age_max = self.ages.copy()
+        elif levels:
+            nodes = np.concatenate(levels)
+            self.subtree_age_min[nodes] = self.ages[nodes]
+            self.subtree_age_max[nodes] = self.ages[nodes]
+        for level in reversed(levels):
+            for children in (self.left_ids[level], self.right_ids[level]):
+                has_child = children >= 0
+                parents, children = level[has_child], children[has_child]
+                self.subtree_age_min[parents] = np.minimum(self.subtree_age_min[parents],
+                                                           self.subtree_age_min[children])
+                self.subtree_age_max[parents] = np.maximum(self.subtree_age_max[parents],
+                                                           self.subtree_age_max[children])
+
+    def rebuild_subtree(self, root, depth, use_approx_median=True, median_sample=10000):
+        """Rebuilds a subtree into a balanced one, in place. The caller links the new subtree root to the parent of
+        the old one
+
+        Args:
+            root: index of the root of the subtree
+            depth: depth of the subtree root, which determines its splitting axis
+            use_approx_median: split large segments around the median of a random sample
+            median_sample: size of the random sample for the approximate median
+
+        Returns: index of the new subtree root
+
+        """
+        nodes = np.concatenate(self.get_tree_levels(root))
+        self.left_ids[nodes] = -1
+        self.right_ids[nodes] = -1
+        new_root = build_kd_tree((self.latitudes, self.longitudes), self.left_ids, self.right_ids, perm=nodes,
+                                 depth=depth, use_approx_median=use_approx_median, median_sample=median_sample)
+        if self.subtree_age_min is not None:
+            self.build_age_index(new_root)
+        if self.subtree_sizes is not None:
+            # the rows of the rebuilt subtrees are not in their in-order anymore
+            self.subtree_sizes[nodes] = self.NOT_CONTIGUOUS
+            if self.appended_rows:
+                for node in nodes.tolist():
+                    self.appended_rows.pop(node, None)
+        self.invalidate_subtree_layout()
+        return int(new_root)
+
+    def mark_not_contiguous(self, root):
+        """Marks all the nodes of a subtree as not contiguous, along with the rows appended to them
+
+        Args:
+            root: index of the root of the subtree
+
+        Returns: None
+
+        """
+        for level in self.get_tree_levels(root):
+            self.subtree_sizes[level] = self.NOT_CONTIGUOUS
+            if self.appended_rows:
+                for node in level.tolist():
+                    self.appended_rows.pop(node, None)
+
+    def get_subtree_layout(self):
+        """Lays out the nodes of the tree in in-order, so that every subtree occupies a contiguous range. The layout
+        is computed level by level with vectorized operations and cached until the tree changes
+
+        Returns: (inorder, starts, sizes) where inorder is the array of node indices in in-order, and the subtree of
+            node i is inorder[starts[i]:starts[i] + sizes[i]]
+
+        """
+        if self._subtree_layout is not None:
+            return self._subtree_layout
+
+        left_ids = self.left_ids[:self.size]
+        right_ids = self.right_ids[:self.size]
+        sizes = np.zeros(self.size, dtype=np.int64)
+        starts = np.zeros(self.size, dtype=np.int64)
+        inorder = np.empty(0, dtype=np.int64)
+        levels = self.get_tree_levels()
+
+        def subtree_sizes(nodes):
+            return np.where(nodes >= 0, sizes[nodes], 0)
+
+        # sizes bottom-up, then ranges top-down
+        for level in reversed(levels):
+            sizes[level] = 1 + subtree_sizes(left_ids[level]) + subtree_sizes(right_ids[level])
+
+        if levels:
+            inorder = np.empty(sizes[self.root], dtype=np.int64)
+        for level in levels:
+            left, right = left_ids[level], right_ids[level]
+            positions = starts[level] + subtree_sizes(left)
+            inorder[positions] = level
+            starts[left[left >= 0]] = starts[level][left >= 0]
+            starts[right[right >= 0]] = positions[right >= 0] + 1
+
+        self._subtree_layout = (inorder, starts, sizes)
+        return self._subtree_layout
+
+    def _snapshot_arrays(self):
+        """Lists the arrays saved in a snapshot, trimmed to the stored nodes. The kernel columns and the subtree
+        layout, which the searches would otherwise compute on first use, are saved too, so that the processes mapping
+        the snapshot share them instead of each building its own copy
+
+        Returns: list of (attribute name, array)
+
+        """
+        inorder, starts, sizes = self.get_subtree_layout()
+        radian_latitudes, radian_longitudes, cos_latitudes = self.get_kernel_columns()
+        arrays = [('latitudes', self.latitudes[:self.size]),
+                  ('longitudes', self.longitudes[:self.size]),
+                  ('ages', self.ages[:self.size]),
+                  ('left_ids', self.left_ids[:self.size]),
+                  ('right_ids', self.right_ids[:self.size]),
+                  ('name_offsets', self.name_offsets[:self.size + 1]),
+                  ('name_bytes', self.name_bytes[:self.name_offsets[self.size]]),
+                  ('radian_latitudes', radian_latitudes[:self.size]),
+                  ('radian_longitudes', radian_longitudes[:self.size]),
+                  ('cos_latitudes', cos_latitudes[:self.size]),
+                  ('layout_inorder', inorder),
+                  ('layout_starts', starts),
+                  ('layout_sizes', sizes)]
+        if self.subtree_age_min is not None:
+            arrays += [('subtree_age_min', self.subtree_age_min[:self.size]),
+                       ('subtree_age_max', self.subtree_age_max[:self.size])]
+        if self.subtree_sizes is not None:
+            arrays.append(('subtree_sizes', self.subtree_sizes[:self.size]))
+        if self.deleted is not None:
+            arrays.append(('deleted', self.deleted[:self.size]))
+        if self.ids is not None:
+            arrays.append(('ids', self.ids[:self.size]))
+        if self.appended_rows:
+            # flattened as the subtree root, the number of appended rows, and the rows, for each subtree
+            arrays.append(('appended_rows', np.array(
+                [value for root, rows in self.appended_rows.items() for value in [root, len(rows)] + rows],
+                dtype=np.int64)))
+        return arrays
+
+    def save(self, filename):
+        """Saves the store to a binary snapshot file that can be memory-mapped by load. The file is written next to
+        its destination then renamed, so that processes loading the snapshot never see a partial file
+
+        Args:
+            filename: path of the snapshot file
+
+        Returns: None
+
+        """
+        arrays = self._snapshot_arrays()
+        header = {'size': int(self.size), 'root': int(self.root), 'coord_dtype': self.coord_dtype.str,
+                  'next_id': int(self.next_id), 'arrays': []}
+        offset = 0
+        for name, array in arrays:
+            header['arrays'].append({'name': name, 'dtype': array.dtype.str, 'length': len(array), 'offset': offset})
+            offset = _aligned(offset + array.nbytes)
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        prefix = _SNAPSHOT_MAGIC + _SNAPSHOT_PREFIX.pack(SNAPSHOT_VERSION, len(header_bytes)) + header_bytes
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as snapshot_file:
+            snapshot_file.write(prefix)
+            position = len(prefix)
+            data_start = _aligned(position)
+            for (_, array), entry in zip(arrays, header['arrays']):
+                snapshot_file.write(b'\0' * (data_start + entry['offset'] - position))
+                snapshot_file.write(memoryview(np.ascontiguousarray(array)).cast('B'))
+                position = data_start + entry['offset'] + array.nbytes
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        """Opens a snapshot saved by save. With memory mapping, nothing is read upfront: the pages are loaded on
+        demand and shared, through the page cache, by all the processes that map the same file. The store can still
+        take insertions, as the first one copies the arrays to memory when growing them
+
+        Args:
+            filename: path of the snapshot file
+            mmap_mode: 'r' to map the arrays read-only, 'c' for copy-on-write, or None to read them into memory
+
+        Returns: CompactNodeStore
+
+        """
+        if mmap_mode not in ('r', 'c', None):
+            raise ValueError("mmap_mode should be 'r', 'c', or None")
+
+        with open(filename, 'rb') as snapshot_file:
+            prefix = snapshot_file.read(len(_SNAPSHOT_MAGIC) + _SNAPSHOT_PREFIX.size)
+            if len(prefix) < len(_SNAPSHOT_MAGIC) + _SNAPSHOT_PREFIX.size or \
+                    not prefix.startswith(_SNAPSHOT_MAGIC):
+                raise ValueError(filename + ' is not a snapshot file')
+            version, header_length = _SNAPSHOT_PREFIX.unpack(prefix[len(_SNAPSHOT_MAGIC):])
+            if version != SNAPSHOT_VERSION:
+                raise ValueError('unsupported snapshot version {} (expected {})'.format(version, SNAPSHOT_VERSION))
+            header = json.loads(snapshot_file.read(header_length).decode('utf-8'))
+
+        data_start = _aligned(len(prefix) + header_length)
+        store = cls(coord_dtype=np.dtype(header['coord_dtype']))
+        store.size = header['size']
+        store.root = header['root']
+        for entry in header['arrays']:
+            dtype, length, offset = np.dtype(entry['dtype']), entry['length'], data_start + entry['offset']
+            if mmap_mode is None:
+                array = np.fromfile(filename, dtype=dtype, count=length, offset=offset)
+            elif length == 0:
+                array = np.empty(0, dtype=dtype)
+            else:
+                # plain ndarray view, which keeps the mapping alive without the overhead of the memmap subclass
+                array = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=offset, shape=(length,)).view(
+                    np.ndarray)
+            setattr(store, entry['name'], array)
+        if hasattr(store, 'layout_inorder'):
+            store._subtree_layout = (store.layout_inorder, store.layout_starts, store.layout_sizes)
+            del store.layout_inorder, store.layout_starts, store.layout_sizes
+        if store.deleted is not None:
+            store.num_deleted = int(np.count_nonzero(store.deleted))
+        if len(store.appended_rows):
+            flat_rows, store.appended_rows = store.appended_rows.tolist(), {}
+            position = 0
+            while position < len(flat_rows):
+                root, length = flat_rows[position], flat_rows[position + 1]
+                store.appended_rows[root] = flat_rows[position + 2:position + 2 + length]
+                position += 2 + length
+        store.next_id = header.get('next_id', store.size)
+        return store
+
+    def reorder(self, order):
+        """Renumbers the nodes: the node at row order[i] moves to row i, and the child links and the root follow it.
+        The nodes left out of order are dropped, along with the links to them
+
+        Args:
+            order: permutation of the node indices, or of a subset of them
+
+        Returns: None
+
+        """
+        positions = np.full(self.size, -1, dtype=np.int64)
+        positions[order] = np.arange(len(order))
+
+        def renumbered_links(ids):
+            ids = ids[:self.size][order]
+            return np.where(ids >= 0, positions[np.maximum(ids, 0)], -1).astype(ids.dtype)
+
+        self.left_ids = renumbered_links(self.left_ids)
+        self.right_ids = renumbered_links(self.right_ids)
+        for name in ('latitudes', 'longitudes', 'ages', 'subtree_age_min', 'subtree_age_max', 'radian_latitudes',
+                     'radian_longitudes', 'cos_latitudes', 'subtree_sizes', 'deleted', 'ids'):
+            array = getattr(self, name)
+            if array is not None:
+                setattr(self, name, array[:self.size][order])
+
+        name_lengths = np.diff(self.name_offsets[:self.size + 1])[order]
+        name_starts = self.name_offsets[:self.size][order]
+        name_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(name_lengths, out=name_offsets[1:])
+        self.name_bytes = self.name_bytes[np.repeat(name_starts - name_offsets[:-1], name_lengths) +
+                                          np.arange(name_offsets[-1])]
+        self.name_offsets = name_offsets
+
+        self.size = len(order)
+        if self.root >= 0:
+            self.root = int(positions[self.root])
+        self._rows_by_id = None
+        self.appended_rows = {}
+        self.invalidate_subtree_layout()
+
+    def reorder_inorder(self):
+        """Renumbers the nodes in the in-order of the tree, so that the nodes of every subtree occupy a contiguous
+        range of rows: the subtree of node i spans the rows from i - subtree_sizes[left child] to i + subtree_sizes[right
+        child]. The leaf buckets of the k nearest neighbors search are such ranges, which are scanned as array slices.
+        The node ids follow the rows once assign_ids was called, and change accordingly otherwise
+
+        Returns: None
+
+        """
+        inorder, _, sizes = self.get_subtree_layout()
+        if len(inorder) != self.size:
+            raise ValueError('all the nodes should be in the tree to reorder them')
+        subtree_sizes = sizes[inorder].astype(np.int64)
+        self.reorder(inorder)
+        self.subtree_sizes = subtree_sizes
+
+    def get_contiguous_subtree(self, index):
+        """Range of rows of the subtree of a node, when it is contiguous (see reorder_inorder). The rows appended
+        below the node since are in appended_rows
+
+        Args:
+            index: node index
+
+        Returns: (start, end) rows, or None if the subtree is not contiguous
+
+        """
+        size = self.subtree_sizes[index]
+        if size == self.NOT_CONTIGUOUS:
+            return None
+        left_index = self.left_ids[index]
+        start = index - (self.subtree_sizes[left_index] if left_index >= 0 else 0)
+        return start, start + size
+
+    def nbytes(self):
+        """Memory used by the node arrays
+
+        Returns: number of bytes
+
+        """
+        return sum(array.nbytes for array in
+                   (self.latitudes, self.longitudes, self.ages, self.left_ids, self.right_ids, self.name_offsets,
+                    self.name_bytes, self.subtree_age_min, self.subtree_age_max, self.radian_latitudes,
+                    self.radian_longitudes, self.cos_latitudes, self.subtree_sizes, self.deleted, self.ids,
+                    self._rows_by_id) if array is not None)
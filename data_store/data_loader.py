@@ -0,0 +1,157 @@
+import io
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from data_store.compact_node_store import CompactNodeStore
+
+# size of the blocks read from the data files. Each block is parsed at once, so the memory used by the loader on top of
+# the final arrays stays around a few times this size
+_chunk_bytes = 1 << 22
+
+
+def count_lines(filename, chunk_bytes=_chunk_bytes):
+    """Counts the lines of a file by counting its newlines block by block (a last line without newline counts too)
+
+    Args:
+        filename: path of the file
+        chunk_bytes: size of the blocks read
+
+    Returns: number of lines
+
+    """
+    num_lines = 0
+    last_block = b''
+    with open(filename, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(chunk_bytes), b''):
+            num_lines += block.count(b'\n')
+            last_block = block
+    if last_block and not last_block.endswith(b'\n'):
+        num_lines += 1
+    return num_lines
+
+
+def read_line_chunks(filename, chunk_bytes=_chunk_bytes):
+    """Reads a file in blocks of whole lines
+
+    Args:
+        filename: path of the file
+        chunk_bytes: approximate size of the blocks
+
+    Returns: generator of bytes objects, each ending with a newline
+
+    """
+    remainder = b''
+    with open(filename, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(chunk_bytes), b''):
+            block = remainder + block
+            end = block.rfind(b'\n') + 1
+            remainder = block[end:]
+            if end:
+                yield block[:end]
+    if remainder:
+        yield remainder + b'\n'
+
+
+def _check_num_rows(filename, num_rows, expected_rows):
+    if num_rows != expected_rows:
+        raise ValueError('{} has {} rows instead of {}'.format(filename, num_rows, expected_rows))
+
+
+def _load_ages(filename, store, chunk_bytes):
+    """Parses the ages file (one integer per line) into store.ages. The ages must fit its dtype: the uint8 column of the
+    compact store bounds them to 0-255"""
+    position = 0
+    bounded = store.ages.dtype == np.uint8
+    for chunk in read_line_chunks(filename, chunk_bytes):
+        ages = np.loadtxt(io.BytesIO(chunk), dtype=np.int64, ndmin=1)
+        if bounded and len(ages) and (ages.min() < 0 or ages.max() > 255):
+            raise ValueError('ages should be between 0 and 255 in ' + filename)
+        if position + len(ages) > store.size:
+            _check_num_rows(filename, position + len(ages), store.size)
+        store.ages[position:position + len(ages)] = ages
+        position += len(ages)
+    _check_num_rows(filename, position, store.size)
+
+
+def _load_coords(filename, store, chunk_bytes):
+    """Parses the coordinates file (latitude,longitude per line) into store.latitudes and store.longitudes"""
+    position = 0
+    for chunk in read_line_chunks(filename, chunk_bytes):
+        coords = np.loadtxt(io.BytesIO(chunk), dtype=np.float64, delimiter=',', ndmin=2)
+        if position + len(coords) > store.size:
+            _check_num_rows(filename, position + len(coords), store.size)
+        store.latitudes[position:position + len(coords)] = coords[:, 0]
+        store.longitudes[position:position + len(coords)] = coords[:, 1]
+        position += len(coords)
+    _check_num_rows(filename, position, store.size)
+
+
+def _load_names(filename, store, chunk_bytes):
+    """Copies the names file (one name per line) into store.name_bytes and store.name_offsets, by splitting the raw
+    bytes on the newlines"""
+    position = 0
+    name_end = 0
+    for chunk in read_line_chunks(filename, chunk_bytes):
+        if b'\r' in chunk:
+            chunk = chunk.replace(b'\r', b'')
+        chunk_bytes_array = np.frombuffer(chunk, dtype=np.uint8)
+        is_newline = chunk_bytes_array == ord('\n')
+        newlines = np.flatnonzero(is_newline)
+        if position + len(newlines) > store.size:
+            _check_num_rows(filename, position + len(newlines), store.size)
+
+        # removing the newlines shifts the end of the i-th name of the chunk by i
+        names = chunk_bytes_array[~is_newline]
+        store.name_bytes[name_end:name_end + len(names)] = names
+        store.name_offsets[position + 1:position + 1 + len(newlines)] = name_end + newlines - np.arange(len(newlines))
+        position += len(newlines)
+        name_end += len(names)
+    _check_num_rows(filename, position, store.size)
+    store.name_bytes = store.name_bytes[:name_end]
+
+
+def load_compact_store(ages_file, names_file, coords_file, coord_dtype=np.float64, data_in_parallel=False,
+                       chunk_bytes=_chunk_bytes, compact_ages=True):
+    """Loads the generated data files into a CompactNodeStore (without child links).
+
+    The arrays are allocated once from the number of lines, then each file is streamed in blocks of lines that are
+    parsed with numpy's C parser (or split on the newlines for the names) and copied straight into the arrays, so that
+    no python object is created per row.
+
+    Args:
+        ages_file: path of the ages file
+        names_file: path of the names file
+        coords_file: path of the coordinates file
+        coord_dtype: numpy dtype of the coordinates
+        data_in_parallel: load the three files concurrently (in threads writing to their own arrays)
+        chunk_bytes: size of the blocks read from the files
+        compact_ages: keep the ages in the uint8 column of the compact store, which only holds ages between 0 and 255.
+            Otherwise, they are loaded as int64 without bounds, for the stores that are only formatted from the arrays
+
+    Returns: CompactNodeStore
+
+    """
+    start_time = time.time()
+    size = count_lines(ages_file, chunk_bytes)
+    store = CompactNodeStore(capacity=size, coord_dtype=coord_dtype)
+    store.size = size
+    if not compact_ages:
+        store.ages = np.empty(size, dtype=np.int64)
+    # upper bound of the names' size: the file without the newlines (the last line might not have one)
+    store.name_bytes = np.empty(os.path.getsize(names_file) - count_lines(names_file, chunk_bytes) + 1,
+                                dtype=np.uint8)
+
+    loaders = [(_load_ages, ages_file), (_load_names, names_file), (_load_coords, coords_file)]
+    if data_in_parallel:
+        with ThreadPool(len(loaders)) as pool:
+            pool.map(lambda loader: loader[0](loader[1], store, chunk_bytes), loaders)
+    else:
+        for loader, filename in loaders:
+            loader(filename, store, chunk_bytes)
+
+    elapsed = time.time() - start_time
+    print('loaded {} rows in {:.2f} seconds ({:.0f} rows/sec)'.format(size, elapsed, size / max(elapsed, 1e-9)))
+    return store
@@ -0,0 +1,75 @@
+import argparse
+import time
+
+import numpy as np
+
+from data_store.grid_store import GridDataStore
+from data_store.kd_tree_store import KDTreeDataStore
+
+
+def benchmark_engine(store, targets, k, age_proximity, exact_results):
+    """Times the queries of an engine and measures its recall
+
+    Args:
+        store: data store
+        targets: list of target items
+        k: number of neighbors
+        age_proximity: maximum difference between a candidate neighbor's age and the target
+        exact_results: exact neighbors of each target
+
+    Returns: dictionary of statistics (latencies in milliseconds)
+
+    """
+    latencies = []
+    recalls = []
+    for target_item, expected in zip(targets, exact_results):
+        start_time = time.perf_counter()
+        result = store.k_nearest_neighbors(target_item, k, age_proximity)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+        recalls.append(KDTreeDataStore.recall_at_k(result, expected))
+    memory = store.nbytes() if isinstance(store, GridDataStore) else store.node_store.nbytes()
+    return {'mean_ms': np.mean(latencies),
+            'p50_ms': np.percentile(latencies, 50),
+            'p95_ms': np.percentile(latencies, 95),
+            'p99_ms': np.percentile(latencies, 99),
+            'recall': np.mean(recalls),
+            'memory_mb': memory / 2 ** 20}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compares the latency, recall, and memory of the index engines')
+    parser.add_argument('-s', '--size', help='number of data items (of the generated data files)', dest='size',
+                        required=True, type=int)
+    parser.add_argument('-q', '--num_queries', help='number of queries', dest='num_queries', default=500, type=int)
+    parser.add_argument('-k', help='number of neighbors', dest='k', default=10, type=int)
+    parser.add_argument('--age_proximity', help='age proximity of the queries', dest='age_proximity', default=5,
+                        type=int)
+    parser.add_argument('--bucket_size', help='leaf bucket size of the k-d tree', dest='bucket_size', default=128,
+                        type=int)
+    args = parser.parse_args()
+
+    engines = []
+    start_time = time.time()
+    kd_store = KDTreeDataStore(redis_mode=False, size=args.size, compact_mode=True, use_snapshot=False,
+                               bucket_size=args.bucket_size)
+    engines.append(('kd_tree', kd_store, time.time() - start_time))
+    for exact in (True, False):
+        start_time = time.time()
+        grid_store = GridDataStore(size=args.size, exact=exact)
+        engines.append(('grid' if exact else 'grid (approximate)', grid_store, time.time() - start_time))
+
+    # the queries are made from the locations of random people, like the requests of the users
+    rng = np.random.RandomState(0)
+    rows = rng.randint(0, kd_store.node_store.size, args.num_queries)
+    targets = [{'latitude': float(kd_store.node_store.latitudes[row]),
+                'longitude': float(kd_store.node_store.longitudes[row]),
+                'age': int(rng.randint(10, 80))} for row in rows]
+    exact_results = [kd_store.k_nearest_neighbors(target_item, args.k, args.age_proximity) for target_item in targets]
+
+    print('\n{:<20}{:>10}{:>10}{:>10}{:>10}{:>10}{:>12}{:>10}'.format('engine', 'build s', 'mean ms', 'p50 ms',
+                                                                    'p95 ms', 'p99 ms', 'memory MB', 'recall'))
+    for name, store, build_time in engines:
+        stats = benchmark_engine(store, targets, args.k, args.age_proximity, exact_results)
+        print('{:<20}{:>10.2f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>12.1f}{:>10.3f}'.format(
+            name, build_time, stats['mean_ms'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['memory_mb'], stats['recall']))
@@ -0,0 +1,418 @@
+import time
+
+import numpy as np
+
+from data_store.compact_node_store import CompactNodeStore
+from data_store.data_loader import load_compact_store
+from data_store.kd_tree_store import KDTreeDataStore
+from data_store.metrics import SearchCounters
+from utilities import file_utils
+from utilities.distance_kernels import query_terms, haversine_terms, terms_to_distances, distance_to_term
+from utilities.geo_utils import box_boundary_distances
+
+
+class GridDataStore(KDTreeDataStore):
+    """In-memory data store indexing the people in a fixed grid of latitude/longitude cells, as an alternative engine
+    to the k-d tree.
+
+    The cell size is chosen from the number of people, so that a cell holds points_per_cell people on average. The
+    records are kept in a CompactNodeStore sorted by cell, so that each cell is a contiguous range of rows
+    (cell_starts[cell] to cell_starts[cell + 1]). A query scans the rings of cells around the target's cell, each ring
+    with one vectorized distance and age filter, until the k-th neighbor found is closer than any unscanned cell.
+    Inserted people are kept in per-cell lists and merged into the sorted rows once they exceed merge_fraction of the
+    store.
+
+    The store answers the same k_nearest_neighbors and insert_item calls as KDTreeDataStore, and reuses its rest
+    application and profiling. Its attributes are set by KDTreeDataStore._configure, as an in-memory compact store
+    without snapshots.
+    """
+    # average number of people per cell targeted when sizing the grid
+    points_per_cell = 32
+    # fraction of the store that the inserted people can reach before they are merged into the sorted rows
+    merge_fraction = 0.25
+
+    def __init__(self, data_from_file=True, data_list=None, data_in_parallel=False, size=100,
+                 coord_dtype=np.float64, points_per_cell=None, exact=True, max_visits=None, time_budget=None,
+                 max_radius=None, max_age_widening=0, result_cache_bytes=0, result_cache_grid=0.01,
+                 result_cache_ttl=60.0):
+        """Initializes the store, reads the data, and constructs the grid
+
+        Args:
+            data_from_file: when True, data is loaded from files; otherwise, data_list should give the list of data
+            data_list: list of items to build the index from
+            data_in_parallel: load the three data files concurrently
+            size: size of the data files
+            coord_dtype: numpy dtype of the coordinates
+            points_per_cell: (optional) average number of people per cell. Defaults to the class attribute
+            exact: return the exact k nearest neighbors. Otherwise, the search stops at the first ring of cells after
+                which k neighbors were found, which is faster but can miss closer people right across a cell border
+            max_visits: (optional) default maximum number of people scanned by a k nearest neighbors search
+            time_budget: (optional) default maximum duration of a k nearest neighbors search, in seconds
+            max_radius: (optional) default maximum distance of the neighbors returned by recommend, in kilometers
+            max_age_widening: default number of years by which recommend can widen the age window when it finds too
+                few neighbors
+            result_cache_bytes: memory of the cache of k nearest neighbors results (see ResultCache). 0 disables the
+                cache
+            result_cache_grid: size of the cells the cached queries are quantized to, in degrees
+            result_cache_ttl: number of seconds after which a cached result expires
+        """
+        self._configure(redis_mode=False, data_from_file=data_from_file, data_list=data_list, size=size,
+                        compact_mode=True, coord_dtype=coord_dtype, build_workers=1, age_index=False,
+                        use_snapshot=False, node_cache_size=0, pinned_levels=0, redis_index=None, bucket_size=0,
+                        max_visits=max_visits, time_budget=time_budget, max_radius=max_radius,
+                        max_age_widening=max_age_widening, rebalance=False, result_cache_bytes=result_cache_bytes,
+                        result_cache_grid=result_cache_grid, result_cache_ttl=result_cache_ttl)
+        if points_per_cell is not None:
+            self.points_per_cell = points_per_cell
+        self.exact = exact
+
+        if data_from_file:
+            if not file_utils.all_files_exist(self.ages_file, self.names_file, self.coords_file):
+                raise AssertionError(
+                    "Data files are missing for this size. Generate them by running realistic_data_generator.py with --size argument of " + str(
+                        size))
+            self.node_store = load_compact_store(self.ages_file, self.names_file, self.coords_file,
+                                                 coord_dtype=coord_dtype, data_in_parallel=data_in_parallel)
+        else:
+            self.node_store = CompactNodeStore.from_items(data_list or [], coord_dtype=coord_dtype)
+
+        self.construct_index()
+
+    def save_snapshot(self, filename=None):
+        """Not available: the grid is not saved in the snapshots, which only hold the k-d tree layout
+
+        Raises: AssertionError
+
+        """
+        raise AssertionError('snapshots are not available with the grid engine')
+
+    def load_snapshot(self, filename=None, mmap_mode='r'):
+        """Not available (see save_snapshot)
+
+        Raises: AssertionError
+
+        """
+        raise AssertionError('snapshots are not available with the grid engine')
+
+    def construct_index(self, item_list=None):
+        """Sizes the grid for the current number of people, and sorts the records by cell
+
+        Args:
+            item_list: (optional) list of items to index instead of the current records
+
+        Returns: None
+
+        """
+        if item_list is not None:
+            self.node_store = CompactNodeStore.from_items(item_list, coord_dtype=self.coord_dtype)
+            if self.result_cache is not None:
+                self.result_cache.clear()
+
+        start_time = time.time()
+        self._build_grid()
+        print('built a grid of {}x{} cells in {:.2f} seconds'.format(self.num_rows, self.num_cols,
+                                                                     time.time() - start_time))
+
+    def _build_grid(self):
+        """Sizes the grid for the current number of people, and sorts the records by cell, which merges the inserted
+        people into the sorted rows. The people keep the ids of their rows in the data, as the rows move
+
+        Returns: None
+
+        """
+        store = self.node_store
+        store.assign_ids()
+        cell_degrees = min(np.sqrt(180.0 * 360.0 * self.points_per_cell / max(store.size, 1)), 180.0)
+        self.num_rows = int(np.ceil(180.0 / cell_degrees))
+        self.num_cols = int(np.ceil(360.0 / cell_degrees))
+        self.row_degrees = 180.0 / self.num_rows
+        self.col_degrees = 360.0 / self.num_cols
+
+        cells = self._cells_of(store.latitudes[:store.size], store.longitudes[:store.size])
+        order = np.argsort(cells, kind='stable')
+        store.reorder(order)
+        self.cell_starts = np.searchsorted(cells[order], np.arange(self.num_rows * self.num_cols + 1))
+        # rows appended since the grid was built, by cell
+        self._inserted = {}
+        self._num_inserted = 0
+
+    def _cells_of(self, latitudes, longitudes):
+        """Grid cells of the given coordinates
+
+        Args:
+            latitudes: latitudes (scalar or numpy array)
+            longitudes: longitudes
+
+        Returns: cell numbers (row * num_cols + col)
+
+        """
+        rows = np.clip(np.floor((np.asarray(latitudes, dtype=np.float64) + 90) / self.row_degrees), 0,
+                       self.num_rows - 1).astype(np.int64)
+        cols = np.floor((np.asarray(longitudes, dtype=np.float64) + 180) / self.col_degrees).astype(np.int64)
+        return rows * self.num_cols + cols % self.num_cols
+
+    def _ring_cells(self, row, col, ring):
+        """Cells at exactly ring cells from (row, col), wrapping around the antimeridian
+
+        Args:
+            row: row of the center cell
+            col: column of the center cell
+            ring: ring number (0 for the center cell)
+
+        Returns: numpy array of cell numbers
+
+        """
+        ring_cols = np.unique((col + np.arange(-ring, ring + 1)) % self.num_cols)
+        inner_cols = np.unique((col + np.arange(-ring + 1, ring)) % self.num_cols) if ring else ring_cols[:0]
+        cells = []
+        for ring_row in (row - ring, row + ring) if ring else (row,):
+            if 0 <= ring_row < self.num_rows:
+                cells.append(ring_row * self.num_cols + ring_cols)
+        side_cols = np.setdiff1d(ring_cols, inner_cols, assume_unique=True)
+        side_rows = np.arange(max(row - ring + 1, 0), min(row + ring, self.num_rows))
+        if ring and len(side_cols) and len(side_rows):
+            cells.append((side_rows[:, None] * self.num_cols + side_cols).ravel())
+        return np.concatenate(cells) if cells else np.empty(0, dtype=np.int64)
+
+    def _cell_rows(self, cells):
+        """Rows of the records in the given cells, including the inserted ones
+
+        Args:
+            cells: numpy array of cell numbers
+
+        Returns: numpy array of row indices
+
+        """
+        starts, ends = self.cell_starts[cells], self.cell_starts[cells + 1]
+        lengths = ends - starts
+        rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        if self._inserted:
+            inserted = [self._inserted[cell] for cell in cells.tolist() if cell in self._inserted]
+            if inserted:
+                rows = np.concatenate([rows] + [np.array(cell_rows, dtype=np.int64) for cell_rows in inserted])
+        return rows
+
+    def _searched_box_distance(self, latitude, longitude, row, col, ring):
+        """Lower bound of the distance between the target and the cells beyond ring
+
+        Args:
+            latitude: target's latitude
+            longitude: target's longitude
+            row: row of the target's cell
+            col: column of the target's cell
+            ring: last ring scanned
+
+        Returns: distance in kilometers (infinite once the whole grid was scanned)
+
+        """
+        lat_min = (row - ring) * self.row_degrees - 90 if row - ring > 0 else -np.inf
+        lat_max = (row + ring + 1) * self.row_degrees - 90 if row + ring + 1 < self.num_rows else np.inf
+        if 2 * ring + 1 >= self.num_cols:
+            lon_min, lon_max = -180.0, 180.0
+        else:
+            lon_min = (col - ring) * self.col_degrees - 180
+            lon_max = (col + ring + 1) * self.col_degrees - 180
+        return float(box_boundary_distances(np.float64(latitude), np.float64(longitude), lat_min, lat_max, lon_min,
+                                            lon_max))
+
+    def _search(self, target_item, k, age_proximity, budget=None, max_radius=None, counters=None):
+        """Scans the rings of cells around the target
+
+        Args:
+            target_item: target user
+            k: number of neighbors
+            age_proximity: maximum difference between a candidate neighbor's age and the user
+            budget: (optional) search budget (see _search_budget), counting the people scanned
+            max_radius: (optional) only consider the people closer than this distance, in kilometers
+            counters: (optional) SearchCounters receiving the number of people scanned
+
+        Returns: (rows, distances, exact) of the neighbors, sorted in ascending order of distance, where exact is False
+            when closer neighbors could remain in the cells left unscanned
+
+        """
+        store = self.node_store
+        radian_latitudes, radian_longitudes, cos_latitudes = store.get_kernel_columns()
+        latitude, longitude = target_item['latitude'], target_item['longitude']
+        query = query_terms(latitude, longitude)
+        center = int(self._cells_of(latitude, longitude))
+        row, col = divmod(center, self.num_cols)
+
+        best_rows = np.empty(0, dtype=np.int64)
+        best_terms = np.empty(0)
+        if k <= 0:
+            return best_rows, best_terms, True
+        last_ring = max(row, self.num_rows - 1 - row, self.num_cols // 2)
+        max_term = np.inf if max_radius is None else distance_to_term(max_radius)
+        visits = 0
+        exact = True
+        for ring in range(last_ring + 1):
+            candidates = self._cell_rows(self._ring_cells(row, col, ring))
+            visits += len(candidates)
+            if len(candidates):
+                valid = np.abs(store.ages[candidates].astype(np.int64) - target_item['age']) <= age_proximity
+                if store.deleted is not None:
+                    valid &= ~store.deleted[candidates]
+                candidates = candidates[valid]
+                candidate_terms = haversine_terms(query, radian_latitudes[candidates], radian_longitudes[candidates],
+                                                  cos_latitudes[candidates])
+                if max_radius is not None:
+                    in_radius = candidate_terms < max_term
+                    candidates, candidate_terms = candidates[in_radius], candidate_terms[in_radius]
+                best_rows = np.concatenate([best_rows, candidates])
+                best_terms = np.concatenate([best_terms, candidate_terms])
+                if len(best_rows) > k:
+                    best = np.argpartition(best_terms, k - 1)[:k]
+                    best_rows, best_terms = best_rows[best], best_terms[best]
+
+            if ring == last_ring:
+                break
+            # no unscanned cell can hold people closer than the k-th neighbor, or than the radius
+            bound = terms_to_distances(best_terms.max()) if len(best_rows) == k else (
+                np.inf if max_radius is None else max_radius)
+            if bound <= self._searched_box_distance(latitude, longitude, row, col, ring):
+                break
+            if (len(best_rows) == k and not self.exact) or (
+                    budget is not None and self._budget_exhausted(budget, visits)):
+                exact = False
+                break
+
+        if counters is not None:
+            counters.visited += visits
+        order = np.argsort(best_terms, kind='stable')
+        return best_rows[order], terms_to_distances(best_terms[order]), exact
+
+    def k_nearest_neighbors(self, target_item, k, age_proximity, max_visits=None, time_budget=None,
+                            return_exact=False, max_radius=None):
+        """Compute the k nearest neighbors to the target_item given the age_proximity
+
+        Args:
+            target_item: user node
+            k: number of neighbors
+            age_proximity: maximum difference between a candidate neighbor's age and the user
+            max_visits: (optional) maximum number of people scanned. Defaults to self.max_visits
+            time_budget: (optional) maximum duration of the search, in seconds. Defaults to self.time_budget
+            return_exact: also return whether the search was exact
+            max_radius: (optional) only consider the people closer than this distance, in kilometers
+
+        Returns: list of neighbors, sorted in ascending order of distance to the target_user. With return_exact,
+            (list of neighbors, exact)
+
+        """
+        start_time = time.perf_counter()
+        cached = self._get_cached_result(target_item, k, age_proximity, max_radius, max_visits)
+        if cached is not None:
+            self.metrics.observe_stage('cache_hit', time.perf_counter() - start_time)
+            return cached if return_exact else cached[0]
+
+        counters = SearchCounters()
+        rows, distances, exact = self._search(target_item, k, age_proximity,
+                                              self._search_budget(max_visits, time_budget), max_radius=max_radius,
+                                              counters=counters)
+        result = []
+        for index, distance in zip(rows.tolist(), distances.tolist()):
+            node = self.node_store.get_node(index)
+            result.append({'distance': distance, 'longitude': node['longitude'], 'latitude': node['latitude'],
+                           'name': node['name'], 'age': node['age']})
+        self.metrics.observe_stage('search', time.perf_counter() - start_time)
+        # the grid has no tree to prune nor queue to push to
+        self.metrics.observe_query(counters.visited, 0, 0, 0)
+        if self.result_cache is not None:
+            self.result_cache.put(target_item, k, age_proximity, result, exact, max_radius=max_radius,
+                                  max_visits=max_visits)
+        if return_exact:
+            return result, exact
+        return result
+
+    def k_nearest_neighbors_batch(self, latitudes, longitudes, ages, k, age_proximity):
+        """Computes the k nearest neighbors of many targets. This is not a vectorized batch path like the k-d tree's:
+        the targets are searched one after the other, each with its own vectorized scan of the rings of cells
+
+        Args:
+            latitudes: numpy array of the targets' latitudes
+            longitudes: numpy array of the targets' longitudes
+            ages: numpy array of the targets' ages
+            k: number of neighbors
+            age_proximity: maximum difference between a candidate neighbor's age and the target
+
+        Returns: (indices, distances) arrays of shape (number of targets, k), sorted in ascending order of distance.
+            Missing neighbors have an index of -1 and an infinite distance
+
+        """
+        start_time = time.perf_counter()
+        indices = np.full((len(latitudes), k), -1, dtype=np.int64)
+        distances = np.full((len(latitudes), k), np.inf)
+        for i, (latitude, longitude, age) in enumerate(zip(latitudes, longitudes, ages)):
+            rows, row_distances, _ = self._search({'latitude': latitude, 'longitude': longitude, 'age': age}, k,
+                                               age_proximity)
+            indices[i, :len(rows)] = rows
+            distances[i, :len(rows)] = row_distances
+        self.metrics.observe_stage('batch_search', time.perf_counter() - start_time)
+        return indices, distances
+
+    def insert_item(self, target_item):
+        """Adds the target_item to the store. The item gets the next id (see CompactNodeStore.get_id), which it keeps
+        when the merges move the rows
+
+        Args:
+            target_item: item representing a person
+
+        Returns: None
+
+        """
+        self._invalidate_results(target_item['latitude'], target_item['longitude'], target_item['age'])
+        store = self.node_store
+        index = store.append(target_item['latitude'], target_item['longitude'], target_item['age'],
+                             target_item['name'])
+        target_item['id'] = str(store.get_id(index))
+        self._index_appended_row(index)
+
+    def insert_items_bulk(self, item_list, build_subtrees=True):
+        """Adds many items to the store at once (see insert_item)
+
+        Args:
+            item_list: list of items
+            build_subtrees: unused, as the grid has no subtrees (kept for compatibility with KDTreeDataStore)
+
+        Returns: None
+
+        """
+        store = self.node_store
+        start = store.extend([item['latitude'] for item in item_list], [item['longitude'] for item in item_list],
+                             [item['age'] for item in item_list], [item['name'] for item in item_list])
+        rows = np.arange(start, store.size)
+        self._invalidate_results(store.latitudes[rows], store.longitudes[rows], store.ages[rows])
+        for item, node_id in zip(item_list, store.get_ids(rows).tolist()):
+            item['id'] = str(node_id)
+
+        self._num_inserted += len(rows)
+        if self._num_inserted > max(self.merge_fraction * store.size, self.points_per_cell):
+            self._build_grid()
+            return
+        for cell, row in zip(self._cells_of(store.latitudes[rows], store.longitudes[rows]).tolist(), rows.tolist()):
+            self._inserted.setdefault(cell, []).append(row)
+
+    def _index_appended_row(self, index):
+        """Adds a row appended to the node store to the list of its cell, and merges the inserted rows into the
+        sorted ones when they are too many
+
+        Args:
+            index: index of the row
+
+        Returns: None
+
+        """
+        store = self.node_store
+        cell = int(self._cells_of(store.latitudes[index], store.longitudes[index]))
+        self._inserted.setdefault(cell, []).append(index)
+        self._num_inserted += 1
+
+        if self._num_inserted > max(self.merge_fraction * store.size, self.points_per_cell):
+            self._build_grid()
+
+    def nbytes(self):
+        """Memory used by the store's arrays
+
+        Returns: number of bytes
+
+        """
+        return self.node_store.nbytes() + self.cell_starts.nbytes
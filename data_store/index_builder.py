@@ -0,0 +1,373 @@
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# segments up to this length are sorted together with one vectorized sort per level, larger ones are split one at a
+# time
+_batch_split_size = 4096
+# trees up to this size are built with plain python, which is faster than the vectorized levels for a few nodes (as in
+# the rebuilds of small subtrees after insertions)
+_small_tree_size = 64
+
+
+def _concatenated_ranges(starts, ends):
+    """Concatenation of np.arange(start, end) for all the given ranges, along with the range number of each
+    position
+
+    Args:
+        starts: range starts
+        ends: range ends (exclusive)
+
+    Returns: positions, range_numbers
+
+    """
+    lengths = ends - starts
+    range_numbers = np.repeat(np.arange(len(starts)), lengths)
+    positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + starts[range_numbers]
+    return positions, range_numbers
+
+
+def _sort_small_segments(perm, values, starts, ends):
+    """Sorts each of the segments perm[start:end] in place by coordinate. The segments are laid out as the rows of a
+    padded 2d array, so that a single row-wise argsort handles all of them. Segments of very different lengths (as
+    in the subtrees of a bulk insertion) are sorted by segment and coordinate instead, without the padding
+
+    Args:
+        perm: permutation array of node indices
+        values: coordinates of all the nodes along the current axis
+        starts: segment starts in perm
+        ends: segment ends in perm
+
+    Returns: None
+
+    """
+    positions, rows = _concatenated_ranges(starts, ends)
+    shape = (len(starts), (ends - starts).max())
+    if shape[0] * shape[1] > 2 * len(positions):
+        perm[positions] = perm[positions][np.lexsort((values[perm[positions]], rows))]
+        return
+    columns = positions - starts[rows]
+
+    # the padding goes to the end of each sorted row
+    padded_values = np.full(shape, np.inf)
+    padded_values[rows, columns] = values[perm[positions]]
+    padded_perm = np.zeros(shape, dtype=perm.dtype)
+    padded_perm[rows, columns] = perm[positions]
+
+    sorted_perm = np.take_along_axis(padded_perm, np.argsort(padded_values, axis=1), axis=1)
+    perm[positions] = sorted_perm[rows, columns]
+
+
+def _split_segment(perm, values, start, end, use_approx_median, median_sample):
+    """Reorders perm[start:end] in place around its (exact or approximate) median along the current axis
+
+    Args:
+        perm: permutation array of node indices
+        values: coordinates of the nodes in perm[start:end] along the current axis
+        start: segment start in perm
+        end: segment end in perm
+        use_approx_median: use the median of a random sample of the segment when it is large enough
+        median_sample: size of the random sample
+
+    Returns: position of the median in perm
+
+    """
+    segment = perm[start:end]
+    if use_approx_median and len(segment) >= median_sample * 5:
+        sample_positions = np.random.randint(0, len(segment), size=median_sample)
+        median_position = sample_positions[np.argsort(values[sample_positions])[median_sample // 2]]
+        key_value = values[median_position]
+
+        left_mask = values <= key_value
+        left_mask[median_position] = False
+        median_index = segment[median_position]
+        left_segment = segment[left_mask]
+        right_segment = segment[values > key_value]
+
+        mid = start + len(left_segment)
+        perm[start:mid] = left_segment
+        perm[mid] = median_index
+        perm[mid + 1:end] = right_segment
+        return mid
+
+    kth = len(segment) // 2
+    perm[start:end] = segment[np.argpartition(values, kth)]
+    return start + kth
+
+
+def _build_levels(coords, left_ids, right_ids, perm, depth, use_approx_median, median_sample, max_levels=None,
+                  pbar=None, segments=None):
+    """Builds the tree one level at a time, until it is complete or max_levels levels have been built
+
+    Args:
+        coords: tuple with one coordinates array per axis
+        left_ids: array receiving the index of the left child of each node
+        right_ids: array receiving the index of the right child of each node
+        perm: permutation of the node indices to build the tree on
+        depth: depth of the root of the built tree
+        use_approx_median: split large segments around the median of a random sample
+        median_sample: size of the random sample for the approximate median
+        max_levels: (optional) maximum number of levels to build
+        pbar: (optional) progress bar object
+        segments: (optional) (starts, ends, parents, is_left) arrays of the segments of perm to build subtrees on, all
+            at the given depth. Defaults to the whole of perm, without parent
+
+    Returns: root index, and the (starts, ends, parents, is_left) arrays of the segments left to build along with their
+        depth
+
+    """
+    num_axes = len(coords)
+
+    if segments is None:
+        segments = (np.array([0]), np.array([len(perm)]), np.array([-1]), np.array([False]))
+    starts, ends, parents, is_left = segments
+    root = -1
+    level = 0
+
+    while len(starts) and (max_levels is None or level < max_levels):
+        values = coords[depth % num_axes]
+        mids = np.empty_like(starts)
+
+        large = ends - starts > _batch_split_size
+        for i in np.flatnonzero(large):
+            mids[i] = _split_segment(perm, values[perm[starts[i]:ends[i]]], starts[i], ends[i], use_approx_median,
+                                     median_sample)
+
+        small = ~large
+        if small.any():
+            _sort_small_segments(perm, values, starts[small], ends[small])
+            mids[small] = (starts[small] + ends[small]) // 2
+
+        nodes = perm[mids]
+        if parents[0] < 0:
+            root = nodes[0]
+        has_parent = parents >= 0
+        left_ids[parents[has_parent & is_left]] = nodes[has_parent & is_left]
+        right_ids[parents[has_parent & ~is_left]] = nodes[has_parent & ~is_left]
+
+        if pbar is not None:
+            pbar.update(len(nodes))
+
+        starts, ends, parents, is_left = (np.concatenate((starts, mids + 1)), np.concatenate((mids, ends)),
+                                          np.concatenate((nodes, nodes)),
+                                          np.concatenate((np.ones(len(nodes), bool), np.zeros(len(nodes), bool))))
+        non_empty = ends > starts
+        starts, ends, parents, is_left = starts[non_empty], ends[non_empty], parents[non_empty], is_left[non_empty]
+        depth += 1
+        level += 1
+
+    return root, (starts, ends, parents, is_left), depth
+
+
+def _build_small_tree(coords, left_ids, right_ids, perm, depth):
+    """Builds a small tree recursively on python lists, splitting at the same positions as _build_levels
+
+    Args:
+        coords: tuple with one coordinates array per axis
+        left_ids: array receiving the index of the left child of each node
+        right_ids: array receiving the index of the right child of each node
+        perm: array of the node indices to build the tree on
+        depth: depth of the root of the built tree
+
+    Returns: root index
+
+    """
+    num_axes = len(coords)
+    points = list(zip(perm.tolist(), *(values[perm].tolist() for values in coords)))
+
+    def build(points, depth):
+        if not points:
+            return -1
+        points.sort(key=lambda point: point[1 + depth % num_axes])
+        mid = len(points) // 2
+        node = points[mid][0]
+        left_ids[node] = build(points[:mid], depth + 1)
+        right_ids[node] = build(points[mid + 1:], depth + 1)
+        return node
+
+    return build(points, depth)
+
+
+def build_kd_tree(coords, left_ids, right_ids, perm=None, depth=0, use_approx_median=True, median_sample=10000,
+                  pbar=None):
+    """Builds the k-d tree over the given coordinates, one level at a time.
+
+    The nodes are never copied: a permutation of their indices is partitioned in place, so that each subtree occupies
+    a contiguous segment of perm whose median becomes the subtree root. The child links are written to left_ids and
+    right_ids (-1 for a missing child).
+
+    Args:
+        coords: tuple with one coordinates array per axis (latitudes, longitudes)
+        left_ids: array receiving the index of the left child of each node
+        right_ids: array receiving the index of the right child of each node
+        perm: (optional) permutation of the node indices to build the tree on. Defaults to all the nodes
+        depth: depth of the root of the built tree, which determines the first splitting axis
+        use_approx_median: split large segments around the median of a random sample, like KDTreeDataStore.get_median
+        median_sample: size of the random sample for the approximate median
+        pbar: (optional) progress bar object
+
+    Returns: root index (-1 for an empty tree)
+
+    """
+    if perm is None:
+        perm = np.arange(len(coords[0]))
+    if len(perm) == 0:
+        return -1
+    if len(perm) <= _small_tree_size:
+        root = _build_small_tree(coords, left_ids, right_ids, perm, depth)
+        if pbar is not None:
+            pbar.update(len(perm))
+        return root
+
+    root, _, _ = _build_levels(coords, left_ids, right_ids, perm, depth, use_approx_median, median_sample, pbar=pbar)
+    return root
+
+
+def build_kd_subtrees(coords, left_ids, right_ids, perm, starts, ends, parents, is_left, depth, use_approx_median=True,
+                      median_sample=10000):
+    """Builds many balanced subtrees at once, one over each segment perm[start:end], with the same level by level
+    splits as build_kd_tree. The root of each subtree becomes the left or right child of its parent
+
+    Args:
+        coords: tuple with one coordinates array per axis (latitudes, longitudes)
+        left_ids: array receiving the index of the left child of each node
+        right_ids: array receiving the index of the right child of each node
+        perm: array of node indices, reordered in place
+        starts: segment starts in perm
+        ends: segment ends in perm
+        parents: index of the parent of each subtree
+        is_left: whether each subtree is the left child of its parent
+        depth: depth of the subtree roots, which determines their splitting axis (only its parity matters with two
+            axes, so the subtrees should all have the same depth modulo the number of axes)
+        use_approx_median: split large segments around the median of a random sample
+        median_sample: size of the random sample for the approximate median
+
+    Returns: None
+
+    """
+    _build_levels(coords, left_ids, right_ids, perm, depth, use_approx_median, median_sample,
+                  segments=(starts, ends, parents, is_left))
+
+
+# shared arrays of the current build, attached once per worker process, and their memory blocks
+_worker_arrays = {}
+_worker_blocks = []
+
+
+def _to_shared_memory(array, shared_blocks):
+    """Copies the array into a new shared memory block
+
+    Args:
+        array: numpy array
+        shared_blocks: list to which the created block is appended (for cleanup)
+
+    Returns: (block name, shape, dtype) descriptor, and the numpy array backed by the block
+
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_blocks.append(block)
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared_array[:] = array
+    return (block.name, array.shape, array.dtype.str), shared_array
+
+
+def _attach_shared_arrays(descriptors):
+    """Pool initializer: maps the shared memory blocks of the build into the worker process
+
+    Args:
+        descriptors: dictionary of array name to (block name, shape, dtype)
+
+    Returns: None
+
+    """
+    _worker_arrays.clear()
+    del _worker_blocks[:]
+    for name, (block_name, shape, dtype) in descriptors.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        # keep a reference to the block so that its buffer stays mapped
+        _worker_blocks.append(block)
+        _worker_arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _build_subtree_task(task):
+    """Pool task: builds the subtree over one segment of the shared permutation array
+
+    Args:
+        task: (start, end, depth, num_axes, use_approx_median, median_sample, seed) tuple
+
+    Returns: (start, root index of the subtree)
+
+    """
+    start, end, depth, num_axes, use_approx_median, median_sample, seed = task
+    np.random.seed(seed)
+    coords = tuple(_worker_arrays['coords_' + str(axis)] for axis in range(num_axes))
+    root, _, _ = _build_levels(coords, _worker_arrays['left_ids'], _worker_arrays['right_ids'],
+                               _worker_arrays['perm'][start:end], depth, use_approx_median, median_sample)
+    return start, root
+
+
+def build_kd_tree_parallel(coords, left_ids, right_ids, num_workers, use_approx_median=True, median_sample=10000,
+                           pbar=None):
+    """Builds the same tree as build_kd_tree using a pool of processes.
+
+    The top levels are built serially until there are a few independent subtrees per worker. The coordinates, the
+    permutation array and the child links are placed in shared memory, so each task only receives the bounds of its
+    segment; the workers write the links of their subtree directly, and the subtree roots are then attached to their
+    parents.
+
+    Args:
+        coords: tuple with one coordinates array per axis (latitudes, longitudes)
+        left_ids: array receiving the index of the left child of each node
+        right_ids: array receiving the index of the right child of each node
+        num_workers: number of worker processes
+        use_approx_median: split large segments around the median of a random sample
+        median_sample: size of the random sample for the approximate median
+        pbar: (optional) progress bar object
+
+    Returns: root index (-1 for an empty tree)
+
+    """
+    if num_workers <= 1 or len(coords[0]) <= _batch_split_size:
+        return build_kd_tree(coords, left_ids, right_ids, use_approx_median=use_approx_median,
+                             median_sample=median_sample, pbar=pbar)
+
+    shared_blocks = []
+    try:
+        descriptors = {}
+        shared = {}
+        arrays = [('coords_' + str(axis), axis_coords) for axis, axis_coords in enumerate(coords)]
+        arrays += [('perm', np.arange(len(coords[0]))), ('left_ids', left_ids), ('right_ids', right_ids)]
+        for name, array in arrays:
+            descriptors[name], shared[name] = _to_shared_memory(np.asarray(array), shared_blocks)
+
+        shared_coords = tuple(shared['coords_' + str(axis)] for axis in range(len(coords)))
+
+        # a few subtrees per worker, so that workers finishing early can take over remaining subtrees
+        serial_levels = int(np.ceil(np.log2(num_workers * 4)))
+        root, (starts, ends, parents, is_left), depth = _build_levels(
+            shared_coords, shared['left_ids'], shared['right_ids'], shared['perm'], 0, use_approx_median,
+            median_sample, max_levels=serial_levels, pbar=pbar)
+
+        segments = {int(start): (int(end), int(parent), bool(left))
+                    for start, end, parent, left in zip(starts, ends, parents, is_left)}
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=len(segments))
+        tasks = [(start, end, depth, len(coords), use_approx_median, median_sample, int(seed))
+                 for (start, (end, _, _)), seed in zip(sorted(segments.items(), key=lambda s: s[0] - s[1][0]),
+                                                       seeds)]
+
+        with multiprocessing.Pool(num_workers, initializer=_attach_shared_arrays, initargs=(descriptors,)) as pool:
+            for start, subtree_root in pool.imap_unordered(_build_subtree_task, tasks):
+                end, parent, left = segments[start]
+                # stitch the subtree to its parent
+                (shared['left_ids'] if left else shared['right_ids'])[parent] = subtree_root
+                if pbar is not None:
+                    pbar.update(end - start)
+
+        left_ids[:] = shared['left_ids']
+        right_ids[:] = shared['right_ids']
+        return root
+    finally:
+        for block in shared_blocks:
+            block.close()
+            block.unlink()
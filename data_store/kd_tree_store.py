@@ -1,7 +1,21 @@
+import heapq
+import itertools
+import math
 import numpy as np
 import numpy.random as random
 from data_store.bounded_priority_queue import BoundedPriorityQueue
-from utilities.geo_utils import haversine_distance
+from data_store.compact_node_store import CompactNodeStore
+from data_store.data_loader import load_compact_store
+from data_store.index_builder import build_kd_tree, build_kd_tree_parallel, build_kd_subtrees
+from data_store.metrics import SearchCounters, StoreMetrics, METRICS_CONTENT_TYPE
+from data_store.node_cache import NodeCache
+from data_store.query_response import check_coordinates, parse_query, encode_recommendation, MAX_K
+from data_store.redis_node_store import RedisNodeStore
+from data_store.result_cache import ResultCache
+from data_store.worker_server import serve_workers
+from data_store.async_server import serve_async
+from utilities.geo_utils import haversine_distance, box_distance, box_distances, box_boundary_distances
+from utilities.distance_kernels import query_terms, haversine_terms, terms_to_distances, distance_to_term
 import argparse
 from profilehooks import timecall
 from tqdm import tqdm
@@ -12,7 +26,6 @@ import os.path
 from utilities import file_utils
 import redis
 import multiprocessing
-from multiprocessing import Process, Queue
 import sys
 from scipy import stats
 import os.path
@@ -26,10 +39,35 @@ class KDTreeDataStore():
     _num_axes = len(_axis_keys)
 
     use_approx_median = True
+    # build the index by partitioning arrays of node indices level by level instead of recursively splitting lists
+    use_vectorized_build = True
+    # batch queries: size of the subtrees scored at once, and number of entries of the distance matrices
+    _batch_subtree_size = 512
+    _batch_matrix_size = 2 ** 22
+    # bounding box (lat_min, lat_max, lon_min, lon_max) of the whole tree
+    _root_box = (-float('inf'), float('inf'), -180.0, 180.0)
+    # number of nodes fetched from redis in one round trip by the k nearest neighbors search
+    redis_batch_size = 16
+    # redis set listing the names of the indices stored in redis
+    _redis_indices_key = 'kd_tree_indices'
+    # bulk load of the index into redis: number of nodes per write command, and number of concurrent connections
+    redis_write_chunk_size = 10000
+    redis_write_connections = 4
+    # balance of the subtrees kept by the insertions: a subtree is rebuilt when one of its children holds more than
+    # this fraction of its nodes
+    rebalance_alpha = 0.7
+    # fraction of tombstones (deleted or moved people) among the nodes beyond which the index is compacted
+    compaction_fraction = 0.25
+    # in compact mode with leaf buckets, a bulk insertion of more than this fraction of the nodes lays the rows out
+    # again, rather than leaving the new rows outside of the buckets
+    bulk_relayout_fraction = 0.1
 
     def __init__(self, rebuild_index=False, redis_mode=True, data_from_file=True, data_list=None,
                  data_in_parallel=False,
-                 size=100):
+                 size=100, compact_mode=False, coord_dtype=np.float64, build_workers=1, age_index=False,
+                 use_snapshot=False, node_cache_size=10000, pinned_levels=10, redis_index=None, bucket_size=0,
+                 max_visits=None, time_budget=None, max_radius=None, max_age_widening=0, rebalance=True,
+                 result_cache_bytes=0, result_cache_grid=0.01, result_cache_ttl=60.0, redis_client=None):
         """Initializes the store, reads the data, and construct the index
 
         Args:
@@ -37,35 +75,51 @@ class KDTreeDataStore():
             redis_mode: use redis backend
             data_from_file: when True, data is loaded from files; otherwise, data_list should give the list of data
             data_list: list of items to build the index from
-            data_in_parallel: use multiprocessing to load data
+            data_in_parallel: load the three data files concurrently
             size:
+            compact_mode: keep the nodes in typed numpy arrays (CompactNodeStore) instead of one dictionary per node.
+                Only available for the in-memory store
+            coord_dtype: numpy dtype of the coordinates in compact mode (np.float32 halves their memory)
+            build_workers: number of processes used to construct the index (with the vectorized build)
+            age_index: keep the minimum and maximum age of each subtree, so that the k nearest neighbors search skips
+                subtrees without anybody in the age range
+            use_snapshot: in compact mode with data from files, save the built index to a binary snapshot
+                (data_filename, next to the generated data files) and, on the next start, memory-map it instead of
+                reading the files and rebuilding
+            node_cache_size: in redis mode, number of recently read nodes kept in memory (0 to disable)
+            pinned_levels: in redis mode, number of top levels of the tree that are kept in memory at all times
+            redis_index: name under which the index is stored in redis (defaults to one index per data size)
+            bucket_size: in compact mode, store the subtrees contiguously and let the k nearest neighbors search treat
+                the subtrees of at most bucket_size nodes (typically 32 to 256) as leaf buckets, scored at once with
+                vectorized operations (0 to disable)
+            max_visits: (optional) default maximum number of nodes visited by a k nearest neighbors search, after which
+                it returns the best neighbors found so far
+            time_budget: (optional) default maximum duration of a k nearest neighbors search, in seconds
+            max_radius: (optional) default maximum distance of the neighbors returned by recommend, in kilometers
+            max_age_widening: default number of years by which recommend can widen the age window when it finds too
+                few neighbors
+            rebalance: rebuild the subtrees that insertions made too unbalanced (see rebalance_alpha), so that the
+                depth of the tree stays logarithmic
+            result_cache_bytes: memory of the cache of k nearest neighbors results, which answers the queries repeated
+                from the same place (see ResultCache). 0 disables the cache
+            result_cache_grid: size of the cells the cached queries are quantized to, in degrees
+            result_cache_ttl: number of seconds after which a cached result expires
+            redis_client: (optional) redis client to use in redis mode, without decode_responses. Defaults to a
+                connection to the local redis server
         """
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-
-        self.generated_data_location = os.path.abspath(
-            os.path.join(dir_path, os.pardir, './data_generation/generated_data/'))
-
-        self.data_filename = '../data_generation/data_store_' + str(size) + '.p'
-
-        if redis_mode:
-            try:
-                redis.Redis(host="localhost").ping()
-            except:
-                raise AssertionError('problem connecting to redis: make sure redis is up and running')
-
-            try:
-                self.r_server = redis.StrictRedis(host="localhost", charset="utf-8", decode_responses=True)
-            except:
-                raise AssertionError('problem connecting to redis: make sure redis is up and running')
-
-        if (data_from_file and not redis_mode) or rebuild_index:
-
-            self.ages_file = os.path.join(self.generated_data_location, 'ages_' + str(size) + '.txt')
-            self.names_file = os.path.join(self.generated_data_location,
-                                           'names_' + str(size) + '.txt')
-            self.coords_file = os.path.join(self.generated_data_location,
-                                            'coords_' + str(size) + '.txt')
+        self._configure(redis_mode=redis_mode, data_from_file=data_from_file, data_list=data_list, size=size,
+                        compact_mode=compact_mode, coord_dtype=coord_dtype, build_workers=build_workers,
+                        age_index=age_index, use_snapshot=use_snapshot, node_cache_size=node_cache_size,
+                        pinned_levels=pinned_levels, redis_index=redis_index, bucket_size=bucket_size,
+                        max_visits=max_visits, time_budget=time_budget, max_radius=max_radius,
+                        max_age_widening=max_age_widening, rebalance=rebalance, result_cache_bytes=result_cache_bytes,
+                        result_cache_grid=result_cache_grid, result_cache_ttl=result_cache_ttl,
+                        redis_client=redis_client)
+
+        if self.use_snapshot and not rebuild_index and self._load_fresh_snapshot():
+            return
 
+        if data_from_file and (rebuild_index or not redis_mode):
             all_files_exist = file_utils.all_files_exist(self.ages_file, self.names_file, self.coords_file)
             if not all_files_exist:
                 raise AssertionError(
@@ -73,21 +127,166 @@ class KDTreeDataStore():
                         size))
 
             self.load_data_from_file(data_in_parallel=data_in_parallel)
-        else:
-            self.data_list = data_list
 
+        if rebuild_index or not self.redis_mode:
+            self.construct_index(item_list=self.data_list)
+
+        if self.use_snapshot:
+            self.save_snapshot()
+
+        if self.redis_mode:
+            self.warm_node_cache()
+
+    def _configure(self, redis_mode, data_from_file, data_list, size, compact_mode, coord_dtype, build_workers,
+                   age_index, use_snapshot, node_cache_size, pinned_levels, redis_index, bucket_size, max_visits,
+                   time_budget, max_radius, max_age_widening, rebalance, result_cache_bytes, result_cache_grid,
+                   result_cache_ttl, redis_client=None):
+        """Sets the attributes of the store (data files, backend, search defaults, caches) without loading any data.
+        Shared with the other engines (see GridDataStore), so that the inherited methods find every attribute. See
+        __init__ for the arguments
+
+        Returns: None
+
+        """
+        if compact_mode and redis_mode:
+            raise AssertionError('compact mode is only available for the in-memory store (without redis_mode)')
+
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+
+        self.generated_data_location = os.path.abspath(
+            os.path.join(dir_path, os.pardir, './data_generation/generated_data/'))
+
+        self.data_filename = os.path.join(self.generated_data_location, 'data_store_' + str(size) + '.snapshot')
+
+        if redis_mode:
+            if redis_client is None:
+                try:
+                    redis.Redis(host="localhost").ping()
+                except:
+                    raise AssertionError('problem connecting to redis: make sure redis is up and running')
+
+                try:
+                    redis_client = redis.StrictRedis(host="localhost")
+                except:
+                    raise AssertionError('problem connecting to redis: make sure redis is up and running')
+            self.r_server = redis_client
+            self.redis_nodes = RedisNodeStore(self.r_server)
+            # the index lives under the keys <redis_index>:v<version>:, and <redis_index>:root points to the version
+            # being served
+            self.redis_index = redis_index or 'kd_tree_' + str(size)
+            self.redis_version = None
+            # <redis_index>:epoch is bumped after every write to the nodes, and the node cache is dropped when it
+            # moved on since it was last read (see _get_redis_root_id)
+            self._redis_epoch = None
+
+        self.ages_file = os.path.join(self.generated_data_location, 'ages_' + str(size) + '.txt')
+        self.names_file = os.path.join(self.generated_data_location,
+                                       'names_' + str(size) + '.txt')
+        self.coords_file = os.path.join(self.generated_data_location,
+                                        'coords_' + str(size) + '.txt')
+
+        self.data_list = data_list
         # key value store to store objects in by id. This is used to allow easy switching to redis
         self.kv_store = {}
         self.redis_mode = redis_mode
+        # columnar node storage, used instead of kv_store in compact mode
+        self.compact_mode = compact_mode
+        self.coord_dtype = coord_dtype
+        self.node_store = None
+        self.build_workers = build_workers
+        self.age_index = age_index
+        self.bucket_size = bucket_size if compact_mode else 0
+        self.max_visits = max_visits
+        self.time_budget = time_budget
+        self.max_radius = max_radius
+        self.max_age_widening = max_age_widening
+        self.rebalance = rebalance
+        self.use_snapshot = use_snapshot and compact_mode and data_from_file
+        # cache of the nodes read from redis
+        self.node_cache = NodeCache(node_cache_size) if redis_mode else None
+        # latency histograms and query counters, served at /metrics
+        self.metrics = StoreMetrics()
+        # cache of the k nearest neighbors results
+        self.result_cache = ResultCache(result_cache_bytes, result_cache_grid, result_cache_ttl) \
+            if result_cache_bytes else None
+        self.pinned_levels = pinned_levels
         # flag that is triggered in during index construction. This is used with redis to not heavily use redis when
         # constructing the index. Instead the values are stored in memory and batch-saved at the end.
         self._construction_phase = False
 
-        if rebuild_index or not self.redis_mode:
-            self.construct_index(item_list=self.data_list)
+    def save_snapshot(self, filename=None):
+        """Saves the compact index to a binary snapshot file (see CompactNodeStore.save)
+
+        Args:
+            filename: (optional) path of the snapshot file. Defaults to data_filename
+
+        Returns: None
+
+        """
+        if not self.compact_mode:
+            raise AssertionError('snapshots are only available in compact mode')
+        filename = filename or self.data_filename
+        self.node_store.save(filename)
+        print('saved index snapshot to ' + filename)
+
+    def load_snapshot(self, filename=None, mmap_mode='r'):
+        """Replaces the compact index with the one saved in a snapshot file, which is memory-mapped rather than read
+
+        Args:
+            filename: (optional) path of the snapshot file. Defaults to data_filename
+            mmap_mode: 'r' (shared, read-only pages), 'c' (copy-on-write) or None (read into memory)
+
+        Returns: None
+
+        """
+        if not self.compact_mode:
+            raise AssertionError('snapshots are only available in compact mode')
+        filename = filename or self.data_filename
+        node_store = CompactNodeStore.load(filename, mmap_mode=mmap_mode)
+        if self.bucket_size and node_store.subtree_sizes is None:
+            # the people keep the ids of the snapshot's rows
+            node_store.assign_ids()
+            node_store.reorder_inorder()
+        if self.age_index and node_store.subtree_age_min is None:
+            node_store.build_age_index()
+        self.node_store = node_store
+        self.coord_dtype = node_store.coord_dtype
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+    def _load_fresh_snapshot(self):
+        """Loads the snapshot at data_filename if it is newer than the data files and was saved with the requested
+        coordinates type
+
+        Returns: True if the snapshot was loaded
+
+        """
+        if not os.path.isfile(self.data_filename):
+            return False
+        snapshot_time = os.path.getmtime(self.data_filename)
+        if any(os.path.isfile(filename) and os.path.getmtime(filename) > snapshot_time
+               for filename in (self.ages_file, self.names_file, self.coords_file)):
+            print('the data files changed since the last snapshot: rebuilding the index')
+            return False
+
+        requested_dtype = np.dtype(self.coord_dtype)
+        try:
+            self.load_snapshot()
+        except ValueError as e:
+            print('could not load the index snapshot ({}): rebuilding the index'.format(e))
+            return False
+        if self.node_store.coord_dtype != requested_dtype:
+            print('the index snapshot has different coordinates type: rebuilding the index')
+            self.node_store = None
+            self.coord_dtype = requested_dtype
+            return False
+
+        print('loaded index snapshot from ' + self.data_filename)
+        return True
 
     def load_ages(self, filename):
-        """Loads the ages data samples
+        """Loads the ages data samples. Deprecated: load_data_from_file streams the three files with
+        data_loader.load_compact_store, which should be used instead
 
         Args:
             filename: age samples' filename
@@ -95,13 +294,10 @@ class KDTreeDataStore():
         Returns: ages' numpy array
 
         """
-        print('loading ages data')
-        result = np.genfromtxt(filename, dtype=int)
-        print('finished loading ages data')
-        return result
+        return np.loadtxt(filename, dtype=int, ndmin=1)
 
     def load_names(self, filename):
-        """Loads the names data samples
+        """Loads the names data samples. Deprecated (see load_ages)
 
         Args:
             filename: names' samples filename
@@ -109,13 +305,11 @@ class KDTreeDataStore():
         Returns: names numpy array
 
         """
-        print('loading names data')
-        result = np.genfromtxt(filename, dtype=str)
-        print('finished loading names data')
-        return result
+        with open(filename, encoding='utf-8') as names_file:
+            return np.array(names_file.read().splitlines())
 
     def load_coords(self, filename):
-        """Loads the coordinates' samples
+        """Loads the coordinates' samples. Deprecated (see load_ages)
 
         Args:
             filename: coordinates samples' filename
@@ -123,87 +317,37 @@ class KDTreeDataStore():
         Returns: coordinates numpy array
 
         """
-        print('loading coords data')
-        result = np.genfromtxt(filename, delimiter=',')
-        print('finished loading coords data')
-        return result
+        return np.loadtxt(filename, delimiter=',', ndmin=2)
 
     # @timecall
     def load_data_from_file(self, data_in_parallel=False):
-        """Loads the ages, names, and coordinates data into self.data_list
+        """Loads the ages, names, and coordinates data files with the streaming loader (see
+        data_loader.load_compact_store). In compact mode, the loaded arrays become self.node_store directly; otherwise
+        they are formatted into self.data_list
 
         Args:
-            data_in_parallel: when True, data is loaded in parallel, using multiprocessing
+            data_in_parallel: when True, the three files are loaded concurrently
 
         Returns: None
 
         """
+        store = load_compact_store(self.ages_file, self.names_file, self.coords_file,
+                                   coord_dtype=self.coord_dtype if self.compact_mode else np.float64,
+                                   data_in_parallel=data_in_parallel, compact_ages=self.compact_mode)
+        if self.compact_mode:
+            self.node_store = store
+            self.data_list = None
+            return
 
-        start_time = time.clock()
-
-        if data_in_parallel:
-            print('loading data from files with multiprocessing')
-
-            nprocs = 3
-
-            def worker(type, filename, out_q):
-                """ The worker function, invoked in a process. 'nums' is a
-                    list of numbers to factor. The results are placed in
-                    a dictionary that's pushed to a queue.
-                """
-                result = {'type': type, 'data': None}
-                if type == 'ages':
-                    result['data'] = self.load_ages(filename)
-                elif type == 'names':
-                    result['data'] = self.load_names(filename)
-                elif type == 'coords':
-                    result['data'] = self.load_coords(filename)
-
-                out_q.put(result)
-
-            # Each process will get a queue to put its result into
-            out_q = Queue()
-            procs = []
-
-            for item in [('ages', self.ages_file), ('names', self.names_file), ('coords', self.coords_file)]:
-                p = multiprocessing.Process(
-                    target=worker,
-                    args=(item[0], item[1],
-                          out_q))
-                procs.append(p)
-                p.start()
-
-            # Collect all results into a single result dict. We know how many dicts
-            # with results to expect.
-            result = {}
-            for i in range(nprocs):
-                partial = out_q.get()
-                result[partial['type']] = partial['data']
-
-            # Wait for all worker processes to finish
-            for p in procs:
-                p.join()
-
-
-
-        else:
-            print('loading data in series')
-            result = {'ages': None, 'names': None, 'coords': None}
-
-            result['ages'] = self.load_ages(self.ages_file)
-            result['names'] = self.load_names(self.names_file)
-            result['coords'] = self.load_coords(self.coords_file)
-
-        print('finished loading data from files to memory in: ', time.clock() - start_time, ' seconds')
-
-        start_time = time.clock()
+        start_time = time.time()
         print('now formatting the data')
 
         self.data_list = [
-            {'id': str(i), 'age': int(k[0]), 'name': k[1], 'latitude': float(k[2][0]), 'longitude': float(k[2][1])} for
-            i, k in enumerate(zip(result['ages'], result['names'], result['coords']))]
+            {'id': str(i), 'age': age, 'name': store.get_name(i), 'latitude': latitude, 'longitude': longitude} for
+            i, (age, latitude, longitude) in enumerate(zip(store.ages.tolist(), store.latitudes.tolist(),
+                                                           store.longitudes.tolist()))]
 
-        print('finished formatting the loaded data in: ', time.clock() - start_time, ' seconds')
+        print('finished formatting the loaded data in: ', time.time() - start_time, ' seconds')
 
     time_success = 0
     time_total = 0
@@ -278,9 +422,9 @@ class KDTreeDataStore():
         # self.load_data_from_file()
         time_list = []
         for i in tqdm(range(num_loops)):
-            start_time = time.clock()
+            start_time = time.perf_counter()
             self.get_median(self.data_list, i % 2)
-            end_time = time.clock()
+            end_time = time.perf_counter()
             time_list.append(end_time - start_time)
         average_time = np.average(time_list)
         print('\naverage time\n', average_time)
@@ -312,7 +456,9 @@ class KDTreeDataStore():
 
         """
         if self.redis_mode and not self._construction_phase:
-            self.r_server.hmset(key, value)
+            self.redis_nodes.set_node(value)
+            # cache a copy, as the caller keeps the dictionary
+            self.node_cache.put(dict(value))
         else:
             self.kv_store[key] = value
 
@@ -326,7 +472,7 @@ class KDTreeDataStore():
 
         """
         if self.redis_mode and not self._construction_phase:
-            return self.r_server.hgetall(key)
+            return self._get_redis_nodes([key])[0]
         else:
             return self.kv_store[key]
 
@@ -340,48 +486,49 @@ class KDTreeDataStore():
 
         """
         if self.redis_mode and not self._construction_phase:
-            return self.r_server.get(key)
+            value = self.r_server.get(key)
+            return value.decode('utf-8') if value is not None else None
         else:
             return self.kv_store.get(key, None)
 
-    def mem_incr(self, key):
-        """Increment the value at key by 1 in memory or in redis
+    def mem_incr(self, key, amount=1):
+        """Increment the value at key in memory or in redis (a missing value counts as 0)
 
         Args:
             key:
+            amount: increment
 
-        Returns:
+        Returns: incremented value
 
         """
         if self.redis_mode and not self._construction_phase:
-            self.r_server.incr(key)
-        else:
-            self.kv_store[key] = str(int(self.kv_store[key]) + 1)
+            return self.r_server.incr(key, amount)
+        value = int(self.kv_store.get(key) or 0) + amount
+        self.kv_store[key] = str(value)
+        return value
 
     def mem_switch_to_redis(self):
-        """Copies the context from memory to redis. This is triggered at the end of in-memory index construction
+        """Copies the context from memory to redis. This is triggered at the end of in-memory index construction. The
+        nodes are bulk-loaded as packed records (see RedisNodeStore.set_nodes_bulk) under a new version of the index,
+        while the current version is still served, and the root pointer is switched to the new version at the end
 
         Returns: None
 
         """
-        p = self.r_server.pipeline()
-        NUM_ENTRIES = len(self.kv_store)
-        i = 0
-        with tqdm(total=NUM_ENTRIES) as pbar:
-            for key in list(self.kv_store):
-                item = self.kv_store.pop(key)
-                if type(item) is dict:
-                    p.hmset(item['id'], item)
-                elif type(item) is str:
-                    p.set(key, item)
+        version = self._new_redis_version()
+        self._use_redis_version(version)
 
-                pbar.update(1)
-                i += 1
+        nodes = [item for item in self.kv_store.values() if type(item) is dict]
+        with tqdm(total=len(nodes)) as pbar:
+            self.redis_nodes.set_nodes_bulk(nodes, chunk_size=self.redis_write_chunk_size,
+                                            num_connections=self.redis_write_connections, pbar=pbar)
 
-                if i % (100000) == 0:
-                    p.execute()
-                    p = self.r_server.pipeline()
-            p.execute()
+        self.r_server.set(self._redis_key('v' + str(version), 'num_nodes'), len(nodes))
+        # switch the readers to the new version, then drop the older ones. The previous version is kept for the
+        # processes that are still in the middle of a query on it
+        self._set_redis_root(version, self.kv_store.get('root_id'))
+        self.kv_store.clear()
+        self._drop_redis_versions(version - 1)
 
     # @timecall
     def construct_index(self, item_list=None):
@@ -395,14 +542,24 @@ class KDTreeDataStore():
         """
 
         print('started building index from scratch')
-        if self.redis_mode:
-            self.r_server.flushdb()
+        if item_list is not None and self.result_cache is not None:
+            self.result_cache.clear()
+        if self.compact_mode:
+            self.construct_compact_index(item_list)
+            return
+
         self._construction_phase = True
 
         with tqdm(total=len(item_list)) as pbar:
-            root_id = self._construct_index(item_list, depth=0, pbar=pbar)
+            if self.use_vectorized_build:
+                root_id = self._construct_index_from_arrays(item_list, pbar=pbar)
+            else:
+                root_id = self._construct_index(item_list, depth=0, pbar=pbar)
 
-        self.mem_set('root_id', root_id)
+        self.set_root_id(root_id)
+        self.mem_set('num_nodes', str(len(item_list)))
+        if self.age_index and root_id is not None:
+            self._build_age_index(root_id)
 
         self._construction_phase = False
 
@@ -427,7 +584,6 @@ class KDTreeDataStore():
             return None
 
         axis = depth % self._num_axes
-        start = time.clock()
 
         # get the median of the item list as a pivot element
         left_item_set, right_item_set, median_item = self.get_median(item_list, axis)
@@ -443,6 +599,241 @@ class KDTreeDataStore():
 
         return median_item['id']
 
+    def _construct_index_from_arrays(self, item_list, pbar=None):
+        """Builds the index with the array-based builder (see index_builder.build_kd_tree) and stores the resulting
+        nodes as dictionaries. It produces the same tree as _construct_index without copying the item lists at each
+        level
+
+        Args:
+            item_list: list of items representing people
+            pbar: progress bar object
+
+        Returns: id of the root item
+
+        """
+        coords = tuple(np.array([item[key] for item in item_list], dtype=np.float64) for key in self._axis_keys)
+        left_ids = np.full(len(item_list), -1, dtype=np.int64)
+        right_ids = np.full(len(item_list), -1, dtype=np.int64)
+
+        root = build_kd_tree_parallel(coords, left_ids, right_ids, self.build_workers,
+                                      use_approx_median=self.use_approx_median, median_sample=self._median_sample,
+                                      pbar=pbar)
+        if root < 0:
+            return None
+
+        for item, left, right in zip(item_list, left_ids.tolist(), right_ids.tolist()):
+            self.add_node_properties(item, left_id=item_list[left]['id'] if left >= 0 else None,
+                                     right_id=item_list[right]['id'] if right >= 0 else None)
+        return item_list[root]['id']
+
+    def _build_age_index(self, root_id):
+        """Stores in each node the minimum and maximum age of its subtree (age_min and age_max). Used at the end of the
+        construction phase, while the nodes are still in memory
+
+        Args:
+            root_id: id of the root item
+
+        Returns: None
+
+        """
+        stack = [(root_id, False)]
+        while stack:
+            node_id, children_done = stack.pop()
+            node = self.kv_store[node_id]
+            child_ids = [child_id for child_id in (node['left_id'], node['right_id']) if child_id]
+
+            if children_done:
+                children = [self.kv_store[child_id] for child_id in child_ids]
+                node['age_min'] = min([node['age']] + [child['age_min'] for child in children])
+                node['age_max'] = max([node['age']] + [child['age_max'] for child in children])
+            else:
+                stack.append((node_id, True))
+                stack.extend((child_id, False) for child_id in child_ids)
+
+    def construct_compact_index(self, item_list):
+        """Builds the index in the columnar layout of CompactNodeStore
+
+        Args:
+            item_list: list of items representing people. When None, the index is built over the records already
+                loaded in self.node_store (see load_data_from_file)
+
+        Returns: None
+
+        """
+        if item_list is not None:
+            self.node_store = CompactNodeStore.from_items(item_list, coord_dtype=self.coord_dtype)
+        store = self.node_store
+
+        with tqdm(total=store.size) as pbar:
+            store.root = build_kd_tree_parallel((store.latitudes, store.longitudes), store.left_ids,
+                                                store.right_ids, self.build_workers,
+                                                use_approx_median=self.use_approx_median,
+                                                median_sample=self._median_sample, pbar=pbar)
+        if self.bucket_size:
+            # the people keep the ids of their rows in the data
+            store.assign_ids()
+            store.reorder_inorder()
+        if self.age_index:
+            store.build_age_index()
+
+    def get_root_id(self):
+        """Gets the id of the index root
+
+        Returns: root id string, or None when the index is empty
+
+        """
+        if self.compact_mode:
+            if self.node_store is None or self.node_store.root < 0:
+                return None
+            return str(self.node_store.get_id(self.node_store.root))
+        if self.redis_mode and not self._construction_phase:
+            return self._get_redis_root_id()
+        return self.mem_get('root_id')
+
+    def set_root_id(self, root_id):
+        """Sets the id of the index root
+
+        Args:
+            root_id: root id string, or None for an empty index
+
+        Returns: None
+
+        """
+        if self.redis_mode and not self._construction_phase:
+            self._set_redis_root(self.redis_version, root_id)
+        else:
+            self.mem_set('root_id', root_id)
+
+    def _redis_key(self, *parts):
+        return ':'.join([self.redis_index] + [str(part) for part in parts])
+
+    def _get_redis_root_id(self):
+        """Reads the root pointer of the index in redis, which gives the version being served and its root id, along
+        with the write epoch of the index, in one round trip. When another process has switched the index to a new
+        version, the nodes are read from that version from then on. When another process has written nodes since the
+        last read, the node cache is dropped and its top levels are pinned again
+
+        Returns: root id string, or None when the index is empty or missing
+
+        """
+        pointer, epoch = self.r_server.mget([self._redis_key('root'), self._redis_key('epoch')])
+        self.redis_nodes.round_trips += 1
+        if pointer is None:
+            return None
+        version, root_id = pointer.decode('utf-8').split(':', 1)
+        root_id = root_id or None
+        if int(version) != self.redis_version:
+            self._use_redis_version(int(version))
+        epoch = int(epoch or 0)
+        if epoch != self._redis_epoch:
+            self.node_cache.invalidate()
+            self._pin_top_levels(root_id)
+            self._redis_epoch = epoch
+        return root_id
+
+    def _publish_redis_writes(self):
+        """Bumps the write epoch of the index, once the nodes of a change are written to redis, so that the other
+        processes serving the index drop their node caches on their next query
+
+        Returns: None
+
+        """
+        if not self.redis_mode or self._construction_phase:
+            return
+        epoch = self.r_server.incr(self._redis_key('epoch'))
+        self.redis_nodes.round_trips += 1
+        if self._redis_epoch is None or epoch != self._redis_epoch + 1:
+            # another process wrote in between, and the cache can hold stale copies of its nodes
+            self.node_cache.invalidate()
+            self._redis_epoch = None
+        else:
+            self._redis_epoch = epoch
+
+    def _set_redis_root(self, version, root_id):
+        """Points the index to the given version and root. A single key is written, so that readers switch at once
+
+        Args:
+            version: version of the index
+            root_id: root id string, or None for an empty index
+
+        Returns: None
+
+        """
+        self.r_server.set(self._redis_key('root'), '{}:{}'.format(version, root_id or ''))
+
+    def _use_redis_version(self, version):
+        """Reads and writes the nodes of the given version of the index from now on
+
+        Args:
+            version: version of the index
+
+        Returns: None
+
+        """
+        self.redis_version = version
+        self.redis_nodes.key_prefix = self._redis_key('v' + str(version), 'node:')
+        self.node_cache.invalidate()
+        # the top levels of the version are pinned on the next read of the root pointer
+        self._redis_epoch = None
+
+    def _new_redis_version(self):
+        """Allocates a new version of the index, under which a rebuilt index is written while the current version is
+        still served
+
+        Returns: version number
+
+        """
+        version = self.r_server.incr(self._redis_key('next_version'))
+        self.r_server.sadd(self._redis_key('versions'), version)
+        self.r_server.sadd(self._redis_indices_key, self.redis_index)
+        return version
+
+    def _drop_redis_versions(self, keep_from):
+        """Deletes the keys of the versions of the index older than keep_from
+
+        Args:
+            keep_from: oldest version to keep
+
+        Returns: None
+
+        """
+        for version in self.r_server.smembers(self._redis_key('versions')):
+            if int(version) >= keep_from:
+                continue
+            keys = []
+            for key in self.r_server.scan_iter(match=self._redis_key('v' + version.decode('utf-8'), '*'),
+                                               count=10000):
+                keys.append(key)
+                if len(keys) >= 10000:
+                    self.r_server.delete(*keys)
+                    keys = []
+            if keys:
+                self.r_server.delete(*keys)
+            self.r_server.srem(self._redis_key('versions'), version)
+
+    def list_redis_indices(self):
+        """Lists the indices stored in redis
+
+        Returns: sorted list of index names
+
+        """
+        return sorted(name.decode('utf-8') for name in self.r_server.smembers(self._redis_indices_key))
+
+    def select_redis_index(self, redis_index):
+        """Serves another index stored in redis
+
+        Args:
+            redis_index: name of the index
+
+        Returns: None
+
+        """
+        if not self.r_server.exists(redis_index + ':root'):
+            raise AssertionError('there is no index named ' + redis_index + ' in redis')
+        self.redis_index = redis_index
+        self.redis_version = None
+        self.warm_node_cache()
+
     @classmethod
     def get_coords(self, item):
         """get the (latitude,longitude) of an item
@@ -470,7 +861,7 @@ class KDTreeDataStore():
         self.hmem_set(item['id'], item)
 
     def update_item_key(self, item, key, value):
-        """Updates the value of the given key for the given item in redis
+        """Updates the value of the given key for the given item in memory or redis
 
         Args:
             item:
@@ -480,7 +871,13 @@ class KDTreeDataStore():
         Returns:
 
         """
-        self.r_server.hset(item['id'], key, value)
+        if self.redis_mode:
+            item[key] = value
+            self.redis_nodes.set_node(item)
+            # keep the cached node in sync, for instance with the new child links of insert_item
+            self.node_cache.put(item)
+        else:
+            self.kv_store[item['id']][key] = value
 
     # @timecall
     def distance(self, item, other_item, axis=None):
@@ -498,212 +895,1629 @@ class KDTreeDataStore():
         if axis:
             key = self._axis_keys[axis]
 
-            other_latitude = float(item['latitude']) if key == 'latitude' else float(other_item['latitude'])
-            other_longitude = float(item['longitude']) if key == 'longitude' else float(other_item['longitude'])
+            other_latitude = item['latitude'] if key == 'latitude' else other_item['latitude']
+            other_longitude = item['longitude'] if key == 'longitude' else other_item['longitude']
 
-            return haversine_distance(float(item['latitude']), float(item['longitude']), other_latitude,
-                                      other_longitude)
+            return haversine_distance(item['latitude'], item['longitude'], other_latitude, other_longitude)
         else:
-            return haversine_distance(float(item['latitude']), float(item['longitude']), float(other_item['latitude']),
-                                      float(other_item['longitude']))
+            # the nodes hold typed coordinates (including the ones read from redis), so no conversion is needed
+            return haversine_distance(item['latitude'], item['longitude'], other_item['latitude'],
+                                      other_item['longitude'])
 
     # @timecall
-    def k_nearest_neighbors(self, target_item, k, age_proximity):
-        """Compute the k nearest neighbors to the target_item given the age_proximity
+    def k_nearest_neighbors(self, target_item, k, age_proximity, max_visits=None, time_budget=None,
+                            return_exact=False, max_radius=None):
+        """Compute the k nearest neighbors to the target_item given the age_proximity. With a budget, the search stops
+        once it is exhausted and returns the best neighbors found so far
 
         Args:
             target_item: user node
             k: number of neighbors
             age_proximity: maximum difference between a candidate neighbor's age and the user
+            max_visits: (optional) maximum number of nodes visited. Defaults to self.max_visits
+            time_budget: (optional) maximum duration of the search, in seconds. Defaults to self.time_budget
+            return_exact: also return whether the search was exact
+            max_radius: (optional) only consider the people closer than this distance, in kilometers. The search then
+                skips all the subtrees farther away, even when it found fewer than k neighbors
 
-        Returns: list of neighbors, sorted in ascending order of distance to the target_user
+        Returns: list of neighbors, sorted in ascending order of distance to the target_user. With return_exact,
+            (list of neighbors, exact), where exact is False when the budget stopped the search while closer neighbors
+            could remain
 
         """
-        if not self.mem_get('root_id'):
+        start_time = time.perf_counter()
+        cached = self._get_cached_result(target_item, k, age_proximity, max_radius, max_visits)
+        if cached is not None:
+            self.metrics.observe_stage('cache_hit', time.perf_counter() - start_time)
+            return cached if return_exact else cached[0]
+
+        round_trips = self.redis_nodes.round_trips if self.redis_mode else 0
+        budget = self._search_budget(max_visits, time_budget)
+        root_id = self.get_root_id()
+        if not root_id:
             raise ValueError(
                 'The index has not been created yet. Create before running the k_nearest_neighbors function')
         # create a bounded priority queue
-        bp_queue = BoundedPriorityQueue(k)
-        # call the recursive helper function
-        self._k_nearest_neighbors(self.mem_get('root_id'), target_item, k, bp_queue, 0, age_proximity)
-        # convert the queue to a list and sort it
-        result = bp_queue.get_as_list(with_dist=True)
+        bp_queue = BoundedPriorityQueue(k, max_priority=float('inf') if max_radius is None else max_radius)
+        counters = SearchCounters()
+        # call the helper function
+        if self.compact_mode:
+            exact = self._k_nearest_neighbors_compact(self.node_store.root, target_item, bp_queue, age_proximity,
+                                                      bucket_size=self.bucket_size, budget=budget, counters=counters)
+            result = bp_queue.get_as_list(with_dist=True, item_getter=self.node_store.get_node)
+        else:
+            exact = self._k_nearest_neighbors(root_id, target_item, bp_queue, age_proximity, budget=budget,
+                                              counters=counters)
+            # convert the queue to a list and sort it
+            result = bp_queue.get_as_list(with_dist=True)
         result.sort(key=lambda l: l['distance'])
+        self.metrics.observe_stage('search', time.perf_counter() - start_time)
+        self.metrics.observe_query(counters.visited, counters.pruned, bp_queue.num_pushes,
+                                   self.redis_nodes.round_trips - round_trips if self.redis_mode else 0)
+        if self.result_cache is not None:
+            self.result_cache.put(target_item, k, age_proximity, result, exact, max_radius=max_radius,
+                                  max_visits=max_visits)
+        if return_exact:
+            return result, exact
         return result
 
-    def _k_nearest_neighbors(self, current_node_id, target_item, k, bp_queue, axis, age_proximity):
-        """Recursive helper function for the k_nearest neighbor
+    def _get_cached_result(self, target_item, k, age_proximity, max_radius, max_visits):
+        """Looks up the result cache for a k nearest neighbors search (see ResultCache.get)
 
         Args:
-            current_node_id: current item in the recursion
-            target_item: target user for which we want to recommend
-            k:  number of neighbors
-            bp_queue: bounded priority queue
-            axis: axis on which to compute distances
+            target_item: user node
+            k: number of neighbors
             age_proximity: maximum difference between a candidate neighbor's age and the user
+            max_radius: maximum distance of the neighbors, as passed to the search
+            max_visits: maximum number of nodes visited, as passed to the search
 
-        Returns:
+        Returns: (list of neighbors, exact) tuple, or None without a cached result
 
         """
-        if not current_node_id:
-            return
+        if self.result_cache is None:
+            return None
+        return self.result_cache.get(target_item, k, age_proximity, max_radius=max_radius, max_visits=max_visits)
 
-        current_node = self.get_node_from_id(current_node_id)
+    def _invalidate_results(self, latitudes, longitudes, ages):
+        """Drops the cached results that the insertion, deletion, or move of people can change (see
+        ResultCache.invalidate)
 
-        axis %= self._num_axes
-        key = self._axis_keys[axis]
+        Args:
+            latitudes: people's latitudes
+            longitudes: people's longitudes
+            ages: people's ages
 
-        # calculate distance from current_item to target_item
-        distance_to_target = self.distance(current_node, target_item)
+        Returns: None
 
-        # compute the age difference with the target
-        age_diff = abs(target_item['age'] - current_node['age'])
+        """
+        if self.result_cache is not None:
+            self.result_cache.invalidate(latitudes, longitudes, ages)
 
-        # only add to the queue when the age difference is within range
-        if age_diff <= age_proximity:
-            bp_queue.push(current_node, distance_to_target)
-
-        # go first to the subtree which gets us closer to the target location
-        go_left = target_item[key] < current_node[key]
-        # recursively search that subtree
-        self._k_nearest_neighbors(current_node['left_id'] if go_left else current_node['right_id'],
-                                  target_item, k, bp_queue, axis + 1, age_proximity)
-
-        # if the candidate hypersphere intersects with the splitting plane, we
-        # look at the other section of the plane by checking the other subtree
-        if (not bp_queue.is_full()) \
-                or self.distance(target_item, current_node, axis=axis) < bp_queue.peek_item_priority():
-            self._k_nearest_neighbors(current_node['right_id'] if go_left else current_node['left_id'],
-                                      target_item, k, bp_queue, axis + 1, age_proximity)
+    def recommend(self, target_item, k, age_proximity, max_radius=None, max_age_widening=None, max_visits=None,
+                  time_budget=None):
+        """Finds the k nearest neighbors of the target_item within max_radius. When fewer than k people in the radius
+        are within age_proximity, the age window is widened step by step (by 1, 2, 4... years) up to max_age_widening
+        more years, and the neighbors of the last window are returned, possibly fewer than k
 
-    def insert_item(self, target_item):
-        """Inserts the target_item in the index
+        Args:
+            target_item: user node
+            k: number of neighbors
+            age_proximity: maximum difference between a candidate neighbor's age and the user
+            max_radius: (optional) maximum distance of the neighbors, in kilometers. Defaults to self.max_radius
+            max_age_widening: (optional) maximum number of years added to age_proximity. Defaults to
+                self.max_age_widening
+            max_visits: (optional) maximum number of nodes visited by each search. Defaults to self.max_visits
+            time_budget: (optional) maximum duration of all the searches, in seconds. Defaults to self.time_budget
+
+        Returns: dictionary with the neighbors (result), whether the last search was exact, the age_proximity it used,
+            and whether it found fewer than k neighbors (partial)
+
+        """
+        max_radius = self.max_radius if max_radius is None else max_radius
+        max_age_widening = self.max_age_widening if max_age_widening is None else max_age_widening
+        time_budget = self.time_budget if time_budget is None else time_budget
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+
+        search_proximity = age_proximity
+        while True:
+            result, exact = self.k_nearest_neighbors(
+                target_item, k, search_proximity, max_visits=max_visits, return_exact=True, max_radius=max_radius,
+                time_budget=None if deadline is None else max(deadline - time.perf_counter(), 0))
+            if len(result) >= k or search_proximity >= age_proximity + max_age_widening or (
+                    deadline is not None and time.perf_counter() >= deadline):
+                break
+            search_proximity = age_proximity + min(max(2 * (search_proximity - age_proximity), 1), max_age_widening)
+
+        return {'result': result, 'exact': exact, 'age_proximity': search_proximity, 'partial': len(result) < k}
+
+    def _search_budget(self, max_visits, time_budget):
+        """Budget of a k nearest neighbors search
 
         Args:
-            target_item:
+            max_visits: maximum number of nodes visited, or None for the store's default
+            time_budget: maximum duration in seconds, or None for the store's default
 
-        Returns:
+        Returns: (max_visits, deadline), with None for no limit, or None without any budget
 
         """
+        max_visits = self.max_visits if max_visits is None else max_visits
+        time_budget = self.time_budget if time_budget is None else time_budget
+        if max_visits is None and time_budget is None:
+            return None
+        return max_visits, None if time_budget is None else time.perf_counter() + time_budget
 
-        # create new leaf node
-        self.add_node_properties(target_item, left_id=None, right_id=None)
-        # insert leaf in index
-        return self._insert_item(self.mem_get('root_id'), target_item, 0)
+    @staticmethod
+    def _budget_exhausted(budget, visits):
+        """Checks the budget of a search
 
-    def get_node_from_id(self, id):
-        """Gets the node from the memory or redis given its id
+        Args:
+            budget: budget from _search_budget
+            visits: number of nodes visited so far
+
+        Returns: True if the search should stop
+
+        """
+        max_visits, deadline = budget
+        return (max_visits is not None and visits >= max_visits) or (
+            deadline is not None and time.perf_counter() >= deadline)
+
+    @staticmethod
+    def _can_improve(bp_queue, min_distances):
+        """Checks whether subtrees left unvisited could still hold closer neighbors than the queue's
 
         Args:
-            id: node id
+            bp_queue: bounded priority queue
+            min_distances: minimum distances between the target and the subtrees
 
-        Returns: node object
+        Returns: True if any of the subtrees could
 
         """
-        result = self.hgetall(id)
+        priority_bound = bp_queue.priority_bound()
+        return any(min_distance < priority_bound for min_distance in min_distances)
 
-        result['latitude'] = float(result['latitude'])
-        result['longitude'] = float(result['longitude'])
-        result['age'] = int(result['age'])
+    def _k_nearest_neighbors(self, root_id, target_item, bp_queue, age_proximity, budget=None, counters=None):
+        """Helper function for the k_nearest neighbor. The tree is traversed with an explicit stack, whose entries
+        carry the bounding box of their subtree, so that a subtree is pruned before its root is fetched. With redis,
+        the subtrees are instead visited closest first, and the redis_batch_size closest ones are fetched together
+        to save round trips
 
-        if result['left_id'] == 'None':
-            result['left_id'] = None
-        if result['right_id'] == 'None':
-            result['right_id'] = None
-        return result
+        Args:
+            root_id: id of the root node
+            target_item: target user for which we want to recommend
+            bp_queue: bounded priority queue
+            age_proximity: maximum difference between a candidate neighbor's age and the user
+            budget: (optional) search budget (see _search_budget)
+            counters: (optional) SearchCounters receiving the number of nodes visited and of subtrees pruned
+
+        Returns: True if the search was complete, False if the budget stopped it while closer neighbors could remain
 
-    def _insert_item(self, current_node_id, target_item, axis):
-        """Helper recursive function for inserting an item into the index
+        """
+        stack = [(root_id, 0, self._root_box, 0.0)]
+        visits = 0
+        pruned = 0
+        try:
+            if not self.redis_mode:
+                while stack:
+                    if budget is not None and self._budget_exhausted(budget, visits):
+                        return not self._can_improve(bp_queue, (entry[3] for entry in stack))
+                    current_node_id, axis, box, min_distance = stack.pop()
+                    pruned += self._visit_node(stack, self.get_node_from_id(current_node_id), target_item, bp_queue,
+                                               age_proximity, axis, box, min_distance)
+                    visits += 1
+                return True
+
+            # with redis, the closest subtrees of the frontier are fetched together in one round trip
+            frontier = [(0.0, 0, stack.pop())]
+            counter = itertools.count(1)
+            while frontier:
+                if budget is not None and self._budget_exhausted(budget, visits):
+                    return not self._can_improve(bp_queue, (entry[0] for entry in frontier))
+                entries = []
+                while frontier and len(entries) < self.redis_batch_size:
+                    min_distance, _, entry = heapq.heappop(frontier)
+                    if min_distance >= bp_queue.priority_bound():
+                        # all the remaining subtrees are farther
+                        pruned += len(frontier) + 1
+                        frontier = []
+                        break
+                    entries.append(entry)
+
+                for (current_node_id, axis, box, min_distance), current_node in zip(
+                        entries, self.get_nodes_from_ids([entry[0] for entry in entries])):
+                    pruned += self._visit_node(stack, current_node, target_item, bp_queue, age_proximity, axis, box,
+                                               min_distance)
+                    while stack:
+                        entry = stack.pop()
+                        heapq.heappush(frontier, (entry[3], next(counter), entry))
+                visits += len(entries)
+            return True
+        finally:
+            if counters is not None:
+                counters.visited += visits
+                counters.pruned += pruned
+
+    def _visit_node(self, stack, current_node, target_item, bp_queue, age_proximity, axis, box, min_distance):
+        """Processes a node of the k nearest neighbors search: pushes it to the queue when it is in the age range, and
+        its children to the stack
 
         Args:
-            current_node:
-            target_item:
-            axis:
+            stack: stack of the search
+            current_node: node object
+            target_item: target user for which we want to recommend
+            bp_queue: bounded priority queue
+            age_proximity: maximum difference between a candidate neighbor's age and the user
+            axis: splitting axis of the node
+            box: bounding box of the node's subtree
+            min_distance: minimum distance between the target and the bounding box
 
-        Returns:
+        Returns: number of subtrees pruned (the node's, or its children's)
 
         """
+        # the queue might have been filled with closer items since the node was pushed
+        if min_distance >= bp_queue.priority_bound():
+            return 1
 
-        if not current_node_id:
-            self.mem_set('root_id', target_item['id'])
+        # skip the subtree when nobody in it is in the age range
+        if 'age_min' in current_node and (current_node['age_min'] > target_item['age'] + age_proximity or
+                                          current_node['age_max'] < target_item['age'] - age_proximity):
+            return 1
 
-        current_node = self.get_node_from_id(current_node_id)
-        axis %= self._num_axes
-        key = self._axis_keys[axis]
+        # only add to the queue when the age difference is within range
+        if abs(target_item['age'] - current_node['age']) <= age_proximity and not current_node.get('deleted'):
+            bp_queue.push(current_node, self.distance(current_node, target_item))
 
-        # go first to the subtree which gets us closer to the target location
-        go_left = target_item[key] < current_node[key]
+        return self._push_children(stack, target_item, bp_queue, axis, box, current_node[self._axis_keys[axis]],
+                                   current_node['left_id'], current_node['right_id'])
 
-        if go_left and not current_node['left_id']:
-            self.update_item_key(current_node, 'left_id', target_item['id'])
-            return current_node_id
+    def _k_nearest_neighbors_compact(self, root_index, target_item, bp_queue, age_proximity, scan_size=0,
+                                     skip_index=-1, bucket_size=0, budget=None, counters=None):
+        """Helper function for the k_nearest neighbor in compact mode. It traverses the tree like
+        _k_nearest_neighbors, reading the nodes directly from the arrays of the CompactNodeStore and pushing their
+        indices to the queue
 
-        elif not go_left and not current_node['right_id']:
-            self.update_item_key(current_node, 'right_id', target_item['id'])
-            return current_node_id
+        Args:
+            root_index: index of the root node
+            target_item: target user for which we want to recommend
+            bp_queue: bounded priority queue
+            age_proximity: maximum difference between a candidate neighbor's age and the user
+            scan_size: (optional) subtrees with at most that many nodes are scored at once with vectorized operations,
+                using the subtree layout of the store
+            skip_index: (optional) index of a node whose subtree was already scored
+            bucket_size: (optional) like scan_size, for the subtrees stored in contiguous rows (see
+                CompactNodeStore.reorder_inorder), which are scored as array slices
+            budget: (optional) search budget (see _search_budget). A scanned subtree counts as many visits as it has
+                nodes
+            counters: (optional) SearchCounters receiving the number of nodes visited and of subtrees pruned
 
-        else:
-            return self._insert_item(current_node['left_id'] if go_left else current_node['right_id'],
-                                     target_item, axis + 1)
+        Returns: True if the search was complete, False if the budget stopped it while closer neighbors could remain
 
-    def find_item(self, target_item):
-        """Allows looking up the node that matches the target_item coordinates
+        """
+        store = self.node_store
+        target_latitude = target_item['latitude']
+        target_longitude = target_item['longitude']
+        if scan_size:
+            inorder, starts, sizes = store.get_subtree_layout()
+        if store.subtree_sizes is None:
+            bucket_size = 0
+
+        stack = [(root_index, 0, self._root_box, 0.0)]
+        visits = 0
+        pruned = 0
+        try:
+            while stack:
+                if budget is not None and self._budget_exhausted(budget, visits):
+                    return not self._can_improve(bp_queue, (entry[3] for entry in stack))
+                current_index, axis, box, min_distance = stack.pop()
+                if min_distance >= bp_queue.priority_bound():
+                    pruned += 1
+                    continue
+                if current_index == skip_index:
+                    continue
+                if store.subtree_age_min is not None and (
+                        store.subtree_age_min[current_index] > target_item['age'] + age_proximity or
+                        store.subtree_age_max[current_index] < target_item['age'] - age_proximity):
+                    pruned += 1
+                    continue
+
+                if bucket_size and store.subtree_sizes[current_index] <= bucket_size:
+                    start, end = store.get_contiguous_subtree(current_index)
+                    appended_rows = store.appended_rows.get(current_index)
+                    candidates = np.r_[start:end, appended_rows] if appended_rows else slice(start, end)
+                    self._scan_nodes(candidates, target_item, bp_queue, age_proximity)
+                    visits += end - start + (len(appended_rows) if appended_rows else 0)
+                    continue
+
+                if scan_size and sizes[current_index] <= scan_size:
+                    start = starts[current_index]
+                    self._scan_nodes(inorder[start:start + sizes[current_index]], target_item, bp_queue, age_proximity)
+                    visits += sizes[current_index]
+                    continue
+                visits += 1
+
+                latitude = float(store.latitudes[current_index])
+                longitude = float(store.longitudes[current_index])
+
+                if abs(target_item['age'] - int(store.ages[current_index])) <= age_proximity and (
+                        store.deleted is None or not store.deleted[current_index]):
+                    bp_queue.push(current_index, haversine_distance(latitude, longitude, target_latitude,
+                                                                    target_longitude))
+
+                left_index = int(store.left_ids[current_index])
+                right_index = int(store.right_ids[current_index])
+                pruned += self._push_children(stack, target_item, bp_queue, axis, box,
+                                              latitude if axis == 0 else longitude,
+                                              left_index if left_index >= 0 else None,
+                                              right_index if right_index >= 0 else None)
+            return True
+        finally:
+            if counters is not None:
+                counters.visited += visits
+                counters.pruned += pruned
+
+    def _scan_nodes(self, candidates, target_item, bp_queue, age_proximity):
+        """Scores a block of nodes against the target at once, and pushes the ones that can enter the queue
 
         Args:
-            target_item:
+            candidates: array of node indices, or slice of contiguous node indices
+            target_item: target user for which we want to recommend
+            bp_queue: bounded priority queue
+            age_proximity: maximum difference between a candidate neighbor's age and the user
 
-        Returns:
+        Returns: None
 
         """
-        return self._find_item(self.mem_get('root_id'), target_item, 0)
+        store = self.node_store
+        radian_latitudes, radian_longitudes, cos_latitudes = store.get_kernel_columns()
+        # rank on the haversine terms, and only compute the distances of the candidates that can enter the queue
+        candidate_terms = haversine_terms(query_terms(target_item['latitude'], target_item['longitude']),
+                                          radian_latitudes[candidates], radian_longitudes[candidates],
+                                          cos_latitudes[candidates])
+        valid = np.abs(store.ages[candidates].astype(np.int64) - target_item['age']) <= age_proximity
+        valid &= candidate_terms < distance_to_term(bp_queue.priority_bound())
+        if store.deleted is not None:
+            valid &= ~store.deleted[candidates]
+
+        if isinstance(candidates, slice):
+            candidates = np.flatnonzero(valid) + candidates.start
+        else:
+            candidates = candidates[valid]
+        candidate_terms = candidate_terms[valid]
+        if len(candidates) > bp_queue.bound:
+            best = np.argpartition(candidate_terms, bp_queue.bound - 1)[:bp_queue.bound]
+            candidates, candidate_terms = candidates[best], candidate_terms[best]
 
-    def _find_item(self, current_node_id, target_item, axis):
-        """Helper recursive function for finding a node
+        for index, distance in zip(candidates.tolist(), terms_to_distances(candidate_terms).tolist()):
+            bp_queue.push(index, distance)
+
+    def k_nearest_neighbors_batch(self, latitudes, longitudes, ages, k, age_proximity):
+        """Computes the k nearest neighbors of many targets at once (compact mode only). The targets are given as one
+        array per column, the layout of the compact store, rather than as an array of target rows
 
         Args:
-            current_node_id:
-            target_item:
-            axis:
+            latitudes: numpy array of the targets' latitudes
+            longitudes: numpy array of the targets' longitudes
+            ages: numpy array of the targets' ages
+            k: number of neighbors
+            age_proximity: maximum difference between a candidate neighbor's age and the target
 
-        Returns:
+        Returns: (indices, distances) arrays of shape (number of targets, k), sorted in ascending order of distance.
+            Missing neighbors have an index of -1 and an infinite distance
 
         """
-        if not current_node_id:
-            return None
+        if not self.compact_mode:
+            raise ValueError('k_nearest_neighbors_batch is only available in compact mode')
+        if not self.get_root_id():
+            raise ValueError(
+                'The index has not been created yet. Create before running the k_nearest_neighbors_batch function')
 
-        axis %= self._num_axes
-        key = self._axis_keys[axis]
+        start_time = time.perf_counter()
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        ages = np.asarray(ages, dtype=np.int64)
 
-        current_node = self.get_node_from_id(current_node_id)
+        indices = np.full((len(latitudes), k), -1, dtype=np.int64)
+        distances = np.full((len(latitudes), k), np.inf)
+        if len(latitudes) and k > 0:
+            self._k_nearest_neighbors_batch(latitudes, longitudes, ages, age_proximity, indices, distances)
 
-        if self.get_coords(current_node) == self.get_coords(target_item):
-            return current_node
+        order = np.argsort(distances, axis=1, kind='stable')
+        self.metrics.observe_stage('batch_search', time.perf_counter() - start_time)
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
 
-        else:
-            # go first to the subtree which gets us closer to the target location
-            go_left = target_item[key] < current_node[key]
-            return self._find_item(current_node['left_id'] if go_left else current_node['right_id'],
-                                   target_item, axis + 1)
+    def _k_nearest_neighbors_batch(self, latitudes, longitudes, ages, age_proximity, indices, distances):
+        """Helper function for k_nearest_neighbors_batch.
 
-    def print_index(self):
-        """Prints the constructed index
+        All the targets descend the tree together, with one vectorized step per level, until they reach a subtree of
+        at most _batch_subtree_size nodes. The nodes of these subtrees are contiguous in the in-order layout of the
+        tree, so they are scored for all the targets at once as a padded distance matrix. The result of a target is
+        exact when its k-th neighbor is closer than the boundary of its subtree's bounding box. The other targets
+        continue with a single target search, starting from these neighbors and scanning small subtrees as a whole.
 
-        Returns: string of constructed index
+        Args:
+            latitudes: targets' latitudes
+            longitudes: targets' longitudes
+            ages: targets' ages
+            age_proximity: maximum difference between a candidate neighbor's age and the target
+            indices: (number of targets, k) array receiving the neighbors' indices
+            distances: (number of targets, k) array receiving the neighbors' distances
 
-        """
-        return self._print_index(self.mem_get('root_id'), 0)
+        Returns: None
 
-    def _print_index(self, current_node_id, level):
-        """Helper recursive function for printing
+        """
+        targets = np.arange(len(latitudes))
+        nodes, boxes = self._descend_batch(latitudes, longitudes)
+        self._score_subtrees_batch(targets, nodes, latitudes, longitudes, ages, age_proximity, indices, distances)
+
+        kth_distances = distances.max(axis=1)
+        exact = kth_distances <= box_boundary_distances(latitudes, longitudes, *boxes)
+
+        for target in targets[~exact]:
+            bp_queue = BoundedPriorityQueue(indices.shape[1])
+            for index, distance in zip(indices[target], distances[target]):
+                if index >= 0:
+                    bp_queue.push(int(index), float(distance))
+
+            self._k_nearest_neighbors_compact(self.node_store.root, {'latitude': float(latitudes[target]),
+                                                                     'longitude': float(longitudes[target]),
+                                                                     'age': int(ages[target])},
+                                              bp_queue, age_proximity, scan_size=self._batch_subtree_size,
+                                              skip_index=nodes[target])
+            indices[target] = -1
+            distances[target] = np.inf
+            for position in range(bp_queue.size()):
+                distance, _, index = bp_queue.pop()
+                indices[target, position] = index
+                distances[target, position] = -distance
+
+    def _descend_batch(self, latitudes, longitudes):
+        """Moves all the targets down the tree at once, each one going to the side of the splitting line it is on,
+        until its subtree has at most _batch_subtree_size nodes
 
         Args:
-            current_node_id:
-            level:
+            latitudes: targets' latitudes
+            longitudes: targets' longitudes
 
-        Returns:
+        Returns: reached nodes, and the (lat_min, lat_max, lon_min, lon_max) arrays of their bounding boxes
 
         """
-        if not current_node_id:
+        store = self.node_store
+        _, _, sizes = store.get_subtree_layout()
+        target_coords = (latitudes, longitudes)
+        store_coords = (store.latitudes, store.longitudes)
+
+        nodes = np.full(len(latitudes), store.root, dtype=np.int64)
+        boxes = tuple(np.full(len(latitudes), bound) for bound in self._root_box)
+
+        moving = np.flatnonzero(sizes[nodes] > self._batch_subtree_size)
+        axis = 0
+        while len(moving):
+            split_values = store_coords[axis][nodes[moving]]
+            go_left = target_coords[axis][moving] < split_values
+            children = np.where(go_left, store.left_ids[nodes[moving]], store.right_ids[nodes[moving]])
+
+            has_child = children >= 0
+            moving, go_left, split_values = moving[has_child], go_left[has_child], split_values[has_child]
+            nodes[moving] = children[has_child]
+            # the split value becomes the upper bound of the left side and the lower bound of the right side
+            boxes[2 * axis + 1][moving[go_left]] = split_values[go_left]
+            boxes[2 * axis][moving[~go_left]] = split_values[~go_left]
+
+            moving = moving[sizes[nodes[moving]] > self._batch_subtree_size]
+            axis = (axis + 1) % self._num_axes
+
+        return nodes, boxes
+
+    def _score_subtrees_batch(self, targets, nodes, latitudes, longitudes, ages, age_proximity, indices, distances):
+        """Computes the k nearest neighbors of each target within the subtree of its node, with one padded distance
+        matrix per chunk of targets
+
+        Args:
+            targets: targets to score
+            nodes: subtree root of each target
+            latitudes: all targets' latitudes
+            longitudes: all targets' longitudes
+            ages: all targets' ages
+            age_proximity: maximum difference between a candidate neighbor's age and the target
+            indices: array receiving the neighbors' indices
+            distances: array receiving the neighbors' distances
+
+        Returns: None
+
+        """
+        store = self.node_store
+        inorder, starts, sizes = store.get_subtree_layout()
+        radian_latitudes, radian_longitudes, cos_latitudes = store.get_kernel_columns()
+        k = indices.shape[1]
+
+        max_size = int(sizes[nodes].max())
+        columns = np.arange(max_size)
+        chunk_size = max(1, self._batch_matrix_size // max_size)
+
+        for chunk_start in range(0, len(targets), chunk_size):
+            chunk_targets = targets[chunk_start:chunk_start + chunk_size]
+            chunk_nodes = nodes[chunk_start:chunk_start + chunk_size]
+
+            valid = columns < sizes[chunk_nodes][:, None]
+            candidates = inorder[np.where(valid, starts[chunk_nodes][:, None] + columns, 0)]
+
+            candidate_terms = haversine_terms(
+                query_terms(latitudes[chunk_targets][:, None], longitudes[chunk_targets][:, None]),
+                radian_latitudes[candidates], radian_longitudes[candidates], cos_latitudes[candidates])
+            valid &= np.abs(store.ages[candidates].astype(np.int64) - ages[chunk_targets][:, None]) <= age_proximity
+            if store.deleted is not None:
+                valid &= ~store.deleted[candidates]
+            candidate_terms[~valid] = np.inf
+
+            if max_size > k:
+                best = np.argpartition(candidate_terms, k - 1, axis=1)[:, :k]
+            else:
+                best = np.broadcast_to(columns, (len(chunk_targets), max_size))
+
+            best_distances = terms_to_distances(np.take_along_axis(candidate_terms, best, axis=1))
+            best_indices = np.where(np.isfinite(best_distances), np.take_along_axis(candidates, best, axis=1), -1)
+            distances[chunk_targets] = np.inf
+            indices[chunk_targets] = -1
+            distances[chunk_targets, :best.shape[1]] = best_distances
+            indices[chunk_targets, :best.shape[1]] = best_indices
+
+    def _push_children(self, stack, target_item, bp_queue, axis, box, split_value, left_id, right_id):
+        """Pushes the children of a node to the traversal stack along with the bounding box of their subtree. A child
+        whose box is farther from the target than the current k-th neighbor is pruned. The child on the side of the
+        target is pushed last, so that it is visited first
+
+        Args:
+            stack: traversal stack
+            target_item: target user for which we want to recommend
+            bp_queue: bounded priority queue
+            axis: splitting axis of the node
+            box: (lat_min, lat_max, lon_min, lon_max) bounding box of the node's subtree
+            split_value: coordinate of the node along the splitting axis
+            left_id: id of the left child (None if missing)
+            right_id: id of the right child (None if missing)
+
+        Returns: number of children pruned
+
+        """
+        lat_min, lat_max, lon_min, lon_max = box
+        if axis == 0:
+            left_box = (lat_min, split_value, lon_min, lon_max)
+            right_box = (split_value, lat_max, lon_min, lon_max)
+        else:
+            left_box = (lat_min, lat_max, lon_min, split_value)
+            right_box = (lat_min, lat_max, split_value, lon_max)
+
+        if target_item[self._axis_keys[axis]] < split_value:
+            children = ((right_id, right_box), (left_id, left_box))
+        else:
+            children = ((left_id, left_box), (right_id, right_box))
+
+        next_axis = (axis + 1) % self._num_axes
+        pruned = 0
+        for child_id, child_box in children:
+            if child_id is None:
+                continue
+            min_distance = box_distance(target_item['latitude'], target_item['longitude'], *child_box)
+            if min_distance >= bp_queue.priority_bound():
+                pruned += 1
+                continue
+            stack.append((child_id, next_axis, child_box, min_distance))
+        return pruned
+
+    def insert_item(self, target_item):
+        """Inserts the target_item in the index
+
+        Args:
+            target_item:
+
+        Returns:
+
+        """
+        self._invalidate_results(target_item['latitude'], target_item['longitude'], target_item['age'])
+        if self.compact_mode:
+            return self._insert_compact_item(target_item)
+
+        root_id = self.get_root_id()
+        if self.redis_mode and self.redis_version is None:
+            # first item of an index that is not in redis yet
+            self._use_redis_version(self._new_redis_version())
+
+        # create new leaf node
+        if self.age_index:
+            target_item.update({'age_min': target_item['age'], 'age_max': target_item['age']})
+        self.add_node_properties(target_item, left_id=None, right_id=None)
+        num_nodes = self._count_inserted_node()
+        # insert leaf in index
+        path = []
+        parent_id = self._insert_item(root_id, target_item, 0, path=path)
+        if self.rebalance and len(path) > self._max_balanced_depth(num_nodes):
+            self._rebalance(path, target_item)
+        self._publish_redis_writes()
+        return parent_id
+
+    def _insert_compact_item(self, target_item):
+        """Inserts the target_item in the compact index. The item gets the id of the row it is stored in (see
+        CompactNodeStore.get_id)
+
+        Args:
+            target_item:
+
+        Returns: id of the parent node
+
+        """
+        if self.node_store is None:
+            self.node_store = CompactNodeStore(coord_dtype=self.coord_dtype)
+        index = self.node_store.append(target_item['latitude'], target_item['longitude'], target_item['age'],
+                                       target_item['name'])
+        target_item['id'] = str(self.node_store.get_id(index))
+        return self._index_appended_row(index)
+
+    def _index_appended_row(self, index):
+        """Links a row appended to the node store into the tree, as a new leaf. When it lands in a leaf bucket, it is
+        scanned along with the bucket's rows, until the bucket has more than bucket_size appended rows
+
+        Args:
+            index: index of the row
+
+        Returns: id of the parent node
+
+        """
+        store = self.node_store
+        if store.root < 0:
+            store.root = index
+            return None
+
+        latitude, longitude, age = store.latitudes[index], store.longitudes[index], int(store.ages[index])
+
+        path = []
+        bucket_root = -1
+        current_index = store.root
+        axis = 0
+        while True:
+            path.append(current_index)
+            if store.subtree_sizes is not None and bucket_root < 0:
+                if store.subtree_sizes[current_index] <= self.bucket_size:
+                    bucket_root = current_index
+                else:
+                    # the new row is not next to the rows of its ancestors' subtrees anymore
+                    store.subtree_sizes[current_index] = store.NOT_CONTIGUOUS
+            if store.subtree_age_min is not None:
+                store.subtree_age_min[current_index] = min(store.subtree_age_min[current_index], age)
+                store.subtree_age_max[current_index] = max(store.subtree_age_max[current_index], age)
+
+            if axis == 0:
+                go_left = latitude < store.latitudes[current_index]
+            else:
+                go_left = longitude < store.longitudes[current_index]
+            child_ids = store.left_ids if go_left else store.right_ids
+
+            if child_ids[current_index] < 0:
+                child_ids[current_index] = index
+                if bucket_root >= 0:
+                    store.subtree_sizes[index] = 0
+                    appended_rows = store.appended_rows.setdefault(bucket_root, [])
+                    appended_rows.append(index)
+                    if len(appended_rows) > self.bucket_size:
+                        store.mark_not_contiguous(bucket_root)
+                if self.rebalance and len(path) > self._max_balanced_depth(store.size):
+                    if bucket_root >= 0 and store.subtree_sizes[bucket_root] != store.NOT_CONTIGUOUS:
+                        # the rebuilt subtree can be in the bucket, whose range depends on its children
+                        store.mark_not_contiguous(bucket_root)
+                    self._rebalance_compact(path, index)
+                return str(store.get_id(current_index))
+
+            current_index = child_ids[current_index]
+            axis = (axis + 1) % self._num_axes
+
+    def insert_items_bulk(self, item_list, build_subtrees=True):
+        """Inserts a batch of items in the index at once. The batch is routed down the tree level by level, and split
+        at each node along its splitting axis, so that each node on the way is read (and updated) once for the whole
+        batch, with one round trip per level with redis. The items that land in the same empty slot of the tree get a
+        balanced subtree of their own, and the new nodes are written back in bulk
+
+        Args:
+            item_list: list of items. In compact mode, they get the ids of their rows (see CompactNodeStore.get_id)
+            build_subtrees: build a balanced subtree from the items that land in the same empty slot. Otherwise, they
+                are inserted there one by one, as insert_item would
+
+        Returns: None
+
+        """
+        if not item_list:
+            return
+        self._invalidate_results([item['latitude'] for item in item_list], [item['longitude'] for item in item_list],
+                                 [item['age'] for item in item_list])
+        if self.compact_mode:
+            self._insert_compact_items_bulk(item_list, build_subtrees)
+            return
+
+        if self.redis_mode and self.redis_version is None:
+            self._use_redis_version(self._new_redis_version())
+        root_id = self.get_root_id()
+        for item in item_list:
+            item.update({'left_id': None, 'right_id': None})
+        if not root_id:
+            root_id = self._build_subtree(item_list, 0)
+            self._count_inserted_node(len(item_list))
+            self._write_nodes(item_list, [])
+            self.set_root_id(root_id)
+            self._publish_redis_writes()
+            return
+
+        coords = tuple(np.array([item[key] for item in item_list]) for key in self._axis_keys)
+        ages = np.array([item['age'] for item in item_list])
+        # the existing nodes whose links or age ranges changed, and the empty slots reached by the items
+        modified_nodes = {}
+        slots = []
+        # the nodes of the current level that the items reached, and the items grouped by node
+        level_ids = [root_id]
+        indices = np.arange(len(item_list))
+        node_starts = np.array([0])
+        depth = 0
+        while level_ids:
+            level_nodes = self.get_nodes_from_ids(level_ids)
+            node_lengths = np.diff(np.r_[node_starts, len(indices)])
+            # widen the age ranges of the subtrees
+            age_mins = np.minimum.reduceat(ages[indices], node_starts).tolist()
+            age_maxs = np.maximum.reduceat(ages[indices], node_starts).tolist()
+            for node, age_min, age_max in zip(level_nodes, age_mins, age_maxs):
+                if 'age_min' in node and (age_min < node['age_min'] or age_max > node['age_max']):
+                    node['age_min'] = min(node['age_min'], age_min)
+                    node['age_max'] = max(node['age_max'], age_max)
+                    modified_nodes[node['id']] = node
+
+            axis = depth % self._num_axes
+            split_values = np.array([node[self._axis_keys[axis]] for node in level_nodes])
+            # children of the nodes, numbered 2 * node + 1 on the right
+            children = np.repeat(np.arange(len(level_nodes)) * 2, node_lengths)
+            children += coords[axis][indices] >= np.repeat(split_values, node_lengths)
+            order = np.argsort(children, kind='stable')
+            indices, children = indices[order], children[order]
+            child_starts = np.flatnonzero(np.r_[True, children[1:] != children[:-1]])
+            child_ends = np.r_[child_starts[1:], len(indices)]
+
+            level_ids = []
+            go_on = np.zeros(len(child_starts), dtype=bool)
+            for i, (child, start, end) in enumerate(zip(children[child_starts].tolist(), child_starts.tolist(),
+                                                        child_ends.tolist())):
+                node = level_nodes[child // 2]
+                child_key = 'right_id' if child % 2 else 'left_id'
+                if node[child_key]:
+                    level_ids.append(node[child_key])
+                    go_on[i] = True
+                else:
+                    slots.append((node, child_key, indices[start:end], depth + 1))
+            indices = indices[np.repeat(go_on, child_ends - child_starts)]
+            node_lengths = (child_ends - child_starts)[go_on]
+            node_starts = np.cumsum(node_lengths) - node_lengths
+            depth += 1
+
+        remaining_items = []
+        if not build_subtrees:
+            # the first item of each slot is linked there, and the others are inserted after it
+            remaining_items = [item_list[i] for i in np.sort(np.concatenate(
+                [slot_indices[1:] for _, _, slot_indices, _ in slots])).tolist()]
+            slots = [(node, child_key, slot_indices[:1], depth) for node, child_key, slot_indices, depth in slots]
+        subtree_root_ids = self._build_subtrees(item_list, [slot_indices for _, _, slot_indices, _ in slots],
+                                                [depth for _, _, _, depth in slots])
+        for (node, child_key, _, _), subtree_root_id in zip(slots, subtree_root_ids):
+            node[child_key] = subtree_root_id
+            modified_nodes[node['id']] = node
+        new_nodes = [item_list[i] for _, _, slot_indices, _ in slots for i in slot_indices.tolist()]
+        num_nodes = self._count_inserted_node(len(new_nodes))
+        self._write_nodes(new_nodes, list(modified_nodes.values()))
+
+        if self.rebalance:
+            max_depth = self._max_balanced_depth(num_nodes)
+            items_by_id = {item['id']: item for item in new_nodes}
+            for (_, _, slot_indices, depth), subtree_root_id in zip(slots, subtree_root_ids):
+                size = len(slot_indices)
+                # depth of the deepest node of the balanced subtree
+                if depth + size.bit_length() - 1 > max_depth:
+                    # an earlier rebuild can have moved the subtree
+                    subtree_root = items_by_id[subtree_root_id]
+                    path = self._find_path(subtree_root)
+                    size = len(self._subtree_nodes(subtree_root_id))
+                    if len(path) + size.bit_length() - 1 > max_depth:
+                        self._rebalance(path, subtree_root, subtree_size=size, max_depth=max_depth)
+        self._publish_redis_writes()
+        for item in remaining_items:
+            self.insert_item(item)
+
+    def _write_nodes(self, new_nodes, modified_nodes):
+        """Writes the nodes of a bulk insertion, in chunks of one MSET each with redis (see
+        RedisNodeStore.set_nodes_bulk). The new nodes are written before the nodes linking to them
+
+        Args:
+            new_nodes: new node objects
+            modified_nodes: node objects of the index that changed
+
+        Returns: None
+
+        """
+        if self.redis_mode:
+            for nodes in (new_nodes, modified_nodes):
+                self.redis_nodes.set_nodes_bulk(nodes, chunk_size=self.redis_write_chunk_size,
+                                                num_connections=self.redis_write_connections)
+            # cache copies of the new nodes, as the caller keeps the items
+            for node in new_nodes:
+                self.node_cache.put(dict(node))
+            for node in modified_nodes:
+                self.node_cache.put(node)
+        else:
+            for node in new_nodes:
+                self.kv_store[node['id']] = node
+
+    def _insert_compact_items_bulk(self, item_list, build_subtrees):
+        """Inserts a batch of items in the compact index (see insert_items_bulk)
+
+        Args:
+            item_list: list of items
+            build_subtrees: build a balanced subtree from the items that land in the same empty slot
+
+        Returns: None
+
+        """
+        if self.node_store is None:
+            self.node_store = CompactNodeStore(coord_dtype=self.coord_dtype)
+        store = self.node_store
+        relayout = store.subtree_sizes is not None and len(item_list) > self.bulk_relayout_fraction * store.size
+        if relayout:
+            # the buckets are laid out again at the end
+            store.subtree_sizes = None
+            store.appended_rows = {}
+
+        start = store.extend([item['latitude'] for item in item_list], [item['longitude'] for item in item_list],
+                             [item['age'] for item in item_list], [item['name'] for item in item_list])
+        rows = np.arange(start, store.size)
+        for item, node_id in zip(item_list, store.get_ids(rows).tolist()):
+            item['id'] = str(node_id)
+        self._index_appended_rows(rows, build_subtrees)
+
+        if relayout:
+            # the ids are kept apart from the rows that move
+            store.assign_ids()
+            store.reorder_inorder()
+
+    def _index_appended_rows(self, rows, build_subtrees):
+        """Links many rows appended to the node store into the tree at once, like _index_appended_row. All the rows
+        walk down the tree together, one level per step
+
+        Args:
+            rows: numpy array of row indices
+            build_subtrees: build a balanced subtree from the rows that land in the same empty slot. Otherwise, they
+                are linked there one by one
+
+        Returns: None
+
+        """
+        store = self.node_store
+        if store.root < 0:
+            store.root = build_kd_tree((store.latitudes, store.longitudes), store.left_ids, store.right_ids,
+                                       perm=rows.copy(), use_approx_median=self.use_approx_median,
+                                       median_sample=self._median_sample)
+            if store.subtree_age_min is not None:
+                store.build_age_index(store.root)
+            if store.subtree_sizes is not None:
+                store.subtree_sizes[rows] = store.NOT_CONTIGUOUS
+            return
+
+        coords = (store.latitudes, store.longitudes)
+        ages = store.ages[rows]
+        # the node each row is at, and where it stops: the parent of its empty slot and the side of the slot
+        nodes = np.full(len(rows), store.root, dtype=np.int64)
+        bucket_roots = np.full(len(rows), -1, dtype=np.int64)
+        parents = np.empty(len(rows), dtype=np.int64)
+        go_lefts = np.empty(len(rows), dtype=bool)
+        depths = np.empty(len(rows), dtype=np.int64)
+        moving = np.arange(len(rows))
+        depth = 0
+        while len(moving):
+            current = nodes[moving]
+            if store.subtree_age_min is not None:
+                np.minimum.at(store.subtree_age_min, current, ages[moving])
+                np.maximum.at(store.subtree_age_max, current, ages[moving])
+            if store.subtree_sizes is not None:
+                free = bucket_roots[moving] < 0
+                in_bucket = free & (store.subtree_sizes[current] <= self.bucket_size)
+                bucket_roots[moving[in_bucket]] = current[in_bucket]
+                # the new rows are not next to the rows of their ancestors' subtrees anymore
+                store.subtree_sizes[current[free & ~in_bucket]] = store.NOT_CONTIGUOUS
+
+            axis = depth % self._num_axes
+            go_left = coords[axis][rows[moving]] < coords[axis][current]
+            children = np.where(go_left, store.left_ids[current], store.right_ids[current])
+            arrived = children < 0
+            parents[moving[arrived]] = current[arrived]
+            go_lefts[moving[arrived]] = go_left[arrived]
+            depths[moving[arrived]] = depth + 1
+            nodes[moving[~arrived]] = children[~arrived]
+            moving = moving[~arrived]
+            depth += 1
+
+        # group the rows by slot, in the order of the batch
+        slot_keys = parents * 2 + go_lefts
+        order = np.argsort(slot_keys, kind='stable')
+        slot_keys = slot_keys[order]
+        starts = np.flatnonzero(np.r_[True, slot_keys[1:] != slot_keys[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        placed = order
+        if not build_subtrees:
+            # the first row of each slot is linked there, and the others are inserted after it
+            remaining = np.ones(len(order), dtype=bool)
+            remaining[starts] = False
+            remaining_rows = np.sort(order[remaining])
+            placed = order[starts]
+            ends = starts + 1
+
+        # the subtrees whose roots have the same splitting axis are built together
+        perm = rows[order]
+        slot_parents, slot_lefts, slot_depths = parents[order[starts]], go_lefts[order[starts]], depths[order[starts]]
+        for axis in range(self._num_axes):
+            slots = slot_depths % self._num_axes == axis
+            build_kd_subtrees(coords, store.left_ids, store.right_ids, perm, starts[slots], ends[slots],
+                              slot_parents[slots], slot_lefts[slots], axis, use_approx_median=self.use_approx_median,
+                              median_sample=self._median_sample)
+        subtree_roots = np.where(slot_lefts, store.left_ids[slot_parents], store.right_ids[slot_parents])
+        if store.subtree_age_min is not None:
+            store.build_age_index(subtree_roots)
+
+        if store.subtree_sizes is not None:
+            # the rows that land in a bucket are scanned with it, and the subtrees built elsewhere are not laid out
+            placed_buckets = bucket_roots[placed]
+            in_bucket = placed_buckets >= 0
+            store.subtree_sizes[rows[placed[in_bucket]]] = 0
+            built = np.repeat(ends - starts > 1, ends - starts)
+            store.subtree_sizes[rows[placed[~in_bucket & built]]] = store.NOT_CONTIGUOUS
+
+            bucket_order = np.argsort(placed_buckets[in_bucket], kind='stable')
+            buckets = placed_buckets[in_bucket][bucket_order]
+            bucket_rows = rows[placed[in_bucket]][bucket_order].tolist()
+            bucket_starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]]) if len(buckets) else buckets
+            bucket_ends = np.r_[bucket_starts[1:], len(buckets)]
+            for bucket_start, bucket_end in zip(bucket_starts.tolist(), bucket_ends.tolist()):
+                bucket_root = int(buckets[bucket_start])
+                appended_rows = store.appended_rows.setdefault(bucket_root, [])
+                appended_rows.extend(bucket_rows[bucket_start:bucket_end])
+                if len(appended_rows) > self.bucket_size:
+                    store.mark_not_contiguous(bucket_root)
+
+        if self.rebalance:
+            max_depth = self._max_balanced_depth(store.size)
+            for slot in np.flatnonzero(slot_depths + np.log2(ends - starts).astype(np.int64) > max_depth).tolist():
+                # an earlier rebuild can have moved the subtree
+                subtree_root = int(subtree_roots[slot])
+                path = self._find_compact_path(subtree_root)
+                levels = store.get_tree_levels(subtree_root)
+                if len(path) + len(levels) - 1 > max_depth:
+                    bucket_root = bucket_roots[order[starts[slot]]]
+                    if (store.subtree_sizes is not None and bucket_root >= 0 and
+                            store.subtree_sizes[bucket_root] != store.NOT_CONTIGUOUS):
+                        store.mark_not_contiguous(bucket_root)
+                    self._rebalance_compact(path, subtree_root, subtree_size=sum(len(level) for level in levels),
+                                            max_depth=max_depth)
+
+        if not build_subtrees:
+            for row in rows[remaining_rows].tolist():
+                self._index_appended_row(row)
+
+    def _max_balanced_depth(self, num_nodes):
+        """Depth beyond which an insertion looks for an unbalanced subtree to rebuild, as in scapegoat trees
+
+        Args:
+            num_nodes: number of nodes in the tree
+
+        Returns: depth
+
+        """
+        return math.log(max(num_nodes, 1)) / math.log(1 / self.rebalance_alpha)
+
+    def _rebalance_compact(self, path, index, subtree_size=1, max_depth=None):
+        """Rebuilds the lowest subtree on the path of an insertion whose child on the path holds more than
+        rebalance_alpha of its nodes (the scapegoat). The sizes are counted on the way up, which amortizes to a
+        logarithmic cost per insertion
+
+        Args:
+            path: indices of the ancestors of the inserted node, from the root
+            index: index of the inserted node
+            subtree_size: number of nodes in the subtree of the inserted node (see insert_items_bulk)
+            max_depth: (optional) depth that the inserted subtree should not exceed once rebuilt. The subtrees that are
+                too deep even when balanced are not rebuilt. This matters for the subtrees of bulk insertions, whose
+                parent alone is out of balance
+
+        Returns: None
+
+        """
+        store = self.node_store
+        child_index, child_size = index, subtree_size
+        for depth in range(len(path) - 1, -1, -1):
+            node_index = path[depth]
+            sibling_index = store.left_ids[node_index]
+            if sibling_index == child_index:
+                sibling_index = store.right_ids[node_index]
+            size = child_size + 1 + (sum(len(level) for level in store.get_tree_levels(sibling_index))
+                                     if sibling_index >= 0 else 0)
+            if child_size > self.rebalance_alpha * size and (max_depth is None or
+                                                              depth + size.bit_length() - 1 <= max_depth):
+                new_root = store.rebuild_subtree(node_index, depth, use_approx_median=self.use_approx_median,
+                                                 median_sample=self._median_sample)
+                if depth == 0:
+                    store.root = new_root
+                else:
+                    parent_index = path[depth - 1]
+                    child_ids = store.left_ids if store.left_ids[parent_index] == node_index else store.right_ids
+                    child_ids[parent_index] = new_root
+                return
+            child_index, child_size = node_index, size
+
+    def _count_inserted_node(self, num_inserted=1):
+        """Counts the nodes inserted in the dictionary-based index
+
+        Args:
+            num_inserted: number of inserted nodes
+
+        Returns: number of nodes in the index
+
+        """
+        return self.mem_incr(self._counter_key('num_nodes'), num_inserted)
+
+    def _counter_key(self, name):
+        """Key of a counter of the dictionary-based index, kept per version of the index in redis
+
+        Args:
+            name: name of the counter
+
+        Returns: key
+
+        """
+        if self.redis_mode:
+            return self._redis_key('v' + str(self.redis_version), name)
+        return name
+
+    def _subtree_nodes(self, node_id):
+        """Reads all the nodes of a subtree, level by level (one round trip per level with redis)
+
+        Args:
+            node_id: id of the subtree root (None for an empty subtree)
+
+        Returns: list of node objects
+
+        """
+        nodes = []
+        level_ids = [node_id] if node_id else []
+        while level_ids:
+            level = self.get_nodes_from_ids(level_ids)
+            nodes.extend(level)
+            level_ids = [child_id for node in level for child_id in (node['left_id'], node['right_id']) if child_id]
+        return nodes
+
+    def _rebalance(self, path, target_item, subtree_size=1, max_depth=None):
+        """Rebuilds the scapegoat subtree on the path of an insertion in the dictionary-based index, like
+        _rebalance_compact
+
+        Args:
+            path: ancestors of the inserted node, from the root
+            target_item: inserted node
+            subtree_size: number of nodes in the subtree of the inserted node (see insert_items_bulk)
+            max_depth: (optional) depth that the inserted subtree should not exceed once rebuilt (see
+                _rebalance_compact)
+
+        Returns: None
+
+        """
+        child_id, child_size = target_item['id'], subtree_size
+        for depth in range(len(path) - 1, -1, -1):
+            node = path[depth]
+            sibling_id = node['right_id'] if node['left_id'] == child_id else node['left_id']
+            size = child_size + 1 + len(self._subtree_nodes(sibling_id))
+            if child_size > self.rebalance_alpha * size and (max_depth is None or
+                                                              depth + size.bit_length() - 1 <= max_depth):
+                new_root_id = self._rebuild_subtree(self._subtree_nodes(node['id']), depth)
+                if depth == 0:
+                    self.set_root_id(new_root_id)
+                else:
+                    parent = path[depth - 1]
+                    self.update_item_key(parent, 'left_id' if parent['left_id'] == node['id'] else 'right_id',
+                                         new_root_id)
+                return
+            child_id, child_size = node['id'], size
+
+    def _rebuild_subtree(self, nodes, depth):
+        """Rebuilds the given nodes of a subtree into a balanced subtree, and writes them back (in one pipelined
+        round trip with redis)
+
+        Args:
+            nodes: node objects of the subtree
+            depth: depth of the subtree root, which determines its splitting axis
+
+        Returns: id of the new subtree root
+
+        """
+        root_id = self._build_subtree(nodes, depth)
+        if self.redis_mode:
+            pipeline = self.r_server.pipeline(transaction=False)
+            for node in nodes:
+                self.redis_nodes.set_node(node, pipeline=pipeline)
+            pipeline.execute()
+            self.redis_nodes.round_trips += 1
+            for node in nodes:
+                self.node_cache.put(node)
+        else:
+            for node in nodes:
+                self.kv_store[node['id']] = node
+        return root_id
+
+    def _build_subtree(self, nodes, depth):
+        """Links the given nodes into a balanced subtree, without writing them
+
+        Args:
+            nodes: node objects
+            depth: depth of the subtree root, which determines its splitting axis
+
+        Returns: id of the subtree root
+
+        """
+        return self._build_subtrees(nodes, [np.arange(len(nodes))], [depth])[0]
+
+    def _build_subtrees(self, nodes, subtree_indices, depths):
+        """Links some of the given nodes into balanced subtrees, without writing them. The subtrees are built
+        together (see build_kd_subtrees)
+
+        Args:
+            nodes: node objects
+            subtree_indices: list of the arrays of the positions in nodes of the nodes of each subtree
+            depths: depth of the root of each subtree, which determines its splitting axis
+
+        Returns: list of the ids of the subtree roots
+
+        """
+        coords = tuple(np.array([node[key] for node in nodes]) for key in self._axis_keys)
+        left_ids = np.full(len(nodes), -1, dtype=np.int64)
+        right_ids = np.full(len(nodes), -1, dtype=np.int64)
+        lengths = np.array([len(indices) for indices in subtree_indices], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        perm = np.concatenate([np.empty(0, dtype=np.int64)] + list(subtree_indices)).astype(np.int64)
+        depths = np.asarray(depths)
+        for axis in range(self._num_axes):
+            subtrees = np.flatnonzero(depths % self._num_axes == axis)
+            build_kd_subtrees(coords, left_ids, right_ids, perm, starts[subtrees], ends[subtrees],
+                              np.full(len(subtrees), -1), np.zeros(len(subtrees), dtype=bool), axis,
+                              use_approx_median=self.use_approx_median, median_sample=self._median_sample)
+
+        # the roots are the nodes that are nobody's child
+        is_child = np.zeros(len(nodes), dtype=bool)
+        is_child[left_ids[left_ids >= 0]] = True
+        is_child[right_ids[right_ids >= 0]] = True
+        roots = np.empty(len(subtree_indices), dtype=np.int64)
+        is_root = ~is_child[perm]
+        roots[np.repeat(np.arange(len(subtree_indices)), lengths)[is_root]] = perm[is_root]
+
+        ids = [node['id'] for node in nodes]
+        for i, left, right in zip(perm.tolist(), left_ids[perm].tolist(), right_ids[perm].tolist()):
+            nodes[i]['left_id'] = ids[left] if left >= 0 else None
+            nodes[i]['right_id'] = ids[right] if right >= 0 else None
+
+        if self.age_index:
+            # bottom-up, level by level
+            age_min = np.array([node['age'] for node in nodes])
+            age_max = age_min.copy()
+            levels = []
+            level = roots
+            while len(level):
+                levels.append(level)
+                level = np.concatenate((left_ids[level], right_ids[level]))
+                level = level[level >= 0]
+            for level in reversed(levels):
+                for children in (left_ids[level], right_ids[level]):
+                    has_child = children >= 0
+                    parents, children = level[has_child], children[has_child]
+                    age_min[parents] = np.minimum(age_min[parents], age_min[children])
+                    age_max[parents] = np.maximum(age_max[parents], age_max[children])
+            for i, node_age_min, node_age_max in zip(perm.tolist(), age_min[perm].tolist(), age_max[perm].tolist()):
+                nodes[i]['age_min'] = node_age_min
+                nodes[i]['age_max'] = node_age_max
+        return [ids[root] for root in roots.tolist()]
+
+    def get_node_from_id(self, id):
+        """Gets the node from the memory or redis given its id
+
+        Args:
+            id: node id
+
+        Returns: node object
+
+        """
+        if self.compact_mode:
+            return self.node_store.get_node(self._get_compact_row(id))
+        return self.hgetall(id)
+
+    def get_nodes_from_ids(self, ids):
+        """Gets several nodes from the memory or redis, in a single round trip with redis
+
+        Args:
+            ids: list of node ids
+
+        Returns: list of node objects
+
+        """
+        if self.redis_mode and not self._construction_phase:
+            return self._get_redis_nodes(ids)
+        return [self.get_node_from_id(id) for id in ids]
+
+    def _get_redis_nodes(self, ids):
+        """Gets nodes from the node cache, fetching the missing ones from redis in one round trip
+
+        Args:
+            ids: list of node ids
+
+        Returns: list of node objects
+
+        """
+        nodes = [self.node_cache.get(id) for id in ids]
+        missing_ids = [id for id, node in zip(ids, nodes) if node is None]
+        if not missing_ids:
+            return nodes
+
+        fetched_nodes = dict(zip(missing_ids, self.redis_nodes.get_nodes(missing_ids)))
+        for node in fetched_nodes.values():
+            self.node_cache.put(node)
+        return [node if node is not None else fetched_nodes[id] for id, node in zip(ids, nodes)]
+
+    def warm_node_cache(self):
+        """Drops the node cache, then reads the top pinned_levels levels of the tree from redis, one round trip per
+        level, and pins them in the node cache
+
+        Returns: None
+
+        """
+        self._redis_epoch = None
+        self.get_root_id()
+
+    def _pin_top_levels(self, root_id):
+        """Reads the top pinned_levels levels of the tree from redis, one round trip per level, and pins them in the
+        node cache
+
+        Args:
+            root_id: root id string, or None for an empty index
+
+        Returns: None
+
+        """
+        level_ids = [root_id] if root_id else []
+        for _ in range(self.pinned_levels):
+            if not level_ids:
+                break
+            nodes = self.redis_nodes.get_nodes(level_ids)
+            for node in nodes:
+                self.node_cache.pin(node)
+            level_ids = [child_id for node in nodes for child_id in (node['left_id'], node['right_id']) if child_id]
+
+    def _insert_item(self, current_node_id, target_item, axis, path=None):
+        """Helper function for inserting an item into the index. It walks down from current_node_id iteratively,
+        so that deep trees do not hit the recursion limit
+
+        Args:
+            current_node_id:
+            target_item:
+            axis:
+            path: (optional) list receiving the nodes walked through, from current_node_id to the parent
+
+        Returns: id of the parent node
+
+        """
+
+        if not current_node_id:
+            self.set_root_id(target_item['id'])
+            return None
+
+        while True:
+            current_node = self.get_node_from_id(current_node_id)
+            if path is not None:
+                path.append(current_node)
+            axis %= self._num_axes
+            key = self._axis_keys[axis]
+
+            # widen the age range of the subtree
+            if 'age_min' in current_node:
+                if target_item['age'] < current_node['age_min']:
+                    self.update_item_key(current_node, 'age_min', target_item['age'])
+                if target_item['age'] > current_node['age_max']:
+                    self.update_item_key(current_node, 'age_max', target_item['age'])
+
+            # go first to the subtree which gets us closer to the target location
+            go_left = target_item[key] < current_node[key]
+
+            if go_left and not current_node['left_id']:
+                self.update_item_key(current_node, 'left_id', target_item['id'])
+                return current_node_id
+
+            elif not go_left and not current_node['right_id']:
+                self.update_item_key(current_node, 'right_id', target_item['id'])
+                return current_node_id
+
+            current_node_id = current_node['left_id'] if go_left else current_node['right_id']
+            axis += 1
+
+    def delete_item(self, id):
+        """Deletes a person from the index. Their node stays in the tree as a tombstone, which the searches skip,
+        until the tombstones reach compaction_fraction of the nodes and the index is compacted (see compact_index)
+
+        Args:
+            id: id of the person
+
+        Returns: None
+
+        """
+        if self.compact_mode:
+            store = self.node_store
+            index = self._get_compact_row(id)
+            self._invalidate_results(store.latitudes[index], store.longitudes[index], store.ages[index])
+            store.delete(index)
+            num_tombstones = store.num_deleted
+        else:
+            node = self._get_live_node(id)
+            self._invalidate_results(node['latitude'], node['longitude'], node['age'])
+            self.update_item_key(node, 'deleted', True)
+            num_tombstones = self.mem_incr(self._counter_key('num_tombstones'))
+            self._publish_redis_writes()
+        self._compact_if_needed(num_tombstones)
+
+    def update_location(self, id, latitude, longitude):
+        """Moves a person to a new location. Their former node stays in the tree as a tombstone (see delete_item),
+        and they are inserted again at the new location, under the same id
+
+        Args:
+            id: id of the person
+            latitude: new latitude
+            longitude: new longitude
+
+        Returns: None
+
+        """
+        if self.compact_mode:
+            store = self.node_store
+            index = self._get_compact_row(id)
+            age, name = int(store.ages[index]), store.get_name(index)
+            self._invalidate_results([store.latitudes[index], latitude], [store.longitudes[index], longitude],
+                                     [age, age])
+            store.delete(index)
+            self._index_appended_row(store.append(latitude, longitude, age, name, node_id=store.get_id(index)))
+            num_tombstones = store.num_deleted
+        else:
+            node = self._get_live_node(id)
+            # the new location is invalidated by insert_item
+            self._invalidate_results(node['latitude'], node['longitude'], node['age'])
+            num_tombstones = self.mem_incr(self._counter_key('num_tombstones'))
+            # the former node keeps its place in the tree under another id, which frees the person's id
+            tombstone = dict(node, id='tombstone_' + str(num_tombstones), deleted=True)
+            self.hmem_set(tombstone['id'], tombstone)
+            parent = self._find_parent(node)
+            if parent is None:
+                self.set_root_id(tombstone['id'])
+            else:
+                self.update_item_key(parent, 'left_id' if parent['left_id'] == node['id'] else 'right_id',
+                                     tombstone['id'])
+            # insert_item publishes the writes, the tombstone's included
+            self.insert_item({'id': node['id'], 'name': node['name'], 'age': node['age'], 'latitude': latitude,
+                              'longitude': longitude})
+        self._compact_if_needed(num_tombstones)
+
+    def _get_compact_row(self, id):
+        """Row of a live node of the compact index
+
+        Args:
+            id: node id string
+
+        Returns: node index
+
+        """
+        try:
+            index = self.node_store.get_row(int(id))
+        except (ValueError, TypeError):
+            raise KeyError(id)
+        if index < 0:
+            raise KeyError(id)
+        return index
+
+    def _get_live_node(self, id):
+        """Gets a node of the dictionary-based index that was not deleted
+
+        Args:
+            id: node id
+
+        Returns: node object
+
+        """
+        node = self.get_node_from_id(id)
+        # the memory store also keeps the root id and the counters
+        if type(node) is not dict or node.get('deleted'):
+            raise KeyError(id)
+        return node
+
+    def _find_parent(self, node):
+        """Finds the parent of a node (see _find_path)
+
+        Args:
+            node: node object
+
+        Returns: parent node object, or None for the root
+
+        """
+        path = self._find_path(node)
+        return path[-1] if path else None
+
+    def _find_path(self, node):
+        """Finds the ancestors of a node by walking down from the root along the node's coordinates. Both subtrees
+        are searched below the nodes with the same coordinate, which the index construction can put on either side
+
+        Args:
+            node: node object
+
+        Returns: list of the ancestor node objects, from the root
+
+        """
+        stack = [(self.get_root_id(), 0, [])]
+        while stack:
+            current_node_id, axis, path = stack.pop()
+            if current_node_id == node['id']:
+                return path
+            current_node = self.get_node_from_id(current_node_id)
+            key = self._axis_keys[axis]
+            next_axis = (axis + 1) % self._num_axes
+            if node[key] <= current_node[key] and current_node['left_id']:
+                stack.append((current_node['left_id'], next_axis, path + [current_node]))
+            if node[key] >= current_node[key] and current_node['right_id']:
+                stack.append((current_node['right_id'], next_axis, path + [current_node]))
+        raise KeyError(node['id'])
+
+    def _find_compact_path(self, index):
+        """Finds the ancestors of a node of the compact index, like _find_path
+
+        Args:
+            index: node index
+
+        Returns: list of the ancestor node indices, from the root
+
+        """
+        store = self.node_store
+        coords = (store.latitudes, store.longitudes)
+        stack = [(store.root, 0, [])]
+        while stack:
+            current_index, axis, path = stack.pop()
+            if current_index == index:
+                return path
+            value, split_value = coords[axis][index], coords[axis][current_index]
+            next_axis = (axis + 1) % self._num_axes
+            if value <= split_value and store.left_ids[current_index] >= 0:
+                stack.append((store.left_ids[current_index], next_axis, path + [current_index]))
+            if value >= split_value and store.right_ids[current_index] >= 0:
+                stack.append((store.right_ids[current_index], next_axis, path + [current_index]))
+        raise KeyError(index)
+
+    def _compact_if_needed(self, num_tombstones):
+        """Compacts the index once the tombstones reach compaction_fraction of the nodes
+
+        Args:
+            num_tombstones: number of tombstones in the index
+
+        Returns: None
+
+        """
+        if self.compact_mode:
+            num_nodes = self.node_store.size
+        else:
+            num_nodes = int(self.mem_get(self._counter_key('num_nodes')) or 0)
+        if num_tombstones > self.compaction_fraction * num_nodes:
+            self.compact_index()
+
+    def compact_index(self):
+        """Rebuilds the index without its tombstones. In redis, the compacted index is written under a new version,
+        like a rebuilt one, while the current version is still served
+
+        Returns: None
+
+        """
+        if self.compact_mode:
+            self.node_store.compact()
+            self.construct_index()
+            return
+
+        item_list = [{'id': node['id'], 'name': node['name'], 'age': node['age'], 'latitude': node['latitude'],
+                      'longitude': node['longitude']} for node in self._subtree_nodes(self.get_root_id())
+                     if not node.get('deleted')]
+        self.kv_store.clear()
+        self.construct_index(item_list=item_list)
+
+    def find_item(self, target_item):
+        """Allows looking up the node that matches the target_item coordinates
+
+        Args:
+            target_item:
+
+        Returns:
+
+        """
+        if self.compact_mode:
+            return self._find_compact_item(target_item)
+        return self._find_item(self.get_root_id(), target_item, 0)
+
+    def _find_compact_item(self, target_item):
+        """Looks up the node that matches the target_item coordinates in the compact index
+
+        Args:
+            target_item:
+
+        Returns: node dictionary, or None if not found
+
+        """
+        store = self.node_store
+        if store is None:
+            return None
+
+        # compare in the precision the coordinates are stored in
+        latitude = store.coord_dtype.type(target_item['latitude'])
+        longitude = store.coord_dtype.type(target_item['longitude'])
+
+        current_index = store.root
+        axis = 0
+        while current_index >= 0:
+            if store.latitudes[current_index] == latitude and store.longitudes[current_index] == longitude and (
+                    store.deleted is None or not store.deleted[current_index]):
+                return store.get_node(current_index)
+
+            if axis == 0:
+                go_left = latitude < store.latitudes[current_index]
+            else:
+                go_left = longitude < store.longitudes[current_index]
+            current_index = store.left_ids[current_index] if go_left else store.right_ids[current_index]
+            axis = (axis + 1) % self._num_axes
+        return None
+
+    def _find_item(self, current_node_id, target_item, axis):
+        """Helper function for finding a node, walking down from current_node_id iteratively
+
+        Args:
+            current_node_id:
+            target_item:
+            axis:
+
+        Returns:
+
+        """
+        while current_node_id:
+            axis %= self._num_axes
+            key = self._axis_keys[axis]
+
+            current_node = self.get_node_from_id(current_node_id)
+
+            if self.get_coords(current_node) == self.get_coords(target_item) and not current_node.get('deleted'):
+                return current_node
+
+            # go first to the subtree which gets us closer to the target location
+            go_left = target_item[key] < current_node[key]
+            current_node_id = current_node['left_id'] if go_left else current_node['right_id']
+            axis += 1
+        return None
+
+    def print_index(self):
+        """Prints the constructed index
+
+        Returns: string of constructed index
+
+        """
+        return self._print_index(self.get_root_id(), 0)
+
+    def _print_index(self, current_node_id, level):
+        """Helper recursive function for printing
+
+        Args:
+            current_node_id:
+            level:
+
+        Returns:
+
+        """
+        if not current_node_id:
             return None
 
         current_node = self.get_node_from_id(current_node_id)
@@ -712,6 +2526,65 @@ class KDTreeDataStore():
         self._print_index(current_node['left_id'], level + 1)
         self._print_index(current_node['right_id'], level + 1)
 
+    @staticmethod
+    def recall_at_k(result, expected):
+        """Fraction of the exact neighbors matched by a result. Neighbors at the same distance are interchangeable,
+        so a result neighbor counts as a match when it is not farther than the exact k-th neighbor
+
+        Args:
+            result: list of neighbors returned by an approximate search
+            expected: list of exact neighbors
+
+        Returns: recall between 0 and 1 (1 when there are no exact neighbors)
+
+        """
+        if not expected:
+            return 1.0
+        kth_distance = expected[-1]['distance'] * (1 + 1e-9)
+        return min(len([item for item in result if item['distance'] <= kth_distance]), len(expected)) / len(expected)
+
+    def measure_recall(self, k, age_proximity, max_visits=None, time_budget=None, num_queries=100, targets=None,
+                       seed=0):
+        """Measures the recall@k of budgeted k nearest neighbors searches against exact ones
+
+        Args:
+            k: number of neighbors
+            age_proximity: maximum difference between a candidate neighbor's age and the user
+            max_visits: (optional) maximum number of nodes visited. Defaults to self.max_visits
+            time_budget: (optional) maximum duration of the search, in seconds. Defaults to self.time_budget
+            num_queries: number of random targets, when targets is not given
+            targets: (optional) list of target items
+            seed: seed of the random targets
+
+        Returns: dictionary with the mean recall, the fraction of exact searches, and the mean durations of the
+            budgeted and exact searches (in seconds)
+
+        """
+        if targets is None:
+            rng = random.RandomState(seed)
+            targets = [{'name': 'bla bla', 'age': int(age), 'latitude': latitude, 'longitude': longitude}
+                       for latitude, longitude, age in zip(rng.uniform(-45, 45, num_queries),
+                                                           rng.uniform(-180, 180, num_queries),
+                                                           rng.randint(10, 80, num_queries))]
+        recalls, exact_flags, budget_times, exact_times = [], [], [], []
+        for target_item in targets:
+            start_time = time.perf_counter()
+            result, exact = self.k_nearest_neighbors(target_item, k, age_proximity, max_visits=max_visits,
+                                                     time_budget=time_budget, return_exact=True)
+            budget_times.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            expected = self.k_nearest_neighbors(target_item, k, age_proximity, max_visits=float('inf'),
+                                                time_budget=float('inf'))
+            exact_times.append(time.perf_counter() - start_time)
+
+            recalls.append(self.recall_at_k(result, expected))
+            exact_flags.append(exact)
+        return {'recall': float(np.mean(recalls)),
+                'exact_fraction': float(np.mean(exact_flags)),
+                'mean_time': float(np.mean(budget_times)),
+                'mean_exact_time': float(np.mean(exact_times))}
+
     def run_profiling(self, num_loops, num_neighbors, age_proximity):
         """Executes the k_nearest_neighbors algorithm for num_loops times and returns the average running time
 
@@ -730,10 +2603,10 @@ class KDTreeDataStore():
         time_list = []
 
         for i in tqdm(range(len(random_latitudes))):
-            start_time = time.clock()
-            kd_store.k_nearest_neighbors({'name': 'bla bla', 'age': 23, 'latitude': random_latitudes[i] / 2,
+            start_time = time.perf_counter()
+            self.k_nearest_neighbors({'name': 'bla bla', 'age': 23, 'latitude': random_latitudes[i] / 2,
                                           'longitude': random_longitudes[i]}, num_neighbors, age_proximity)
-            end_time = time.clock()
+            end_time = time.perf_counter()
             time_list.append(end_time - start_time)
 
         # get the timing statistics
@@ -743,18 +2616,45 @@ class KDTreeDataStore():
         print('\nStats:\n', stats_desc)
         return stats_desc
 
-    def server_mode(self, port):
+    def server_mode(self, port, num_workers=1, async_batching=False, batch_window=0.002, latency_slo=0.05):
         """Launches the store in server mode on the given port
 
         Args:
             port: port to serve on
+            num_workers: number of server processes. Several workers share the memory-mapped snapshot of the compact
+                index, serve the read endpoints only, and reload the snapshot when it is replaced (see
+                worker_server.serve_workers)
+            async_batching: serve /query only, from an asyncio event loop answering the concurrent queries in
+                micro-batches (see async_server.serve_async)
+            batch_window: with async_batching, maximum number of seconds a query waits for other queries
+            latency_slo: with async_batching, number of seconds within which a query should be answered
 
         Returns: None
 
+        """
+        if async_batching:
+            serve_async(self, port, batch_window=batch_window, latency_slo=latency_slo)
+        elif num_workers > 1:
+            serve_workers(self, port, num_workers)
+        else:
+            run(self.create_app(), host='0.0.0.0', port=port)
+
+    def create_app(self, read_only=False):
+        """Creates the bottle application serving the store's rest endpoints
+
+        Args:
+            read_only: leave out the endpoints that modify the index
+
+        Returns: bottle application
+
         """
 
         app = Bottle()
 
+        @app.hook('before_request')
+        def start_timer():
+            request.environ['geo_recommender.start_time'] = time.perf_counter()
+
         @app.hook('after_request')
         def enable_cors():
             """
@@ -765,29 +2665,36 @@ class KDTreeDataStore():
             response.headers[
                 'Access-Control-Allow-Headers'] = 'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token'
 
+        @app.hook('after_request')
+        def record_latency():
+            start_time = request.environ.get('geo_recommender.start_time')
+            if start_time is not None:
+                route = request.environ.get('bottle.route')
+                self.metrics.observe_request(route.rule if route is not None else 'unmatched',
+                                             time.perf_counter() - start_time)
+
         @app.route("/query", methods=['GET'])
         def query():
-            """Query resp endpoint, requires latitude, longitude, and age
+            """Query resp endpoint, requires latitude, longitude, and age. Optionally takes k (10 by default),
+            age_proximity (5 by default), and fields, a comma-separated subset of the neighbors' fields to return. The
+            response is encoded according to the Accept header (see query_response)
 
             Returns: sorted list of k nearest neighbors
 
             """
             try:
-                latitude = request.query['latitude']
-                longitude = request.query['longitude']
-                age = request.query['age']
-
-                latitude = float(latitude)
-                longitude = float(longitude)
-                age = int(age)
-
-                result = self.k_nearest_neighbors(
-                    {'name': 'bla bla', 'age': age, 'latitude': latitude, 'longitude': longitude}, 10, 5)
-
-                return {'result': result}
-
-            except:
-                return bottle.HTTPResponse(status=404, body='Error: you need latitude, longitude, and age parameters')
+                params = parse_query(request.query)
+            except ValueError as e:
+                return bottle.HTTPResponse(status=404, body='Error: ' + str(e))
+
+            recommendation = self.recommend({'name': 'bla bla', 'age': params['age'], 'latitude': params['latitude'],
+                                             'longitude': params['longitude']}, params['k'], params['age_proximity'])
+            start_time = time.perf_counter()
+            body, headers = encode_recommendation(recommendation, params['fields'], request.headers.get('Accept'))
+            self.metrics.observe_stage('encode', time.perf_counter() - start_time)
+            for name, value in headers.items():
+                response.set_header(name, value)
+            return body
 
         @app.route("/profile", methods=['GET'])
         def profile():
@@ -809,7 +2716,111 @@ class KDTreeDataStore():
                                            body="Error: you need the number of loops,the number of neighbors,"
                                                 "and the age proximity value.")
 
-        run(app, host='0.0.0.0', port=port)
+        @app.route("/cache_stats", methods=['GET'])
+        def cache_stats():
+            """Usage counters of the redis node cache and of the result cache
+
+            Returns: cache statistics (empty for the caches that are not used)
+
+            """
+            return {'node_cache': self.node_cache.stats() if self.node_cache is not None else {},
+                    'result_cache': self.result_cache.stats() if self.result_cache is not None else {}}
+
+        @app.route("/metrics", methods=['GET'])
+        def metrics():
+            """Latency percentiles of the endpoints and of the query stages, and per-query search counters, in the
+            Prometheus text format (see metrics.StoreMetrics)
+
+            Returns: metrics text
+
+            """
+            response.set_header('Content-Type', METRICS_CONTENT_TYPE)
+            return self.metrics.to_prometheus()
+
+        if not read_only:
+            @app.route("/item/<item_id>", method='DELETE')
+            def delete_item(item_id):
+                """Deletes a person
+
+                Returns: id of the deleted person
+
+                """
+                try:
+                    self.delete_item(item_id)
+                except KeyError:
+                    return bottle.HTTPResponse(status=404, body='Error: there is no person with id ' + item_id)
+                return {'id': item_id}
+
+            @app.route("/item/<item_id>/location", method='PUT')
+            def update_location(item_id):
+                """Moves a person, requires latitude and longitude
+
+                Returns: id and new location of the person
+
+                """
+                try:
+                    latitude = float(request.query['latitude'])
+                    longitude = float(request.query['longitude'])
+                except (KeyError, ValueError):
+                    return bottle.HTTPResponse(status=404, body='Error: you need latitude and longitude parameters')
+                try:
+                    self.update_location(item_id, latitude, longitude)
+                except KeyError:
+                    return bottle.HTTPResponse(status=404, body='Error: there is no person with id ' + item_id)
+                return {'id': item_id, 'latitude': latitude, 'longitude': longitude}
+
+        @app.route("/query_batch", method='POST')
+        def query_batch():
+            """Batch query rest endpoint (compact mode). The body is either a json object with latitudes, longitudes
+            and ages lists (and optionally k and age_proximity), or an application/octet-stream body holding a float64
+            array with one (latitude, longitude, age) row per target, with k and age_proximity in the query string
+
+            Returns: neighbors' ids and distances, as json lists (with -1 and null for missing neighbors) or, for
+                binary requests, as int64 indices followed by float64 distances, with the shape in X-Result-Shape
+
+            """
+            if not self.compact_mode:
+                return bottle.HTTPResponse(status=404, body='Error: /query_batch is only available in compact mode')
+            binary = request.content_type.startswith('application/octet-stream')
+            try:
+                if binary:
+                    targets = np.frombuffer(request.body.read(), dtype='<f8').reshape(-1, 3)
+                    latitudes, longitudes, ages = targets[:, 0], targets[:, 1], targets[:, 2]
+                    k = int(request.query.get('k', 10))
+                    age_proximity = int(request.query.get('age_proximity', 5))
+                else:
+                    body = request.json
+                    latitudes = np.array(body['latitudes'], dtype=np.float64)
+                    longitudes = np.array(body['longitudes'], dtype=np.float64)
+                    ages = np.array(body['ages'], dtype=np.int64)
+                    k = int(body.get('k', 10))
+                    age_proximity = int(body.get('age_proximity', 5))
+                if not len(latitudes) == len(longitudes) == len(ages):
+                    raise ValueError('the number of latitudes, longitudes, and ages should match')
+            except (KeyError, ValueError, TypeError, AttributeError):
+                return bottle.HTTPResponse(status=404, body='Error: you need latitudes, longitudes, and ages')
+            # the same bounds as /query, which also cap the memory of the (targets, k) result arrays
+            if not 0 < k <= MAX_K:
+                return bottle.HTTPResponse(status=404, body='Error: k should be between 1 and {}'.format(MAX_K))
+            if age_proximity < 0:
+                return bottle.HTTPResponse(status=404, body='Error: age_proximity should not be negative')
+            try:
+                check_coordinates(latitudes, longitudes)
+            except ValueError as e:
+                return bottle.HTTPResponse(status=404, body='Error: ' + str(e))
+
+            indices, distances = self.k_nearest_neighbors_batch(latitudes, longitudes, ages, k, age_proximity)
+            indices = self.node_store.get_ids(indices)
+
+            if binary:
+                return bottle.HTTPResponse(
+                    body=indices.astype('<i8').tobytes() + distances.astype('<f8').tobytes(),
+                    headers={'Content-Type': 'application/octet-stream',
+                             'X-Result-Shape': '{},{}'.format(*indices.shape)})
+            return {'indices': indices.tolist(),
+                    'distances': np.where(np.isfinite(distances), distances, None).tolist()}
+
+        return app
 
 
 if __name__ == '__main__':
@@ -818,20 +2829,83 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port', help='port to serve on', dest='port', default=5001, type=int)
     parser.add_argument('--redis_mode', action='store_true', help='activate redis mode', dest='redis_mode')
     parser.add_argument('--rebuild_index', action='store_true', help='rebuild index', dest='rebuild_index')
+    parser.add_argument('--build_workers', help='number of processes used to build the index', dest='build_workers',
+                        default=1, type=int)
+    parser.add_argument('--age_index', action='store_true',
+                        help='keep the age range of each subtree to prune the search by age', dest='age_index')
+    parser.add_argument('--compact_mode', action='store_true',
+                        help='store the nodes in compact numpy arrays (in-memory only)', dest='compact_mode')
+    parser.add_argument('--node_cache_size', help='number of redis nodes cached in memory', dest='node_cache_size',
+                        default=10000, type=int)
+    parser.add_argument('--result_cache_mb', help='memory of the cache of query results in MB (0 to disable)',
+                        dest='result_cache_mb', default=0, type=float)
+    parser.add_argument('--result_cache_grid', help='size of the cells the cached queries are quantized to, in degrees',
+                        dest='result_cache_grid', default=0.01, type=float)
+    parser.add_argument('--result_cache_ttl', help='number of seconds after which a cached query result expires',
+                        dest='result_cache_ttl', default=60.0, type=float)
+    parser.add_argument('--pinned_levels', help='number of top levels of the tree kept in memory in redis mode',
+                        dest='pinned_levels', default=10, type=int)
+    parser.add_argument('--redis_index', help='name of the index in redis (defaults to kd_tree_<size>)',
+                        dest='redis_index', default=None)
+    parser.add_argument('--bucket_size', help='size of the leaf buckets scanned at once in compact mode (0 to disable)',
+                        dest='bucket_size', default=0, type=int)
+    parser.add_argument('--max_visits', help='maximum number of nodes visited per query (approximate results beyond)',
+                        dest='max_visits', default=None, type=int)
+    parser.add_argument('--time_budget', help='maximum duration of a query in seconds (approximate results beyond)',
+                        dest='time_budget', default=None, type=float)
+    parser.add_argument('--max_radius', help='maximum distance of the neighbors returned by /query, in kilometers',
+                        dest='max_radius', default=None, type=float)
+    parser.add_argument('--max_age_widening',
+                        help='number of years by which /query can widen the age window when it finds too few people',
+                        dest='max_age_widening', default=0, type=int)
+    parser.add_argument('--engine', help='index engine: k-d tree, or grid of cells (in-memory only)', dest='engine',
+                        choices=['kd_tree', 'grid'], default='kd_tree')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='load and save the binary snapshot of the compact index', dest='use_snapshot')
+    parser.add_argument('--workers',
+                        help='number of server processes sharing the snapshot of the compact index (read-only)',
+                        dest='workers', default=1, type=int)
+    parser.add_argument('--async_batching', action='store_true',
+                        help='serve /query from an asyncio event loop, answering the concurrent queries in batches',
+                        dest='async_batching')
+    parser.add_argument('--batch_window', help='with --async_batching, maximum wait of a query for a batch in seconds',
+                        dest='batch_window', default=0.002, type=float)
+    parser.add_argument('--latency_slo', help='with --async_batching, target duration of a query in seconds',
+                        dest='latency_slo', default=0.05, type=float)
 
     args = parser.parse_args()
+    if args.engine == 'grid' and args.workers > 1:
+        parser.error('--workers needs the snapshot of the k-d tree, which the grid engine does not have')
 
     print('generating index for data of size ', args.size)
 
-    kd_store = KDTreeDataStore(rebuild_index=args.rebuild_index, redis_mode=args.redis_mode, size=args.size,
-                               data_in_parallel=False)
+    if args.engine == 'grid':
+        from data_store.grid_store import GridDataStore
+
+        kd_store = GridDataStore(size=args.size, data_in_parallel=False, max_visits=args.max_visits,
+                                 time_budget=args.time_budget, max_radius=args.max_radius,
+                                 max_age_widening=args.max_age_widening,
+                                 result_cache_bytes=int(args.result_cache_mb * 2 ** 20),
+                                 result_cache_grid=args.result_cache_grid, result_cache_ttl=args.result_cache_ttl)
+    else:
+        kd_store = KDTreeDataStore(rebuild_index=args.rebuild_index, redis_mode=args.redis_mode, size=args.size,
+                                   data_in_parallel=False, compact_mode=args.compact_mode,
+                                   build_workers=args.build_workers, age_index=args.age_index,
+                                   use_snapshot=args.use_snapshot, node_cache_size=args.node_cache_size,
+                                   pinned_levels=args.pinned_levels, redis_index=args.redis_index,
+                                   bucket_size=args.bucket_size, max_visits=args.max_visits,
+                                   time_budget=args.time_budget, max_radius=args.max_radius,
+                                   max_age_widening=args.max_age_widening,
+                                   result_cache_bytes=int(args.result_cache_mb * 2 ** 20),
+                                   result_cache_grid=args.result_cache_grid, result_cache_ttl=args.result_cache_ttl)
 
     print('\ndone creating index\n')
 
     print('running initial time profiling for k-nearest neighbors: ')
     kd_store.run_profiling(100, 10, 5)
 
-    kd_store.server_mode(args.port)
+    kd_store.server_mode(args.port, num_workers=args.workers, async_batching=args.async_batching,
+                         batch_window=args.batch_window, latency_slo=args.latency_slo)
     #
     # if simple_test:
     #     data_list = [
@@ -0,0 +1,281 @@
+"""Always-on instrumentation of the store: latency histograms of the rest endpoints and of the search stages, and the
+per-query counters of the k nearest neighbors searches, served in the Prometheus text format at /metrics.
+
+The histograms have log-linear buckets, like HdrHistogram: the values below 2 ** sub_bucket_bits are counted exactly,
+and every power of two above is split in 2 ** (sub_bucket_bits - 1) buckets, so that a percentile is known within about
+3% whatever its magnitude, in a few kilobytes. Recording a value is a couple of integer operations, which keeps the
+instrumentation cheap enough to leave on. The histograms are exported as Prometheus summaries (quantiles, sum, and
+count), and cover the whole life of the process.
+
+The forked workers of worker_server each record their own requests. They share their histograms through files in a
+common directory (see StoreMetrics.share), and the worker that answers /metrics adds up the histograms of all of them,
+so that a scrape gets the metrics of the whole server whichever worker it lands on.
+"""
+import glob
+import os
+import pickle
+import threading
+
+# quantiles exported for every histogram
+QUANTILES = (0.5, 0.95, 0.99, 0.999)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class LogHistogram:
+    """Histogram of non-negative integers with log-linear buckets"""
+
+    def __init__(self, sub_bucket_bits=6, max_value_bits=40):
+        """
+        Args:
+            sub_bucket_bits: number of bits of precision of the buckets
+            max_value_bits: the values are capped below 2 ** max_value_bits
+        """
+        self.sub_bucket_bits = sub_bucket_bits
+        self.max_value = 2 ** max_value_bits - 1
+        self._half_count = 2 ** (sub_bucket_bits - 1)
+        self.counts = [0] * self._bucket_index(self.max_value) + [0]
+        self.count = 0
+        self.total = 0
+
+    def _bucket_index(self, value):
+        """Bucket of a value
+
+        Args:
+            value: non-negative integer, at most max_value
+
+        Returns: bucket index
+
+        """
+        shift = value.bit_length() - self.sub_bucket_bits
+        if shift <= 0:
+            return value
+        return (shift + 1) * self._half_count + (value >> shift) - self._half_count
+
+    def _bucket_upper_bound(self, index):
+        """Largest value counted in a bucket
+
+        Args:
+            index: bucket index
+
+        Returns: value
+
+        """
+        if index < 2 * self._half_count:
+            return index
+        shift, offset = divmod(index - 2 * self._half_count, self._half_count)
+        return ((self._half_count + offset + 1) << (shift + 1)) - 1
+
+    def record(self, value):
+        """Counts a value
+
+        Args:
+            value: non-negative integer. Larger values than max_value are counted as max_value
+
+        Returns: None
+
+        """
+        value = min(max(int(value), 0), self.max_value)
+        self.counts[self._bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, quantile):
+        """Value below which the given fraction of the recorded values are
+
+        Args:
+            quantile: fraction between 0 and 1
+
+        Returns: upper bound of the bucket holding the quantile, or 0 without any value
+
+        """
+        if not self.count:
+            return 0
+        rank = max(quantile * self.count, 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self._bucket_upper_bound(index)
+        return self.max_value
+
+    def merge(self, other):
+        """Adds the values counted by another histogram with the same buckets
+
+        Args:
+            other: LogHistogram
+
+        Returns: None
+
+        """
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+
+
+class SearchCounters:
+    """Work done by a k nearest neighbors search, filled in by the search helpers"""
+    __slots__ = ('visited', 'pruned')
+
+    def __init__(self):
+        self.visited = 0
+        self.pruned = 0
+
+
+class StoreMetrics:
+    """Latency histograms and query counters of a store"""
+
+    # per-query counters, with their help text
+    query_counters = (('nodes_visited', 'Nodes (or people, in the grid and the leaf buckets) scanned by a query'),
+                      ('nodes_pruned', 'Subtrees of the k-d tree skipped by the distance or age bounds in a query'),
+                      ('queue_pushes', 'Candidates pushed to the bounded priority queue by a query'),
+                      ('redis_round_trips', 'Redis round trips of a query'))
+
+    def __init__(self, prefix='geo_recommender'):
+        """
+        Args:
+            prefix: prefix of the metric names
+        """
+        self.prefix = prefix
+        # latencies in microseconds, by endpoint and by search stage
+        self.request_latencies = {}
+        self.stage_latencies = {}
+        self.queries = {name: LogHistogram() for name, _ in self.query_counters}
+        self._lock = threading.Lock()
+        # directory and file of the metrics shared between processes (see share)
+        self.shared_directory = None
+        self.shared_filename = None
+
+    def observe_request(self, endpoint, seconds):
+        """Records the latency of a request
+
+        Args:
+            endpoint: route of the request
+            seconds: duration of the request
+
+        Returns: None
+
+        """
+        with self._lock:
+            histogram = self.request_latencies.get(endpoint)
+            if histogram is None:
+                histogram = self.request_latencies[endpoint] = LogHistogram()
+            histogram.record(seconds * 1e6)
+
+    def observe_stage(self, stage, seconds):
+        """Records the duration of a stage of the queries (search, cache hit, batch search, encoding)
+
+        Args:
+            stage: name of the stage
+            seconds: duration of the stage
+
+        Returns: None
+
+        """
+        with self._lock:
+            histogram = self.stage_latencies.get(stage)
+            if histogram is None:
+                histogram = self.stage_latencies[stage] = LogHistogram()
+            histogram.record(seconds * 1e6)
+
+    def observe_query(self, nodes_visited, nodes_pruned, queue_pushes, redis_round_trips):
+        """Records the counters of a k nearest neighbors search
+
+        Args:
+            nodes_visited: nodes scanned
+            nodes_pruned: subtrees skipped
+            queue_pushes: candidates pushed to the queue
+            redis_round_trips: redis round trips
+
+        Returns: None
+
+        """
+        with self._lock:
+            self.queries['nodes_visited'].record(nodes_visited)
+            self.queries['nodes_pruned'].record(nodes_pruned)
+            self.queries['queue_pushes'].record(queue_pushes)
+            self.queries['redis_round_trips'].record(redis_round_trips)
+
+    def share(self, directory, name=None):
+        """Shares the metrics with the other processes serving the same index: they are saved to a file of their own
+        in directory (see save_shared), and to_prometheus adds up the metrics of all the files there. The files of the
+        processes that exited are kept, so that the totals never go down
+
+        Args:
+            directory: directory of the shared metrics
+            name: (optional) name of the file of these metrics. Defaults to the process id
+
+        Returns: None
+
+        """
+        self.shared_directory = directory
+        self.shared_filename = os.path.join(directory, '{}.metrics'.format(name or os.getpid()))
+        self.save_shared()
+
+    def save_shared(self):
+        """Saves the metrics to their file in the shared directory, which is replaced atomically, so that the other
+        processes never read a partial file. Does nothing when the metrics are not shared
+
+        Returns: None
+
+        """
+        if self.shared_directory is None:
+            return
+        with self._lock:
+            data = pickle.dumps((self.request_latencies, self.stage_latencies, self.queries))
+        temp_filename = self.shared_filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(temp_filename, self.shared_filename)
+
+    def _merge_shared(self):
+        """Adds up the metrics saved in the shared directory, these ones included
+
+        Returns: StoreMetrics with the totals
+
+        """
+        self.save_shared()
+        totals = StoreMetrics(prefix=self.prefix)
+        for filename in sorted(glob.glob(os.path.join(self.shared_directory, '*.metrics'))):
+            with open(filename, 'rb') as f:
+                request_latencies, stage_latencies, queries = pickle.load(f)
+            for total_histograms, histograms in ((totals.request_latencies, request_latencies),
+                                                 (totals.stage_latencies, stage_latencies),
+                                                 (totals.queries, queries)):
+                for key, histogram in histograms.items():
+                    total_histograms.setdefault(key, LogHistogram()).merge(histogram)
+        return totals
+
+    def to_prometheus(self):
+        """Formats the metrics in the Prometheus text exposition format. Shared metrics (see share) are added up
+        over all the processes
+
+        Returns: text of the metrics
+
+        """
+        if self.shared_directory is not None:
+            return self._merge_shared()._format_prometheus()
+        return self._format_prometheus()
+
+    def _format_prometheus(self):
+        lines = []
+
+        def add_summary(name, help_text, label, histograms, scale):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} summary'.format(name))
+            for label_value, histogram in sorted(histograms.items()):
+                labels = '{}="{}",'.format(label, label_value) if label else ''
+                for quantile in QUANTILES:
+                    lines.append('{}{{{}quantile="{}"}} {}'.format(name, labels, quantile,
+                                                                   repr(histogram.percentile(quantile) * scale)))
+                labels = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+                lines.append('{}_sum{} {}'.format(name, labels, repr(histogram.total * scale)))
+                lines.append('{}_count{} {}'.format(name, labels, histogram.count))
+
+        with self._lock:
+            add_summary(self.prefix + '_request_seconds', 'Latency of the rest endpoints', 'endpoint',
+                        self.request_latencies, 1e-6)
+            add_summary(self.prefix + '_stage_seconds', 'Duration of the stages of the queries', 'stage',
+                        self.stage_latencies, 1e-6)
+            for name, help_text in self.query_counters:
+                add_summary(self.prefix + '_query_' + name, help_text, None, {'': self.queries[name]}, 1)
+        return '\n'.join(lines) + '\n'
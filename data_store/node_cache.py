@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+
+class NodeCache:
+    """Bounded in-process cache of the nodes read from redis.
+
+    Pinned nodes (typically the top levels of the tree, which every query goes through) are never evicted. The other
+    nodes are kept in least recently used order, up to capacity. The cache is written through: every node written by
+    the store replaces its cached copy, so that updated child links are seen by the next reads. Writes made to redis by
+    other processes are not seen here: the store drops the cache when the write epoch of the index moves on (see
+    KDTreeDataStore._get_redis_root_id).
+    """
+
+    def __init__(self, capacity=10000):
+        """
+        Args:
+            capacity: maximum number of (non pinned) nodes kept
+        """
+        self.capacity = capacity
+        self._pinned = {}
+        self._lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._pinned) + len(self._lru)
+
+    def get(self, node_id):
+        """Gets a cached node, counting the hit or miss
+
+        Args:
+            node_id: node id
+
+        Returns: node dictionary, or None if the node is not cached
+
+        """
+        node = self._pinned.get(node_id)
+        if node is None:
+            node = self._lru.get(node_id)
+            if node is not None:
+                self._lru.move_to_end(node_id)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return node
+
+    def put(self, node):
+        """Adds or replaces a node, evicting the least recently used nodes beyond capacity
+
+        Args:
+            node: node dictionary
+
+        Returns: None
+
+        """
+        node_id = node['id']
+        if node_id in self._pinned:
+            self._pinned[node_id] = node
+            return
+        if self.capacity <= 0:
+            return
+        self._lru[node_id] = node
+        self._lru.move_to_end(node_id)
+        while len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+            self.evictions += 1
+
+    def pin(self, node):
+        """Adds a node that is never evicted
+
+        Args:
+            node: node dictionary
+
+        Returns: None
+
+        """
+        self._lru.pop(node['id'], None)
+        self._pinned[node['id']] = node
+
+    def invalidate(self, node_id=None):
+        """Drops a node from the cache, or all the nodes
+
+        Args:
+            node_id: (optional) id of the node to drop. Defaults to all the nodes
+
+        Returns: None
+
+        """
+        if node_id is None:
+            self._pinned.clear()
+            self._lru.clear()
+        else:
+            self._pinned.pop(node_id, None)
+            self._lru.pop(node_id, None)
+
+    def stats(self):
+        """Usage counters of the cache
+
+        Returns: dictionary with the hits, misses, hit_rate, evictions, and the numbers of pinned and cached nodes
+
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'pinned': len(self._pinned),
+                'cached': len(self._lru)}
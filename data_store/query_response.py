@@ -0,0 +1,178 @@
+"""Parameters and encodings of the /query endpoint, shared by the bottle application and the asyncio server.
+
+The neighbors are encoded according to the Accept header of the request:
+
+- application/json (default): the recommendation dictionary, serialized with orjson when it is installed, or with the
+  standard json module and compact separators otherwise
+- application/msgpack (or application/x-msgpack), when msgpack is installed: the same dictionary in msgpack
+- application/octet-stream: the requested fields as packed little-endian columns, one after the other. The distances
+  and coordinates are float64 arrays, the ages an int64 array, and the names n + 1 int32 byte offsets followed by the
+  utf-8 bytes of the names. The X-Result-Count and X-Result-Fields headers give the number of neighbors and the order
+  of the columns, and X-Exact, X-Partial and X-Age-Proximity the rest of the recommendation
+"""
+import json
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+QUERY_FIELDS = ('distance', 'latitude', 'longitude', 'name', 'age')
+# largest k accepted by /query, which bounds the work and the memory of a single request
+MAX_K = 10000
+MISSING_PARAMETERS = 'you need latitude, longitude, and age parameters'
+
+_column_dtypes = {'distance': '<f8', 'latitude': '<f8', 'longitude': '<f8', 'age': '<i8'}
+_msgpack_types = ('application/msgpack', 'application/x-msgpack')
+
+
+def check_coordinates(latitudes, longitudes):
+    """Checks that the coordinates of targets are finite and within the bounds of latitudes and longitudes, as the
+    searches would otherwise return nan distances (which json cannot encode)
+
+    Args:
+        latitudes: latitude, or numpy array of latitudes
+        longitudes: longitude, or numpy array of longitudes
+
+    Returns: None
+
+    Raises: ValueError describing the invalid coordinate
+
+    """
+    # the comparisons with nan are false
+    if not np.all(np.abs(latitudes) <= 90):
+        raise ValueError('latitude should be between -90 and 90')
+    if not np.all(np.abs(longitudes) <= 180):
+        raise ValueError('longitude should be between -180 and 180')
+
+
+def parse_query(params, default_k=10, default_age_proximity=5):
+    """Reads the parameters of a /query request
+
+    Args:
+        params: mapping of the query string parameters to their (string) values
+        default_k: number of neighbors when k is not given
+        default_age_proximity: age proximity when age_proximity is not given
+
+    Returns: dictionary with the latitude, longitude, age, k, age_proximity, and the tuple of fields to return
+
+    Raises: ValueError describing the invalid or missing parameter
+
+    """
+    try:
+        latitude = float(params['latitude'])
+        longitude = float(params['longitude'])
+        age = int(params['age'])
+    except KeyError:
+        raise ValueError(MISSING_PARAMETERS)
+    check_coordinates(latitude, longitude)
+    k = int(params.get('k', default_k))
+    age_proximity = int(params.get('age_proximity', default_age_proximity))
+    if not 0 < k <= MAX_K:
+        raise ValueError('k should be between 1 and {}'.format(MAX_K))
+    if age_proximity < 0:
+        raise ValueError('age_proximity should not be negative')
+
+    fields = params.get('fields')
+    if fields:
+        fields = tuple(field.strip() for field in fields.split(','))
+        unknown = [field for field in fields if field not in QUERY_FIELDS]
+        if unknown:
+            raise ValueError('unknown fields: {} (available: {})'.format(', '.join(unknown), ', '.join(QUERY_FIELDS)))
+    else:
+        fields = QUERY_FIELDS
+    return {'latitude': latitude, 'longitude': longitude, 'age': age, 'k': k, 'age_proximity': age_proximity,
+            'fields': fields}
+
+
+def dump_json(obj):
+    """Serializes an object to json
+
+    Args:
+        obj: json serializable object
+
+    Returns: utf-8 encoded json bytes
+
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def accepted_encoding(accept):
+    """Chooses the encoding of a response from the Accept header of the request, in the order of preference of the
+    client
+
+    Args:
+        accept: value of the Accept header (possibly empty)
+
+    Returns: 'json', 'msgpack' or 'packed'
+
+    """
+    media_types = []
+    for position, media_range in enumerate((accept or '').split(',')):
+        media_type, _, parameters = media_range.partition(';')
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            name, _, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        media_types.append((-quality, position, media_type.strip().lower()))
+
+    for _, _, media_type in sorted(media_types):
+        if media_type in ('application/json', 'application/*', '*/*'):
+            return 'json'
+        if media_type in _msgpack_types and msgpack is not None:
+            return 'msgpack'
+        if media_type == 'application/octet-stream':
+            return 'packed'
+    return 'json'
+
+
+def encode_recommendation(recommendation, fields=QUERY_FIELDS, accept=None):
+    """Encodes the response of a /query request
+
+    Args:
+        recommendation: dictionary returned by KDTreeDataStore.recommend
+        fields: fields of the neighbors to return
+        accept: (optional) value of the Accept header of the request
+
+    Returns: (body bytes, headers dictionary) tuple
+
+    """
+    neighbors = recommendation['result']
+    encoding = accepted_encoding(accept)
+
+    if encoding == 'packed':
+        columns = []
+        for field in fields:
+            if field == 'name':
+                names = [neighbor['name'].encode('utf-8') for neighbor in neighbors]
+                offsets = np.zeros(len(names) + 1, dtype='<i4')
+                np.cumsum([len(name) for name in names], out=offsets[1:])
+                columns += [offsets.tobytes(), b''.join(names)]
+            else:
+                columns.append(np.array([neighbor[field] for neighbor in neighbors],
+                                        dtype=_column_dtypes[field]).tobytes())
+        return b''.join(columns), {'Content-Type': 'application/octet-stream',
+                                   'X-Result-Count': str(len(neighbors)),
+                                   'X-Result-Fields': ','.join(fields),
+                                   'X-Exact': str(bool(recommendation['exact'])).lower(),
+                                   'X-Partial': str(bool(recommendation['partial'])).lower(),
+                                   'X-Age-Proximity': str(recommendation['age_proximity'])}
+
+    if fields != QUERY_FIELDS:
+        neighbors = [{field: neighbor[field] for field in fields} for neighbor in neighbors]
+    response = dict(recommendation, result=neighbors)
+    if encoding == 'msgpack':
+        return msgpack.packb(response), {'Content-Type': 'application/msgpack'}
+    return dump_json(response), {'Content-Type': 'application/json'}
@@ -0,0 +1,146 @@
+import struct
+from multiprocessing.pool import ThreadPool
+
+# fixed part of a packed node: latitude, longitude, age (-1 - age for the tombstones of deleted nodes), subtree
+# age_min and age_max (-1 without the age index), then the byte lengths of the name, left_id and right_id strings that
+# follow it
+_NODE_HEADER = struct.Struct('<ddhhhHHH')
+
+
+def pack_node(node):
+    """Encodes a node dictionary into bytes
+
+    Args:
+        node: node dictionary (name, age, latitude, longitude, left_id, right_id, and optionally age_min, age_max and
+            deleted)
+
+    Returns: packed bytes
+
+    """
+    name = node['name'].encode('utf-8')
+    left_id = (node['left_id'] or '').encode('utf-8')
+    right_id = (node['right_id'] or '').encode('utf-8')
+    age = -1 - node['age'] if node.get('deleted') else node['age']
+    return _NODE_HEADER.pack(node['latitude'], node['longitude'], age, node.get('age_min', -1),
+                             node.get('age_max', -1), len(name), len(left_id), len(right_id)) + name + left_id + right_id
+
+
+def unpack_node(node_id, data):
+    """Decodes a node packed by pack_node
+
+    Args:
+        node_id: id of the node
+        data: packed bytes
+
+    Returns: node dictionary, with None for the missing children, and deleted set for the tombstones
+
+    """
+    latitude, longitude, age, age_min, age_max, name_length, left_length, right_length = _NODE_HEADER.unpack_from(data)
+    name_end = _NODE_HEADER.size + name_length
+    left_end = name_end + left_length
+    node = {'id': node_id,
+            'name': data[_NODE_HEADER.size:name_end].decode('utf-8'),
+            'age': age if age >= 0 else -1 - age,
+            'latitude': latitude,
+            'longitude': longitude,
+            'left_id': data[name_end:left_end].decode('utf-8') or None,
+            'right_id': data[left_end:left_end + right_length].decode('utf-8') or None}
+    if age_min >= 0:
+        node['age_min'] = age_min
+        node['age_max'] = age_max
+    if age < 0:
+        node['deleted'] = True
+    return node
+
+
+class RedisNodeStore:
+    """Access layer for the k-d tree nodes kept in redis.
+
+    Each node is stored as one packed string (see pack_node) under key_prefix + node id, so that a node is read with a
+    single GET and decoded without parsing strings, and any number of nodes are read in one round trip with MGET.
+    """
+
+    def __init__(self, r_server, key_prefix='node:'):
+        """
+        Args:
+            r_server: redis client, without decode_responses
+            key_prefix: prefix of the node keys
+        """
+        self.r_server = r_server
+        self.key_prefix = key_prefix
+        # number of commands sent to redis, for the query instrumentation
+        self.round_trips = 0
+
+    def node_key(self, node_id):
+        return self.key_prefix + node_id
+
+    def get_nodes(self, node_ids):
+        """Fetches several nodes in one round trip
+
+        Args:
+            node_ids: list of node ids
+
+        Returns: list of node dictionaries, in the order of node_ids
+
+        """
+        if not node_ids:
+            return []
+        values = self.r_server.mget([self.node_key(node_id) for node_id in node_ids])
+        self.round_trips += 1
+        nodes = []
+        for node_id, value in zip(node_ids, values):
+            if value is None:
+                raise KeyError(node_id)
+            nodes.append(unpack_node(node_id, value))
+        return nodes
+
+    def get_node(self, node_id):
+        """Fetches one node
+
+        Args:
+            node_id: node id
+
+        Returns: node dictionary
+
+        """
+        return self.get_nodes([node_id])[0]
+
+    def set_node(self, node, pipeline=None):
+        """Writes a node
+
+        Args:
+            node: node dictionary
+            pipeline: (optional) redis pipeline to queue the write to, instead of sending it right away
+
+        Returns: None
+
+        """
+        (pipeline or self.r_server).set(self.node_key(node['id']), pack_node(node))
+        if pipeline is None:
+            self.round_trips += 1
+
+    def set_nodes_bulk(self, nodes, chunk_size=10000, num_connections=4, pbar=None):
+        """Writes many nodes at once. The nodes are packed and sent in chunks of chunk_size with one MSET each, and the
+        chunks are spread over num_connections concurrent connections, so that packing the next chunks overlaps with
+        the network transfer of the previous ones
+
+        Args:
+            nodes: list of node dictionaries
+            chunk_size: number of nodes written per command
+            num_connections: number of chunks written concurrently
+            pbar: (optional) progress bar object
+
+        Returns: None
+
+        """
+        def write_chunk(start):
+            chunk = nodes[start:start + chunk_size]
+            self.r_server.mset({self.node_key(node['id']): pack_node(node) for node in chunk})
+            return len(chunk)
+
+        self.round_trips += -(-len(nodes) // chunk_size)
+        # the client's connection pool gives each thread its own connection
+        with ThreadPool(max(num_connections, 1)) as pool:
+            for num_written in pool.imap_unordered(write_chunk, range(0, len(nodes), chunk_size)):
+                if pbar is not None:
+                    pbar.update(num_written)
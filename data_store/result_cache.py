@@ -0,0 +1,278 @@
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utilities.distance_kernels import haversine_distances
+from utilities.geo_utils import haversine_distance
+
+
+class ResultCache:
+    """Bounded in-process cache of k nearest neighbors results, for the queries repeated from nearly the same place.
+
+    The targets are quantized to cells of grid_degrees x grid_degrees: the queries from the same cell, with the same
+    age and search parameters, share an entry. The neighbors of a cached entry are the ones found for the first target
+    of its cell, with their distances computed again for each target, so they can differ slightly from the exact
+    neighbors of another target in the cell. The entries expire after ttl seconds, and the least recently used entries
+    are evicted beyond max_bytes (estimated from the size of the result dictionaries).
+
+    The cache does not follow the index by itself: the store invalidates it for every person inserted, deleted or moved
+    (see invalidate). This drops the entries of the cells that could have the person among their neighbors, i.e. the
+    cells closer to the person than the k-th neighbor of one of their entries, with an age window containing the
+    person's age.
+    """
+
+    # beyond this many people times cached cells, an invalidation clears the whole cache instead of testing the cells
+    max_invalidation_tests = 10 ** 7
+
+    def __init__(self, max_bytes=2 ** 26, grid_degrees=0.01, ttl=60.0):
+        """
+        Args:
+            max_bytes: approximate maximum memory used by the cached results
+            grid_degrees: size of the cells the targets are quantized to, in degrees of latitude and longitude
+            ttl: number of seconds after which an entry expires
+        """
+        self.max_bytes = max_bytes
+        self.grid_degrees = grid_degrees
+        self.ttl = ttl
+        # a target is at most this far (in kilometers) from the center of its cell, the widest cells being at the
+        # equator
+        self._cell_radius = haversine_distance(0, 0, grid_degrees / 2, grid_degrees / 2)
+        self._entries = OrderedDict()
+        self._cell_keys = {}
+        # per cached cell: slot in the arrays below, which bound the entries of the cell for the invalidations
+        self._cell_slots = {}
+        self._free_slots = []
+        self._slot_latitudes = np.zeros(0)
+        self._slot_longitudes = np.zeros(0)
+        self._slot_reaches = np.zeros(0)
+        self._slot_age_min = np.zeros(0)
+        self._slot_age_max = np.zeros(0)
+        self._slot_used = np.zeros(0, dtype=bool)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, target_item, k, age_proximity, max_radius=None, max_visits=None):
+        """Gets the cached neighbors of the target's cell, counting the hit or miss
+
+        Args:
+            target_item: user node
+            k: number of neighbors
+            age_proximity: maximum difference between a candidate neighbor's age and the user
+            max_radius: (optional) maximum distance of the neighbors, as passed to the search
+            max_visits: (optional) maximum number of nodes visited, as passed to the search
+
+        Returns: (list of neighbors sorted by distance to the target, exact) tuple, or None if there is no valid entry.
+            Only the target the entry was cached for gets its exactness: the neighbors given to another target of the
+            cell can miss closer people, and are never exact
+
+        """
+        key = self._key(target_item, k, age_proximity, max_radius, max_visits)
+        entry = self._entries.get(key)
+        if entry is not None and entry['expires'] <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        if (target_item['latitude'], target_item['longitude']) == entry['target']:
+            return [dict(neighbor) for neighbor in entry['result']], entry['exact']
+        result = []
+        for neighbor in entry['result']:
+            distance = haversine_distance(target_item['latitude'], target_item['longitude'], neighbor['latitude'],
+                                          neighbor['longitude'])
+            if max_radius is None or distance <= max_radius:
+                result.append(dict(neighbor, distance=distance))
+        result.sort(key=lambda l: l['distance'])
+        return result, False
+
+    def put(self, target_item, k, age_proximity, result, exact, max_radius=None, max_visits=None):
+        """Caches the neighbors found for the target, evicting the least recently used entries beyond max_bytes
+
+        Args:
+            target_item: user node
+            k: number of neighbors
+            age_proximity: maximum difference between a candidate neighbor's age and the user
+            result: list of neighbors, sorted by distance to the target
+            exact: whether the search was exact
+            max_radius: (optional) maximum distance of the neighbors, as passed to the search
+            max_visits: (optional) maximum number of nodes visited, as passed to the search
+
+        Returns: None
+
+        """
+        key = self._key(target_item, k, age_proximity, max_radius, max_visits)
+        if key in self._entries:
+            self._drop(key)
+        # a person closer to the target than its k-th neighbor is at most this far from the center of its cell
+        if len(result) < k:
+            reach = np.inf if max_radius is None else max_radius + self._cell_radius
+        else:
+            reach = result[-1]['distance'] + self._cell_radius
+        nbytes = sys.getsizeof(result) + sum(sys.getsizeof(neighbor) + sys.getsizeof(neighbor['name'])
+                                             for neighbor in result)
+        if nbytes > self.max_bytes:
+            return
+
+        self._entries[key] = {'result': [dict(neighbor) for neighbor in result], 'exact': exact, 'nbytes': nbytes,
+                              'target': (target_item['latitude'], target_item['longitude']),
+                              'expires': time.monotonic() + self.ttl}
+        self.nbytes += nbytes
+        cell = key[:2]
+        self._cell_keys.setdefault(cell, set()).add(key)
+        self._bound_cell(cell, reach, target_item['age'] - age_proximity, target_item['age'] + age_proximity)
+
+        while self.nbytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, latitudes, longitudes, ages):
+        """Drops the entries of the cells that could have any of the given people among their neighbors. Called for the
+        people inserted in, deleted from, or moved in the index (at their former and new locations)
+
+        Args:
+            latitudes: people's latitudes
+            longitudes: people's longitudes
+            ages: people's ages
+
+        Returns: None
+
+        """
+        latitudes, longitudes, ages = np.atleast_1d(latitudes, longitudes, ages)
+        if not self._cell_slots or not len(latitudes):
+            return
+        if len(latitudes) * len(self._slot_used) > self.max_invalidation_tests:
+            self.invalidations += len(self._entries)
+            self.clear()
+            return
+
+        affected = np.zeros(len(self._slot_used), dtype=bool)
+        for latitude, longitude, age in zip(latitudes, longitudes, ages):
+            affected |= ((self._slot_age_min <= age) & (age <= self._slot_age_max) &
+                         (haversine_distances(latitude, longitude, self._slot_latitudes, self._slot_longitudes)
+                          <= self._slot_reaches))
+        affected &= self._slot_used
+        if not affected.any():
+            return
+        affected_slots = set(np.flatnonzero(affected).tolist())
+        for cell in [cell for cell, slot in self._cell_slots.items() if slot in affected_slots]:
+            for key in list(self._cell_keys[cell]):
+                self._drop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        """Drops all the entries
+
+        Returns: None
+
+        """
+        self._entries.clear()
+        self._cell_keys.clear()
+        self._cell_slots.clear()
+        self._free_slots = list(range(len(self._slot_used)))
+        self._slot_used[:] = False
+        self.nbytes = 0
+
+    def stats(self):
+        """Usage counters of the cache
+
+        Returns: dictionary with the hits, misses, hit_rate, expirations, evictions, invalidations, and the number and
+            estimated size of the cached entries
+
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'cached': len(self._entries),
+                'nbytes': self.nbytes}
+
+    def _key(self, target_item, k, age_proximity, max_radius, max_visits):
+        """Cache key of a query
+
+        Returns: (cell row, cell column, age, k, age_proximity, max_radius, max_visits) tuple
+
+        """
+        return (int(np.floor(target_item['latitude'] / self.grid_degrees)),
+                int(np.floor(target_item['longitude'] / self.grid_degrees)),
+                int(target_item['age']), k, age_proximity, max_radius, max_visits)
+
+    def _bound_cell(self, cell, reach, age_min, age_max):
+        """Widens the bounds of a cell's entries with those of a new entry
+
+        Args:
+            cell: (row, column) tuple
+            reach: distance from the cell's center within which a person can be a neighbor of the entry
+            age_min: lowest age of the entry's neighbors
+            age_max: highest age of the entry's neighbors
+
+        Returns: None
+
+        """
+        slot = self._cell_slots.get(cell)
+        if slot is None:
+            if not self._free_slots:
+                self._grow_slots()
+            slot = self._free_slots.pop()
+            self._cell_slots[cell] = slot
+            self._slot_latitudes[slot] = (cell[0] + 0.5) * self.grid_degrees
+            self._slot_longitudes[slot] = (cell[1] + 0.5) * self.grid_degrees
+            self._slot_reaches[slot] = reach
+            self._slot_age_min[slot] = age_min
+            self._slot_age_max[slot] = age_max
+            self._slot_used[slot] = True
+            return
+        self._slot_reaches[slot] = max(self._slot_reaches[slot], reach)
+        self._slot_age_min[slot] = min(self._slot_age_min[slot], age_min)
+        self._slot_age_max[slot] = max(self._slot_age_max[slot], age_max)
+
+    def _grow_slots(self):
+        """Doubles the number of cell slots
+
+        Returns: None
+
+        """
+        size = len(self._slot_used)
+        new_size = max(2 * size, 64)
+        for name in ('_slot_latitudes', '_slot_longitudes', '_slot_reaches', '_slot_age_min', '_slot_age_max',
+                     '_slot_used'):
+            array = getattr(self, name)
+            grown = np.zeros(new_size, dtype=array.dtype)
+            grown[:size] = array
+            setattr(self, name, grown)
+        self._free_slots.extend(range(new_size - 1, size - 1, -1))
+
+    def _drop(self, key):
+        """Drops an entry, and frees the slot of its cell if it was the cell's last entry
+
+        Args:
+            key: entry key
+
+        Returns: None
+
+        """
+        entry = self._entries.pop(key)
+        self.nbytes -= entry['nbytes']
+        cell = key[:2]
+        keys = self._cell_keys[cell]
+        keys.discard(key)
+        if not keys:
+            del self._cell_keys[cell]
+            slot = self._cell_slots.pop(cell)
+            self._slot_used[slot] = False
+            self._free_slots.append(slot)
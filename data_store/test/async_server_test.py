@@ -0,0 +1,118 @@
+import asyncio
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from data_store.async_server import AsyncQueryServer, QueryBatcher
+from data_store.kd_tree_store import KDTreeDataStore
+from data_store.test.kd_tree_store_test import generate_data_list
+
+
+class AsyncServerTest(unittest.TestCase):
+    def setUp(self):
+        self.kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=generate_data_list(2000),
+                                        compact_mode=True, bucket_size=32)
+        self.targets = [(10.0 * (i % 9 - 4), 20.0 * (i % 7 - 3), 20 + i % 50) for i in range(50)]
+        # nobody is this old: recommend has to widen the age window
+        self.targets.append((10.0, 20.0, 500))
+
+    def expected_names(self, latitude, longitude, age):
+        return [item['name'] for item in self.kd_store.recommend(
+            {'latitude': latitude, 'longitude': longitude, 'age': age}, 10, 5)['result']]
+
+    def test_concurrent_queries_are_batched(self):
+        batcher = QueryBatcher(self.kd_store)
+
+        async def query_all():
+            return await asyncio.gather(*[batcher.recommend(*target) for target in self.targets])
+
+        results = asyncio.run(query_all())
+        batcher.close()
+        for target, result in zip(self.targets, results):
+            self.assertEqual([item['name'] for item in result['result']], self.expected_names(*target))
+        self.assertEqual(batcher.num_batches, 1)
+        self.assertEqual(batcher.num_queries, len(self.targets))
+
+        # the batches are capped to answer within the latency SLO
+        batcher.query_duration = 0.001
+        batcher.latency_slo = 0.012
+        self.assertEqual(batcher.batch_size_limit(), 10)
+
+    def start_server(self, batcher):
+        """Serves the batcher from an event loop in another thread
+
+        Returns: (port, function stopping the server)
+        """
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(AsyncQueryServer(batcher).start('127.0.0.1', 0))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+
+        def stop():
+            server.close()
+            asyncio.run_coroutine_threadsafe(server.wait_closed(), loop).result(10)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(10)
+            loop.close()
+            batcher.close()
+
+        return server.sockets[0].getsockname()[1], stop
+
+    def test_http_queries(self):
+        batcher = QueryBatcher(self.kd_store)
+        port, stop = self.start_server(batcher)
+        try:
+            def get_names(target):
+                url = 'http://127.0.0.1:{}/query?latitude={}&longitude={}&age={}'.format(port, *target)
+                with urllib.request.urlopen(url) as response:
+                    return [item['name'] for item in json.loads(response.read().decode('utf-8'))['result']]
+
+            with ThreadPoolExecutor(8) as executor:
+                names = list(executor.map(get_names, self.targets))
+            self.assertEqual(names, [self.expected_names(*target) for target in self.targets])
+
+            url = 'http://127.0.0.1:{}/query?latitude=10&longitude=20&age=40&k=3&age_proximity=2&fields=name'
+            with urllib.request.urlopen(url.format(port)) as response:
+                self.assertEqual(json.loads(response.read().decode('utf-8'))['result'],
+                                 [{'name': item['name']} for item in self.kd_store.recommend(
+                                     {'latitude': 10, 'longitude': 20, 'age': 40}, 3, 2)['result']])
+
+            for query_string in ('latitude=10', 'latitude=nan&longitude=20&age=40'):
+                with self.assertRaises(urllib.error.HTTPError) as context:
+                    urllib.request.urlopen('http://127.0.0.1:{}/query?{}'.format(port, query_string))
+                self.assertEqual(context.exception.code, 404)
+
+            with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port)) as response:
+                lines = response.read().decode('utf-8').splitlines()
+            self.assertIn('geo_recommender_request_seconds_count{{endpoint="/query"}} {}'.format(
+                len(self.targets) + 3), lines)
+        finally:
+            stop()
+
+    def test_failed_batches_and_search_budget(self):
+        def fail(*args):
+            raise ValueError('the index was not built')
+
+        self.kd_store.k_nearest_neighbors_batch = fail
+        port, stop = self.start_server(QueryBatcher(self.kd_store))
+        try:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen('http://127.0.0.1:{}/query?latitude=10&longitude=20&age=40'.format(port))
+            self.assertEqual(context.exception.code, 500)
+        finally:
+            stop()
+
+        # with a search budget, the queries are answered one by one by recommend, which honors it
+        self.kd_store.max_visits = 5
+        batcher = QueryBatcher(self.kd_store)
+
+        async def query_all():
+            return await asyncio.gather(*[batcher.recommend(*target) for target in self.targets])
+
+        results = asyncio.run(query_all())
+        batcher.close()
+        self.assertFalse(all(result['exact'] for result in results))
+        for target, result in zip(self.targets, results):
+            self.assertEqual([item['name'] for item in result['result']], self.expected_names(*target))
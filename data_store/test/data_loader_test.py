@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from data_store.data_loader import load_compact_store, read_line_chunks
+
+
+class DataLoaderTest(unittest.TestCase):
+    def write_data_files(self, directory, size, seed=1437):
+        """Writes random data files in the format of realistic_data_generator.py"""
+        rng = np.random.RandomState(seed)
+        ages = rng.randint(0, 100, size)
+        names = np.array(['FIRST' + str(i) + ',LAST' + 'X' * (i % 7) for i in range(size)])
+        coords = np.column_stack((rng.uniform(-90, 90, size), rng.uniform(-180, 180, size)))
+        filenames = [os.path.join(directory, name) for name in ('ages.txt', 'names.txt', 'coords.txt')]
+        np.savetxt(filenames[0], ages, fmt='%1.0f')
+        np.savetxt(filenames[1], names, fmt='%s')
+        np.savetxt(filenames[2], coords, fmt='%1.6f', delimiter=',')
+        return filenames, ages, names, np.round(coords, 6)
+
+    def test_load_compact_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filenames, ages, names, coords = self.write_data_files(directory, 1000)
+            # small chunks, so that the lines are split across many blocks
+            for data_in_parallel in (False, True):
+                store = load_compact_store(*filenames, data_in_parallel=data_in_parallel, chunk_bytes=100)
+                self.assertEqual(store.size, 1000)
+                np.testing.assert_array_equal(store.ages, ages)
+                np.testing.assert_array_equal(store.latitudes, coords[:, 0])
+                np.testing.assert_array_equal(store.longitudes, coords[:, 1])
+                self.assertEqual([store.get_name(i) for i in range(store.size)], names.tolist())
+                self.assertEqual(len(store.name_bytes), store.name_offsets[-1])
+
+    def test_mismatched_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filenames, _, _, _ = self.write_data_files(directory, 100)
+            with open(filenames[2], 'a') as coords_file:
+                coords_file.write('1.0,2.0')
+            with self.assertRaises(ValueError):
+                load_compact_store(*filenames)
+
+    def test_ages_range(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filenames, ages, _, _ = self.write_data_files(directory, 100)
+            ages[3] = 300
+            np.savetxt(filenames[0], ages, fmt='%1.0f')
+            # the uint8 column of the compact store cannot hold them, the int64 one can
+            with self.assertRaises(ValueError):
+                load_compact_store(*filenames)
+            store = load_compact_store(*filenames, compact_ages=False)
+            np.testing.assert_array_equal(store.ages, ages)
+
+    def test_read_line_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'lines.txt')
+            with open(filename, 'wb') as lines_file:
+                lines_file.write(b'a\nbbbbbbbbbb\ncc\nd')
+            chunks = list(read_line_chunks(filename, chunk_bytes=4))
+            self.assertTrue(all(chunk.endswith(b'\n') for chunk in chunks))
+            self.assertEqual(b''.join(chunks), b'a\nbbbbbbbbbb\ncc\nd\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import io
+import unittest
+from contextlib import redirect_stdout
+import numpy as np
+from data_store.grid_store import GridDataStore
+from data_store.kd_tree_store import KDTreeDataStore
+from data_store.test.kd_tree_store_test import generate_data_list, brute_force_neighbors, call_app
+
+
+class GridDataStoreTest(unittest.TestCase):
+    def test_knn_matches_brute_force(self):
+        data_list = generate_data_list(3000)
+        inserted_items = generate_data_list(100, seed=5)
+        for i, item in enumerate(inserted_items):
+            item['name'] = 'new ' + str(i)
+        grid_store = GridDataStore(data_from_file=False, data_list=data_list)
+        # the first items stay in the per-cell lists, the last ones trigger a merge into the sorted rows
+        for item in inserted_items[:50]:
+            grid_store.insert_item(dict(item))
+        self.assertEqual(grid_store._num_inserted, 50)
+
+        targets = generate_data_list(20, seed=7) + [{'latitude': 89.9, 'longitude': 179.9, 'age': 50},
+                                                    {'latitude': -10, 'longitude': -180, 'age': 30}]
+        for num_inserted in (50, 100):
+            for target_item in targets:
+                for age_proximity in (0, 5):
+                    expected = brute_force_neighbors(data_list + inserted_items[:num_inserted], target_item, 10,
+                                                     age_proximity)
+                    result = grid_store.k_nearest_neighbors(target_item, 10, age_proximity)
+                    self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+                    np.testing.assert_allclose([item['distance'] for item in result], [dist for dist, _ in expected])
+
+            grid_store.merge_fraction = 0
+            for item in inserted_items[50:]:
+                grid_store.insert_item(dict(item))
+        self.assertEqual(grid_store._num_inserted, 0)
+
+    def test_recommend_caps_radius(self):
+        data_list = generate_data_list(3000)
+        grid_store = GridDataStore(data_from_file=False, data_list=data_list, max_radius=800, max_age_widening=20)
+        for target_item in generate_data_list(10, seed=7) + [{'latitude': 10.0, 'longitude': 10.0, 'age': 5}]:
+            response = grid_store.recommend(target_item, 10, 2)
+            expected = [(dist, name) for dist, name in
+                        brute_force_neighbors(data_list, target_item, 10, response['age_proximity']) if dist < 800]
+            self.assertEqual([item['name'] for item in response['result']], [name for _, name in expected])
+            self.assertTrue(response['exact'])
+
+    def test_approximate_mode(self):
+        data_list = generate_data_list(3000)
+        grid_store = GridDataStore(data_from_file=False, data_list=data_list, exact=False)
+        for target_item in generate_data_list(20, seed=7):
+            expected = brute_force_neighbors(data_list, target_item, 10, 5)
+            result = grid_store.k_nearest_neighbors(target_item, 10, 5)
+            self.assertEqual(len(result), 10)
+            # the neighbors found can only be farther than the exact ones
+            self.assertTrue(np.all(np.array([item['distance'] for item in result]) >=
+                                   np.array([dist for dist, _ in expected]) - 1e-9))
+
+        grid_store.exact = True
+        result, exact = grid_store.k_nearest_neighbors(generate_data_list(1, seed=7)[0], 10, 5, max_visits=1,
+                                                       return_exact=True)
+        self.assertFalse(exact)
+        expected = grid_store.k_nearest_neighbors(generate_data_list(1, seed=7)[0], 10, 5)
+        self.assertEqual(KDTreeDataStore.recall_at_k(expected[:5], expected), 0.5)
+        self.assertLess(KDTreeDataStore.recall_at_k(result, expected), 1)
+
+        indices, distances = grid_store.k_nearest_neighbors_batch(np.array([10.0]), np.array([20.0]), np.array([30]),
+                                                                  5, 0)
+        self.assertEqual(indices.shape, (1, 5))
+        self.assertTrue(np.all(np.diff(distances[0]) >= 0))
+
+    def test_insert_items_bulk(self):
+        data_list = generate_data_list(3000)
+        inserted_items = generate_data_list(2000, seed=5)
+        for i, item in enumerate(inserted_items):
+            item['name'] = 'new ' + str(i)
+        grid_store = GridDataStore(data_from_file=False, data_list=data_list)
+        # a small batch stays in the per-cell lists, a large one is merged into the sorted rows
+        for num_inserted in (50, 2000):
+            items = [dict(item) for item in inserted_items[grid_store.node_store.size - 3000:num_inserted]]
+            grid_store.insert_items_bulk(items)
+            self.assertEqual(grid_store._num_inserted, 50 if num_inserted == 50 else 0)
+            for target_item in generate_data_list(10, seed=7):
+                expected = brute_force_neighbors(data_list + inserted_items[:num_inserted], target_item, 10, 5)
+                result = grid_store.k_nearest_neighbors(target_item, 10, 5)
+                self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+            self.assertEqual(grid_store.get_node_from_id(items[-1]['id'])['name'], items[-1]['name'])
+
+    def test_ids_follow_the_people(self):
+        data_list = generate_data_list(1000)
+        grid_store = GridDataStore(data_from_file=False, data_list=[dict(item) for item in data_list])
+        inserted_items = [dict(item, name='new ' + str(i)) for i, item in enumerate(generate_data_list(300, seed=5))]
+        grid_store.merge_fraction = 0.1
+        output = io.StringIO()
+        with redirect_stdout(output):
+            # the last insertions merge the inserted people into the sorted rows, quietly
+            for item in inserted_items:
+                grid_store.insert_item(item)
+        self.assertEqual(output.getvalue(), '')
+        self.assertLess(grid_store._num_inserted, 300)
+
+        for item in data_list[:10] + inserted_items[::30]:
+            self.assertEqual(grid_store.get_node_from_id(item['id'])['name'], item['name'])
+        grid_store.delete_item('7')
+        self.assertNotIn(data_list[7]['name'], [item['name'] for item in
+                                                grid_store.k_nearest_neighbors(data_list[7], 1, 0)])
+
+    def test_shared_attributes(self):
+        grid_store = GridDataStore(data_from_file=False, data_list=generate_data_list(500))
+        # the attributes the inherited methods rely on are set like for an in-memory compact store
+        self.assertFalse(grid_store.redis_mode or grid_store.use_snapshot)
+        self.assertIsNone(grid_store.node_cache)
+        status, _, _ = call_app(grid_store.create_app(), '/cache_stats')
+        self.assertTrue(status.startswith('200'))
+        with self.assertRaises(AssertionError):
+            grid_store.save_snapshot()
@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+from data_store import index_builder
+from data_store.index_builder import build_kd_tree, build_kd_tree_parallel
+
+
+def check_subtree(test_case, coords, left_ids, right_ids, node, depth, visited):
+    """Checks the k-d tree invariant below node and returns the indices of its subtree"""
+    if node < 0:
+        return np.array([], dtype=int)
+    visited.append(node)
+    axis = depth % len(coords)
+    left = check_subtree(test_case, coords, left_ids, right_ids, left_ids[node], depth + 1, visited)
+    right = check_subtree(test_case, coords, left_ids, right_ids, right_ids[node], depth + 1, visited)
+    test_case.assertTrue(np.all(coords[axis][left] <= coords[axis][node]))
+    test_case.assertTrue(np.all(coords[axis][right] >= coords[axis][node]))
+    return np.concatenate((left, right, [node]))
+
+
+class IndexBuilderTest(unittest.TestCase):
+    def build_and_check(self, size, use_approx_median, median_sample=10000, num_workers=1):
+        rng = np.random.RandomState(1437)
+        # rounded coordinates, to have ties on the splitting values
+        coords = (np.round(rng.uniform(-90, 90, size), 1), np.round(rng.uniform(-180, 180, size), 1))
+        left_ids = np.full(size, -1)
+        right_ids = np.full(size, -1)
+
+        root = build_kd_tree_parallel(coords, left_ids, right_ids, num_workers, use_approx_median=use_approx_median,
+                                      median_sample=median_sample)
+
+        visited = []
+        check_subtree(self, coords, left_ids, right_ids, root, 0, visited)
+        self.assertEqual(sorted(visited), list(range(size)))
+        return root, left_ids, right_ids
+
+    def test_exact_median_tree(self):
+        root, left_ids, right_ids = self.build_and_check(20000, use_approx_median=False)
+        # exact medians give a balanced tree
+        depth, level = 0, [root]
+        while level:
+            level = [child for node in level for child in (left_ids[node], right_ids[node]) if child >= 0]
+            depth += 1
+        self.assertEqual(depth, int(np.ceil(np.log2(20000 + 1))))
+
+    def test_approx_median_tree(self):
+        self.build_and_check(20000, use_approx_median=True, median_sample=100)
+
+    def test_small_segments_only(self):
+        original_split_size = index_builder._batch_split_size
+        index_builder._batch_split_size = 10 ** 9
+        try:
+            self.build_and_check(3000, use_approx_median=False)
+        finally:
+            index_builder._batch_split_size = original_split_size
+
+    def test_parallel_build(self):
+        self.build_and_check(50000, use_approx_median=False, num_workers=2)
+        self.build_and_check(50000, use_approx_median=True, median_sample=500, num_workers=3)
+
+    def test_empty(self):
+        self.assertEqual(build_kd_tree((np.array([]), np.array([])), np.array([]), np.array([])), -1)
+
+
+if __name__ == "__main__":
+    unittest.main()
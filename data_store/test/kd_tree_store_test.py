@@ -1,6 +1,44 @@
+import io
+import json
+import os
+import tempfile
 import unittest
+from wsgiref.util import setup_testing_defaults
+import numpy as np
 from data_store.kd_tree_store import KDTreeDataStore
-from data_generation.person import Person
+from utilities.geo_utils import haversine_distance
+
+
+def generate_data_list(size, seed=1437):
+    """Generates a list of random people for the tests"""
+    rng = np.random.RandomState(seed)
+    return [{'id': str(i), 'name': 'person ' + str(i), 'age': int(rng.randint(20, 80)),
+             'latitude': float(rng.uniform(-60, 60)), 'longitude': float(rng.uniform(-180, 180))}
+            for i in range(size)]
+
+
+def brute_force_neighbors(data_list, target_item, k, age_proximity):
+    """Exact k nearest neighbors by scanning all the items"""
+    candidates = [(haversine_distance(item['latitude'], item['longitude'], target_item['latitude'],
+                                      target_item['longitude']), item['name']) for item in data_list
+                  if abs(item['age'] - target_item['age']) <= age_proximity]
+    return sorted(candidates)[:k]
+
+
+def call_app(app, path, query_string='', method='GET', body=b'', content_type='application/json', accept=None):
+    """Calls the wsgi app and returns the status, headers and body of the response"""
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query_string, 'REQUEST_METHOD': method,
+               'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+    if accept is not None:
+        environ['HTTP_ACCEPT'] = accept
+    setup_testing_defaults(environ)
+    result = {}
+
+    def start_response(status, headers, exc_info=None):
+        result['status'], result['headers'] = status, dict(headers)
+
+    response_body = b''.join(app(environ, start_response))
+    return result['status'], result['headers'], response_body
 
 
 class KDTreeDataStoreTest(unittest.TestCase):
@@ -19,6 +57,419 @@ class KDTreeDataStoreTest(unittest.TestCase):
         self.assertEqual(right_item_set, [{'longitude': 53.3, 'age': 35, 'name': 'Jane Smith', 'latitude': 110.3}, {'longitude': -3.3, 'age': 40, 'name': 'John Doe', 'latitude': 120.3}, {'longitude': 53.3, 'age': 35, 'name': 'Debby Smith', 'latitude': 120.3}])
         # self.assertEqual(KDTreeDataStore.get_median(item_list, 1)[2],  {'name':'hamza harkous','age': 18,'latitude':40.3,'longitude':13.3})
 
+    def test_knn_matches_brute_force(self):
+        data_list = generate_data_list(2000)
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=data_list)
+
+        for target_item in generate_data_list(20, seed=7):
+            result = kd_store.k_nearest_neighbors(target_item, 10, 5)
+            expected = brute_force_neighbors(data_list, target_item, 10, 5)
+            self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+
+    def test_knn_on_degenerate_tree(self):
+        # inserting sorted items chains them into a tree deeper than the recursion limit
+        data_list = generate_data_list(1)
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=data_list, rebalance=False)
+        for i in range(3000):
+            item = {'id': 'inserted_' + str(i), 'name': 'inserted ' + str(i), 'age': 30, 'latitude': 10 + i * 1e-3, 'longitude': 10 + i * 1e-3}
+            kd_store.insert_item(item)
+
+        result = kd_store.k_nearest_neighbors({'age': 30, 'latitude': 11, 'longitude': 11}, 3, 0)
+        self.assertEqual([item['name'] for item in result], ['inserted 1000', 'inserted 1001', 'inserted 999'])
+
+    def test_compact_mode_matches_brute_force(self):
+        data_list = generate_data_list(2000)
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=data_list, compact_mode=True)
+
+        for target_item in generate_data_list(20, seed=7):
+            result = kd_store.k_nearest_neighbors(target_item, 10, 5)
+            expected = brute_force_neighbors(data_list, target_item, 10, 5)
+            self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+            np.testing.assert_allclose([item['distance'] for item in result], [dist for dist, _ in expected])
+
+    def test_compact_mode_insert_and_find(self):
+        data_list = generate_data_list(500)
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=data_list, compact_mode=True)
+
+        new_item = {'name': 'new person', 'age': 30, 'latitude': 12.5, 'longitude': 45.25}
+        kd_store.insert_item(new_item)
+        self.assertEqual(new_item['id'], '500')
+
+        found = kd_store.find_item({'latitude': 12.5, 'longitude': 45.25})
+        self.assertEqual(found['name'], 'new person')
+        self.assertEqual(found['age'], 30)
+        self.assertEqual(kd_store.k_nearest_neighbors(new_item, 1, 0)[0]['name'], 'new person')
+        self.assertIsNone(kd_store.find_item({'latitude': 12.5, 'longitude': 45.5}))
+
+    def test_age_index_gives_same_neighbors(self):
+        data_list = generate_data_list(3000)
+        inserted_items = generate_data_list(30, seed=5)
+        for i, item in enumerate(inserted_items):
+            item.update({'id': 'new_' + str(i), 'age': 90 + i % 5})
+
+        for compact_mode in (False, True):
+            indexed_store = KDTreeDataStore(redis_mode=False, data_from_file=False,
+                                            data_list=[dict(item) for item in data_list], compact_mode=compact_mode,
+                                            age_index=True)
+            for item in inserted_items:
+                indexed_store.insert_item(dict(item))
+
+            for target_item in generate_data_list(20, seed=7) + [{'latitude': 0, 'longitude': 0, 'age': 92}]:
+                for age_proximity in (0, 2, 10):
+                    expected = brute_force_neighbors(data_list + inserted_items, target_item, 5, age_proximity)
+                    result = indexed_store.k_nearest_neighbors(target_item, 5, age_proximity)
+                    self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+
+    def test_leaf_buckets_match_brute_force(self):
+        data_list = generate_data_list(3000)
+        inserted_items = generate_data_list(40, seed=5)
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=[dict(item) for item in data_list],
+                                   compact_mode=True, age_index=True, bucket_size=64)
+        store = kd_store.node_store
+        # the rows were renumbered in in-order, along with their names
+        self.assertEqual(store.get_contiguous_subtree(store.root), (0, 3000))
+        names = {(item['latitude'], item['longitude']): item['name'] for item in data_list}
+        for index in range(store.size):
+            start, end = store.get_contiguous_subtree(index)
+            self.assertTrue(start <= index < end)
+            self.assertEqual(store.get_name(index), names[(store.latitudes[index], store.longitudes[index])])
+
+        for i, item in enumerate(inserted_items):
+            item['name'] = 'new ' + str(i)
+            kd_store.insert_item(dict(item))
+        self.assertIsNone(store.get_contiguous_subtree(store.root))
+
+        for target_item in generate_data_list(20, seed=7):
+            for age_proximity in (0, 5):
+                expected = brute_force_neighbors(data_list + inserted_items, target_item, 10, age_proximity)
+                result = kd_store.k_nearest_neighbors(target_item, 10, age_proximity)
+                self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+
+    def test_search_budget(self):
+        data_list = generate_data_list(3000)
+        targets = generate_data_list(10, seed=7)
+        for compact_mode in (False, True):
+            kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False,
+                                       data_list=[dict(item) for item in data_list], compact_mode=compact_mode)
+            for target_item in targets:
+                expected = brute_force_neighbors(data_list, target_item, 10, 5)
+                result, exact = kd_store.k_nearest_neighbors(target_item, 10, 5, max_visits=10 ** 6,
+                                                             return_exact=True)
+                self.assertTrue(exact)
+                self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+
+                for budget in ({'max_visits': 20}, {'time_budget': 0}):
+                    result, exact = kd_store.k_nearest_neighbors(target_item, 10, 5, return_exact=True, **budget)
+                    self.assertFalse(exact)
+                    self.assertTrue(np.all(np.array([item['distance'] for item in result]) >=
+                                           np.array([dist for dist, _ in expected[:len(result)]]) - 1e-9))
+
+            kd_store.max_visits = 200
+            stats = kd_store.measure_recall(10, 5, targets=targets)
+            self.assertLess(stats['recall'], 1)
+            self.assertLess(stats['exact_fraction'], 1)
+            stats = kd_store.measure_recall(10, 5, max_visits=10 ** 6, num_queries=10)
+            self.assertEqual((stats['recall'], stats['exact_fraction']), (1, 1))
+
+    def test_recommend_caps_radius_and_widens_ages(self):
+        data_list = generate_data_list(3000)
+        for compact_mode in (False, True):
+            kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False,
+                                       data_list=[dict(item) for item in data_list], compact_mode=compact_mode,
+                                       bucket_size=32, max_radius=1000, max_age_widening=20)
+            for target_item in generate_data_list(10, seed=7):
+                expected = [(dist, name) for dist, name in brute_force_neighbors(data_list, target_item, 10, 5)
+                            if dist < 1000]
+                response = kd_store.recommend(target_item, 10, 5, max_age_widening=0)
+                self.assertEqual([item['name'] for item in response['result']], [name for _, name in expected])
+                self.assertEqual((response['age_proximity'], response['partial']), (5, len(expected) < 10))
+
+            # nobody is younger than 20 in the data: the age window is widened by 1, 2, 4, 8, then 16 years
+            target_item = {'latitude': 10.0, 'longitude': 10.0, 'age': 5}
+            response = kd_store.recommend(target_item, 3, 2)
+            expected = [(dist, name) for dist, name in brute_force_neighbors(data_list, target_item, 3, 18)
+                        if dist < 1000]
+            self.assertEqual(response['age_proximity'], 18)
+            self.assertTrue(response['exact'])
+            self.assertEqual([item['name'] for item in response['result']], [name for _, name in expected])
+
+            status, _, body = call_app(kd_store.create_app(), '/query', 'latitude=10&longitude=10&age=5')
+            self.assertEqual(json.loads(body.decode('utf-8'))['age_proximity'], 25)
+
+    def test_rebalancing_keeps_the_tree_shallow(self):
+        data_list = generate_data_list(500)
+        # people signing up along a street, which chains them without rebalancing
+        inserted_items = [{'name': 'inserted ' + str(i), 'age': 20 + i % 60, 'latitude': 10 + i * 1e-3,
+                           'longitude': 10 + i * 1e-3} for i in range(3000)]
+        for compact_mode in (False, True):
+            kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False,
+                                       data_list=[dict(item) for item in data_list], compact_mode=compact_mode,
+                                       age_index=True, bucket_size=16)
+            for i, item in enumerate(inserted_items):
+                kd_store.insert_item(dict(item, id='new_' + str(i)))
+
+            depth, level_ids = 0, [kd_store.get_root_id()]
+            while level_ids:
+                nodes = kd_store.get_nodes_from_ids(level_ids)
+                level_ids = [child for node in nodes for child in (node['left_id'], node['right_id']) if child]
+                depth += 1
+            self.assertLessEqual(depth, kd_store._max_balanced_depth(3500) + 2)
+
+            for target_item in generate_data_list(10, seed=7) + [{'latitude': 11, 'longitude': 11, 'age': 40}]:
+                expected = brute_force_neighbors(data_list + inserted_items, target_item, 10, 3)
+                result = kd_store.k_nearest_neighbors(target_item, 10, 3)
+                self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+            self.assertEqual(kd_store.find_item({'latitude': 10 + 1234e-3, 'longitude': 10 + 1234e-3})['name'],
+                             'inserted 1234')
+
+    def test_insert_items_bulk(self):
+        data_list = generate_data_list(1000)
+        # spread people, and a street of sign-ups that all land in the same empty slot
+        inserted_items = generate_data_list(300, seed=5) + [
+            {'name': 'street ' + str(i), 'age': 20 + i % 60, 'latitude': 10 + i * 1e-3, 'longitude': 10 + i * 1e-3}
+            for i in range(1000)]
+        for i, item in enumerate(inserted_items):
+            item.update({'id': 'new_' + str(i), 'name': 'inserted ' + str(i)})
+        for compact_mode, build_subtrees, batch_size in ((False, True, 1300), (False, False, 1300),
+                                                         (True, True, 1300), (True, False, 1300), (True, True, 50)):
+            kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False,
+                                       data_list=[dict(item) for item in data_list], compact_mode=compact_mode,
+                                       age_index=True, bucket_size=16)
+            items = [dict(item) for item in inserted_items]
+            for start in range(0, len(items), batch_size):
+                kd_store.insert_items_bulk(items[start:start + batch_size], build_subtrees=build_subtrees)
+
+            depth, level_ids = 0, [kd_store.get_root_id()]
+            while level_ids:
+                nodes = kd_store.get_nodes_from_ids(level_ids)
+                level_ids = [child for node in nodes for child in (node['left_id'], node['right_id']) if child]
+                depth += 1
+            self.assertLessEqual(depth, kd_store._max_balanced_depth(2300) + 2)
+
+            for target_item in generate_data_list(20, seed=7) + [{'latitude': 10.5, 'longitude': 10.5, 'age': 40}]:
+                expected = brute_force_neighbors(data_list + inserted_items, target_item, 10, 3)
+                result = kd_store.k_nearest_neighbors(target_item, 10, 3)
+                self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+            for item in items[::97]:
+                self.assertEqual(kd_store.get_node_from_id(item['id'])['name'], item['name'])
+
+    def test_delete_and_update_location(self):
+        data_list = generate_data_list(1000)
+        rng = np.random.RandomState(3)
+        for compact_mode in (False, True):
+            kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False,
+                                       data_list=[dict(item) for item in data_list], compact_mode=compact_mode,
+                                       age_index=True, bucket_size=16)
+            # in compact mode, the ids are the rows, which the leaf buckets reorder
+            people = {kd_store.find_item(item)['id']: dict(item) for item in data_list}
+            # enough deletions and moves for two compactions
+            for step in range(600):
+                person_id = sorted(people)[rng.randint(len(people))]
+                if step % 3 == 0:
+                    kd_store.delete_item(person_id)
+                    del people[person_id]
+                else:
+                    latitude, longitude = float(rng.uniform(-60, 60)), float(rng.uniform(-180, 180))
+                    kd_store.update_location(person_id, latitude, longitude)
+                    people[person_id].update({'latitude': latitude, 'longitude': longitude})
+            with self.assertRaises(KeyError):
+                kd_store.delete_item(person_id if step % 3 == 0 else '12345')
+
+            for target_item in generate_data_list(20, seed=7):
+                expected = brute_force_neighbors(list(people.values()), target_item, 10, 5)
+                result = kd_store.k_nearest_neighbors(target_item, 10, 5)
+                self.assertEqual([item['name'] for item in result], [name for _, name in expected])
+
+            # the moved people keep their ids
+            person_id = sorted(people)[0]
+            self.assertEqual(kd_store.find_item(people[person_id])['id'], person_id)
+            self.assertEqual(kd_store.get_node_from_id(person_id)['name'], people[person_id]['name'])
+
+            app = kd_store.create_app()
+            status, _, body = call_app(app, '/item/' + person_id + '/location', 'latitude=1.5&longitude=2.5',
+                                       method='PUT')
+            self.assertTrue(status.startswith('200'))
+            self.assertEqual(kd_store.find_item({'latitude': 1.5, 'longitude': 2.5})['id'], person_id)
+            self.assertTrue(call_app(app, '/item/' + person_id, method='DELETE')[0].startswith('200'))
+            self.assertIsNone(kd_store.find_item({'latitude': 1.5, 'longitude': 2.5}))
+            self.assertTrue(call_app(app, '/item/' + person_id, method='DELETE')[0].startswith('404'))
+
+    def test_ids_follow_the_people(self):
+        data_list = generate_data_list(500)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'index.snapshot')
+            KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=[dict(item) for item in data_list],
+                            compact_mode=True).save_snapshot(filename)
+            stores = [KDTreeDataStore(redis_mode=False, data_from_file=False,
+                                      data_list=[dict(item) for item in data_list], **kwargs)
+                      for kwargs in ({}, {'compact_mode': True}, {'compact_mode': True, 'bucket_size': 32})]
+            # a snapshot saved without the leaf buckets, loaded with them
+            loaded_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=[], compact_mode=True,
+                                           bucket_size=32)
+            loaded_store.load_snapshot(filename, mmap_mode=None)
+            stores.append(loaded_store)
+
+            for kd_store in stores:
+                for item in data_list[:10]:
+                    self.assertEqual(kd_store.find_item(item)['id'], item['id'])
+                    self.assertEqual(kd_store.get_node_from_id(item['id'])['name'], item['name'])
+                kd_store.delete_item('7')
+                self.assertIsNone(kd_store.find_item(data_list[7]))
+                self.assertEqual(kd_store.find_item(data_list[8])['id'], '8')
+
+    def test_compact_mode_keeps_the_item_ids(self):
+        data_list = generate_data_list(500)
+        for i, item in enumerate(data_list):
+            item['id'] = str(1000 + (i * 7) % 500)
+        for kwargs in ({}, {'compact_mode': True}, {'compact_mode': True, 'bucket_size': 32}):
+            kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False,
+                                       data_list=[dict(item) for item in data_list], **kwargs)
+            for item in data_list[:10]:
+                self.assertEqual(kd_store.find_item(item)['id'], item['id'])
+            kd_store.delete_item(data_list[3]['id'])
+            self.assertIsNone(kd_store.find_item(data_list[3]))
+            if kwargs:
+                # the new people get ids that no item had
+                new_item = {'name': 'newcomer', 'age': 40, 'latitude': 10.0, 'longitude': 20.0}
+                kd_store.insert_item(new_item)
+                self.assertEqual(new_item['id'], '1500')
+
+        for ids in (['p' + str(i) for i in range(500)], ['1'] * 500):
+            with self.assertRaises(ValueError):
+                KDTreeDataStore(redis_mode=False, data_from_file=False, compact_mode=True,
+                                data_list=[dict(item, id=id) for item, id in zip(data_list, ids)])
+
+    def test_batch_matches_single_queries(self):
+        data_list = generate_data_list(5000)
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=data_list, compact_mode=True)
+        for item in generate_data_list(50, seed=3):
+            kd_store.insert_item(item)
+
+        targets = generate_data_list(300, seed=11)
+        latitudes = np.array([item['latitude'] for item in targets])
+        longitudes = np.array([item['longitude'] for item in targets])
+        ages = np.array([item['age'] for item in targets])
+
+        for k, age_proximity in ((10, 5), (3, 0), (20, 100)):
+            indices, distances = kd_store.k_nearest_neighbors_batch(latitudes, longitudes, ages, k, age_proximity)
+            self.assertEqual(indices.shape, (300, k))
+            for target_item, target_indices, target_distances in zip(targets, indices, distances):
+                expected = kd_store.k_nearest_neighbors(target_item, k, age_proximity)
+                np.testing.assert_allclose(target_distances[:len(expected)], [item['distance'] for item in expected])
+                self.assertTrue(np.all(target_indices[len(expected):] == -1))
+
+    def test_snapshot_round_trip(self):
+        data_list = generate_data_list(3000)
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=data_list, compact_mode=True,
+                                   age_index=True)
+        targets = generate_data_list(20, seed=7)
+        expected = [kd_store.k_nearest_neighbors(target_item, 10, 5) for target_item in targets]
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'index.snapshot')
+            kd_store.save_snapshot(filename)
+
+            loaded_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=[], compact_mode=True,
+                                           age_index=True)
+            loaded_store.load_snapshot(filename)
+            self.assertIsInstance(loaded_store.node_store.latitudes.base, np.memmap)
+            self.assertIsNotNone(loaded_store.node_store.subtree_age_max)
+            # the arrays the searches would build on first use are mapped too, so that the workers share them
+            self.assertIsInstance(loaded_store.node_store.cos_latitudes.base, np.memmap)
+            self.assertIsInstance(loaded_store.node_store.get_subtree_layout()[0].base, np.memmap)
+            for target_item, expected_result in zip(targets, expected):
+                self.assertEqual(loaded_store.k_nearest_neighbors(target_item, 10, 5), expected_result)
+
+            # the read-only mapped store still takes insertions
+            item = {'name': 'inserted', 'age': 30, 'latitude': 12.5, 'longitude': 45.5}
+            loaded_store.insert_item(item)
+            self.assertEqual(loaded_store.find_item(item)['name'], 'inserted')
+            del loaded_store
+
+            with open(filename, 'r+b') as snapshot_file:
+                snapshot_file.seek(8)
+                snapshot_file.write(b'\xff')
+            with self.assertRaises(ValueError):
+                kd_store.load_snapshot(filename)
+
+    def test_query_batch_endpoint(self):
+        data_list = generate_data_list(1000)
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=data_list, compact_mode=True)
+        app = kd_store.create_app()
+        expected_indices, expected_distances = kd_store.k_nearest_neighbors_batch([10, -20], [30, 40], [30, 50], 4, 5)
+
+        body = json.dumps({'latitudes': [10, -20], 'longitudes': [30, 40], 'ages': [30, 50], 'k': 4}).encode()
+        status, _, response_body = call_app(app, '/query_batch', method='POST', body=body)
+        self.assertTrue(status.startswith('200'))
+        result = json.loads(response_body.decode())
+        self.assertEqual(result['indices'], expected_indices.tolist())
+        np.testing.assert_allclose(result['distances'], expected_distances)
+
+        body = np.array([[10, 30, 30], [-20, 40, 50]], dtype='<f8').tobytes()
+        status, headers, response_body = call_app(app, '/query_batch', query_string='k=4', method='POST', body=body,
+                                                  content_type='application/octet-stream')
+        self.assertEqual(headers['X-Result-Shape'], '2,4')
+        np.testing.assert_array_equal(np.frombuffer(response_body[:64], dtype='<i8').reshape(2, 4), expected_indices)
+        np.testing.assert_allclose(np.frombuffer(response_body[64:], dtype='<f8').reshape(2, 4), expected_distances)
+
+        for query_string in ('k=0', 'k=-3', 'k=100000', 'age_proximity=-1'):
+            status, _, response_body = call_app(app, '/query_batch', query_string=query_string, method='POST',
+                                                 body=body, content_type='application/octet-stream')
+            self.assertTrue(status.startswith('404'), query_string)
+            self.assertTrue(response_body.startswith(b'Error: '))
+        for latitude, longitude in ((np.nan, 30), (10, np.inf), (-91, 30), (10, 200)):
+            body = np.array([[10, 30, 30], [latitude, longitude, 50]], dtype='<f8').tobytes()
+            status, _, response_body = call_app(app, '/query_batch', method='POST', body=body,
+                                                 content_type='application/octet-stream')
+            self.assertTrue(status.startswith('404'), (latitude, longitude))
+            self.assertTrue(response_body.startswith(b'Error: l'))
+
+        dict_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=data_list)
+        status, _, response_body = call_app(dict_store.create_app(), '/query_batch', method='POST', body=body,
+                                            content_type='application/octet-stream')
+        self.assertTrue(status.startswith('404'))
+        self.assertIn(b'compact mode', response_body)
+
+    def test_query_endpoint(self):
+        data_list = generate_data_list(1000)
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=data_list, compact_mode=True)
+        app = kd_store.create_app()
+        target_item = {'latitude': 10.0, 'longitude': 30.0, 'age': 30}
+        expected = kd_store.recommend(target_item, 25, 8)
+
+        status, headers, body = call_app(app, '/query', 'latitude=10&longitude=30&age=30&k=25&age_proximity=8')
+        self.assertTrue(status.startswith('200'))
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(body.decode('utf-8')), expected)
+
+        status, _, body = call_app(app, '/query', 'latitude=10&longitude=30&age=30&k=25&age_proximity=8'
+                                                  '&fields=name,distance')
+        self.assertEqual(json.loads(body.decode('utf-8'))['result'],
+                         [{'name': item['name'], 'distance': item['distance']} for item in expected['result']])
+
+        # packed columns, in the order of the fields
+        status, headers, body = call_app(app, '/query', 'latitude=10&longitude=30&age=30&k=25&age_proximity=8'
+                                                        '&fields=distance,name,age',
+                                         accept='application/octet-stream')
+        self.assertEqual(headers['Content-Type'], 'application/octet-stream')
+        self.assertEqual((headers['X-Result-Count'], headers['X-Result-Fields']), ('25', 'distance,name,age'))
+        np.testing.assert_array_equal(np.frombuffer(body[:200], dtype='<f8'),
+                                      [item['distance'] for item in expected['result']])
+        offsets = np.frombuffer(body[200:304], dtype='<i4')
+        names = body[304:304 + offsets[-1]].decode('utf-8')
+        self.assertEqual([names[start:end] for start, end in zip(offsets[:-1], offsets[1:])],
+                         [item['name'] for item in expected['result']])
+        np.testing.assert_array_equal(np.frombuffer(body[304 + offsets[-1]:], dtype='<i8'),
+                                      [item['age'] for item in expected['result']])
+
+        for query_string in ('latitude=10&longitude=30', 'latitude=10&longitude=30&age=abc',
+                             'latitude=10&longitude=30&age=30&k=0', 'latitude=10&longitude=30&age=30&fields=id',
+                             'latitude=nan&longitude=30&age=30', 'latitude=10&longitude=inf&age=30',
+                             'latitude=90.5&longitude=30&age=30', 'latitude=10&longitude=-181&age=30'):
+            status, _, body = call_app(app, '/query', query_string)
+            self.assertTrue(status.startswith('404'), query_string)
+            self.assertTrue(body.startswith(b'Error: '))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,95 @@
+import tempfile
+import unittest
+import numpy as np
+from data_store.grid_store import GridDataStore
+from data_store.kd_tree_store import KDTreeDataStore
+from data_store.metrics import LogHistogram, StoreMetrics
+from data_store.test.kd_tree_store_test import generate_data_list, call_app
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram_percentiles(self):
+        histogram = LogHistogram()
+        values = np.random.RandomState(0).lognormal(8, 2, 100000).astype(np.int64)
+        for value in values:
+            histogram.record(value)
+        self.assertEqual(histogram.count, len(values))
+        self.assertEqual(histogram.total, values.sum())
+        for quantile in (0.5, 0.95, 0.99, 0.999):
+            self.assertAlmostEqual(histogram.percentile(quantile) / np.percentile(values, quantile * 100), 1,
+                                   delta=0.04)
+
+        # the small values are exact
+        histogram = LogHistogram()
+        for value in range(10):
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(0.5), 4)
+        self.assertEqual(LogHistogram().percentile(0.5), 0)
+
+    def test_prometheus_format(self):
+        metrics = StoreMetrics()
+        metrics.observe_request('/query', 0.002)
+        metrics.observe_query(100, 20, 30, 0)
+        lines = metrics.to_prometheus().splitlines()
+        self.assertIn('# TYPE geo_recommender_request_seconds summary', lines)
+        self.assertIn('geo_recommender_request_seconds_count{endpoint="/query"} 1', lines)
+        self.assertIn('geo_recommender_query_queue_pushes{quantile="0.5"} 30', lines)
+        self.assertIn('geo_recommender_query_nodes_pruned_sum 20', lines)
+
+    def test_shared_metrics(self):
+        with tempfile.TemporaryDirectory() as directory:
+            workers = [StoreMetrics() for _ in range(3)]
+            for i, metrics in enumerate(workers):
+                metrics.share(directory, name='worker_' + str(i))
+                for _ in range(i + 1):
+                    metrics.observe_request('/query', 0.002)
+                metrics.observe_query(100 * (i + 1), 20, 30, 0)
+            # the other workers' metrics are as of their last save
+            workers[1].save_shared()
+            lines = workers[2].to_prometheus().splitlines()
+            self.assertIn('geo_recommender_request_seconds_count{endpoint="/query"} 5', lines)
+            self.assertIn('geo_recommender_query_nodes_visited_sum 500', lines)
+            self.assertIn('geo_recommender_query_nodes_visited_count 2', lines)
+
+            workers[0].save_shared()
+            lines = workers[1].to_prometheus().splitlines()
+            self.assertIn('geo_recommender_request_seconds_count{endpoint="/query"} 6', lines)
+            self.assertIn('geo_recommender_query_queue_pushes_sum 90', lines)
+
+    def test_store_counters(self):
+        target = {'latitude': 10.0, 'longitude': 20.0, 'age': 40}
+        for store in (KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=generate_data_list(2000),
+                                      compact_mode=True, bucket_size=32),
+                      KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=generate_data_list(2000)),
+                      GridDataStore(data_from_file=False, data_list=generate_data_list(2000))):
+            store.k_nearest_neighbors(target, 10, 5)
+            queries = store.metrics.queries
+            self.assertEqual(queries['nodes_visited'].count, 1)
+            self.assertGreater(queries['nodes_visited'].total, 10)
+            self.assertLess(queries['nodes_visited'].total, 2000)
+            self.assertEqual(store.metrics.stage_latencies['search'].count, 1)
+            if not isinstance(store, GridDataStore):
+                self.assertGreater(queries['nodes_pruned'].total, 0)
+                self.assertGreaterEqual(queries['queue_pushes'].total, 10)
+
+    def test_metrics_endpoint(self):
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=generate_data_list(1000),
+                                   compact_mode=True)
+        app = kd_store.create_app()
+        for _ in range(3):
+            call_app(app, '/query', 'latitude=10&longitude=30&age=30')
+        call_app(app, '/query', 'latitude=10')
+        call_app(app, '/nowhere')
+
+        status, headers, body = call_app(app, '/metrics')
+        self.assertTrue(status.startswith('200'))
+        self.assertTrue(headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = body.decode('utf-8').splitlines()
+        self.assertIn('geo_recommender_request_seconds_count{endpoint="/query"} 4', lines)
+        self.assertIn('geo_recommender_request_seconds_count{endpoint="unmatched"} 1', lines)
+        self.assertIn('geo_recommender_stage_seconds_count{stage="encode"} 3', lines)
+        self.assertIn('geo_recommender_query_queue_pushes_count 3', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
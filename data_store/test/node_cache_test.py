@@ -0,0 +1,37 @@
+import unittest
+from data_store.node_cache import NodeCache
+
+
+class NodeCacheTest(unittest.TestCase):
+    def test_lru_eviction_and_pinning(self):
+        cache = NodeCache(capacity=2)
+        cache.pin({'id': 'root', 'left_id': None})
+        for node_id in ('a', 'b'):
+            cache.put({'id': node_id})
+        # 'a' becomes the most recently used, so 'b' is evicted
+        self.assertEqual(cache.get('a'), {'id': 'a'})
+        cache.put({'id': 'c'})
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), {'id': 'c'})
+        self.assertIsNotNone(cache.get('root'))
+
+        # writes replace the cached copies, pinned ones included
+        cache.put({'id': 'root', 'left_id': 'a'})
+        self.assertEqual(cache.get('root')['left_id'], 'a')
+
+        self.assertEqual(cache.stats(), {'hits': 4, 'misses': 1, 'hit_rate': 0.8, 'evictions': 1, 'pinned': 1,
+                                         'cached': 2})
+
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled_cache(self):
+        cache = NodeCache(capacity=0)
+        cache.put({'id': 'a'})
+        self.assertIsNone(cache.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+import fakeredis
+from data_store.redis_node_store import RedisNodeStore, pack_node, unpack_node
+
+
+class RedisNodeStoreTest(unittest.TestCase):
+    def test_pack_node(self):
+        node = {'id': '12', 'name': 'Zoë O\'Neil', 'age': 34, 'latitude': 46.519653, 'longitude': -6.632273,
+                'left_id': '3', 'right_id': None}
+        self.assertEqual(unpack_node('12', pack_node(node)), node)
+
+        node.update({'left_id': None, 'right_id': 'inserted_42', 'age_min': 18, 'age_max': 90})
+        self.assertEqual(unpack_node('12', pack_node(node)), node)
+
+        node.update({'age': 0, 'deleted': True})
+        self.assertEqual(unpack_node('12', pack_node(node)), node)
+
+    def test_set_nodes_bulk(self):
+        r_server = fakeredis.FakeStrictRedis()
+        nodes = [{'id': str(i), 'name': 'person ' + str(i), 'age': 20 + i % 60, 'latitude': i * 0.5,
+                  'longitude': -i * 0.25, 'left_id': str(2 * i + 1), 'right_id': None} for i in range(250)]
+        redis_nodes = RedisNodeStore(r_server, key_prefix='test:v1:node:')
+        redis_nodes.set_nodes_bulk(nodes, chunk_size=64, num_connections=3)
+        # one MSET per chunk
+        self.assertEqual(redis_nodes.round_trips, 4)
+        self.assertEqual(len(r_server.keys('test:v1:node:*')), len(nodes))
+        self.assertEqual(unpack_node('17', r_server.get('test:v1:node:17')), nodes[17])
+
+        # any number of nodes are read back in one round trip
+        self.assertEqual(redis_nodes.get_nodes([node['id'] for node in nodes[::-1]]), nodes[::-1])
+        self.assertEqual(redis_nodes.round_trips, 5)
+        with self.assertRaises(KeyError):
+            redis_nodes.get_nodes(['3', 'missing'])
+
+
+if __name__ == '__main__':
+    unittest.main()
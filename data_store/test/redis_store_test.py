@@ -0,0 +1,194 @@
+import unittest
+import fakeredis
+import numpy as np
+from data_store.kd_tree_store import KDTreeDataStore
+from data_store.redis_node_store import unpack_node
+from data_store.test.kd_tree_store_test import generate_data_list, brute_force_neighbors
+
+
+class RedisStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.data_list = generate_data_list(500)
+        self.target = {'latitude': 10.0, 'longitude': 20.0, 'age': 40}
+
+    def create_store(self, rebuild_index=False, **kwargs):
+        """Creates a store of the test index, in the fake redis server shared by the test's stores"""
+        return KDTreeDataStore(rebuild_index=rebuild_index, redis_mode=True, data_from_file=False,
+                               data_list=[dict(item) for item in self.data_list] if rebuild_index else None,
+                               redis_client=fakeredis.FakeStrictRedis(server=self.server), redis_index='test_index',
+                               **kwargs)
+
+    def neighbor_names(self, kd_store, k=10, age_proximity=5):
+        return [item['name'] for item in kd_store.k_nearest_neighbors(self.target, k, age_proximity)]
+
+    def expected_names(self, k=10, age_proximity=5):
+        return [name for _, name in brute_force_neighbors(self.data_list, self.target, k, age_proximity)]
+
+    def test_bulk_load(self):
+        kd_store = self.create_store(rebuild_index=True)
+        kd_store.redis_write_chunk_size = 64
+        round_trips = kd_store.redis_nodes.round_trips
+        kd_store.construct_index(item_list=[dict(item) for item in self.data_list])
+        # the nodes are written with one MSET per chunk
+        self.assertEqual(kd_store.redis_nodes.round_trips - round_trips, 8)
+
+        r_server = kd_store.r_server
+        version = kd_store.redis_version
+        node_keys = r_server.keys('test_index:v{}:node:*'.format(version))
+        self.assertEqual(len(node_keys), len(self.data_list))
+        self.assertEqual(int(r_server.get('test_index:v{}:num_nodes'.format(version))), len(self.data_list))
+        node = unpack_node('7', r_server.get('test_index:v{}:node:7'.format(version)))
+        self.assertEqual((node['name'], node['latitude']), (self.data_list[7]['name'], self.data_list[7]['latitude']))
+        self.assertEqual(self.neighbor_names(kd_store), self.expected_names())
+
+    def test_versions(self):
+        writer = self.create_store(rebuild_index=True)
+        reader = self.create_store()
+        r_server = writer.r_server
+        self.assertEqual(reader.redis_version, 1)
+        self.assertEqual(self.neighbor_names(reader), self.expected_names())
+
+        def version_keys(version):
+            return r_server.keys('test_index:v{}:*'.format(version))
+
+        # a rebuild is written under a new version, and the readers switch to it with the root pointer
+        self.data_list = generate_data_list(300, seed=11)
+        writer.construct_index(item_list=[dict(item) for item in self.data_list])
+        self.assertEqual(r_server.get('test_index:root').decode('utf-8').split(':')[0], '2')
+        self.assertEqual(self.neighbor_names(reader), self.expected_names())
+        self.assertEqual(reader.redis_version, 2)
+        # the previous version is kept for the queries still running on it
+        self.assertEqual(len(version_keys(1)), 500 + 1)
+
+        writer.construct_index(item_list=[dict(item) for item in self.data_list])
+        self.assertEqual(self.neighbor_names(reader), self.expected_names())
+        self.assertEqual(version_keys(1), [])
+        self.assertEqual(len(version_keys(2)), 300 + 1)
+        self.assertEqual(sorted(int(version) for version in r_server.smembers('test_index:versions')), [2, 3])
+
+    def test_index_namespaces(self):
+        kd_store = self.create_store(rebuild_index=True)
+        other_data_list = generate_data_list(200, seed=13)
+        other_store = KDTreeDataStore(rebuild_index=True, redis_mode=True, data_from_file=False,
+                                      data_list=[dict(item) for item in other_data_list],
+                                      redis_client=fakeredis.FakeStrictRedis(server=self.server),
+                                      redis_index='other_index')
+        self.assertEqual(kd_store.list_redis_indices(), ['other_index', 'test_index'])
+        self.assertEqual(self.neighbor_names(kd_store), self.expected_names())
+
+        kd_store.select_redis_index('other_index')
+        self.data_list = other_data_list
+        self.assertEqual(self.neighbor_names(kd_store), self.expected_names())
+        self.assertEqual(self.neighbor_names(other_store), self.expected_names())
+        with self.assertRaises(AssertionError):
+            kd_store.select_redis_index('missing_index')
+
+    def test_packed_nodes_are_read_in_batches(self):
+        kd_store = self.create_store(rebuild_index=True, age_index=True, node_cache_size=0, pinned_levels=0)
+        self.assertEqual(kd_store.r_server.type('test_index:v1:node:7'), b'string')
+        nodes_visited = kd_store.metrics.queries['nodes_visited']
+        for target in generate_data_list(10, seed=7):
+            self.target = target
+            round_trips, visits = kd_store.redis_nodes.round_trips, nodes_visited.total
+            self.assertEqual(self.neighbor_names(kd_store), self.expected_names())
+            # the nodes to visit next are fetched together, with one MGET
+            self.assertLess(4 * (kd_store.redis_nodes.round_trips - round_trips), nodes_visited.total - visits)
+
+    def test_node_cache(self):
+        kd_store = self.create_store(rebuild_index=True, pinned_levels=3)
+        self.assertEqual(kd_store.node_cache.stats()['pinned'], 7)
+        round_trips = kd_store.redis_nodes.round_trips
+        self.assertEqual(self.neighbor_names(kd_store), self.expected_names())
+        self.assertGreater(kd_store.redis_nodes.round_trips - round_trips, 1)
+        self.assertEqual(kd_store.node_cache.stats()['hits'], 7)
+
+        # the repeated query only reads the root pointer
+        round_trips = kd_store.redis_nodes.round_trips
+        self.assertEqual(self.neighbor_names(kd_store), self.expected_names())
+        self.assertEqual(kd_store.redis_nodes.round_trips - round_trips, 1)
+
+    def test_delete_and_update_location(self):
+        writer = self.create_store(rebuild_index=True, age_index=True)
+        reader = self.create_store()
+        r_server = writer.r_server
+        people = {item['id']: dict(item) for item in self.data_list}
+
+        # the deleted nodes stay in the tree as packed tombstones
+        writer.delete_item('7')
+        del people['7']
+        node = unpack_node('7', r_server.get('test_index:v1:node:7'))
+        self.assertTrue(node['deleted'])
+        self.assertEqual(node['name'], 'person 7')
+        self.assertIsNone(reader.find_item(self.data_list[7]))
+
+        # enough deletions and moves for a compaction, written under a new version
+        rng = np.random.RandomState(3)
+        for step in range(200):
+            person_id = sorted(people)[rng.randint(len(people))]
+            if step % 3 == 0:
+                writer.delete_item(person_id)
+                del people[person_id]
+            else:
+                latitude, longitude = float(rng.uniform(-60, 60)), float(rng.uniform(-180, 180))
+                writer.update_location(person_id, latitude, longitude)
+                people[person_id].update({'latitude': latitude, 'longitude': longitude})
+        self.assertGreater(writer.redis_version, 1)
+
+        self.data_list = list(people.values())
+        for target in generate_data_list(10, seed=7):
+            self.target = target
+            self.assertEqual(self.neighbor_names(reader), self.expected_names())
+        person_id = sorted(people)[0]
+        self.assertEqual(reader.find_item(people[person_id])['id'], person_id)
+
+    def test_insert_items_bulk(self):
+        writer = self.create_store(rebuild_index=True, age_index=True)
+        reader = self.create_store()
+        inserted_items = generate_data_list(200, seed=5) + [
+            {'name': 'street ' + str(i), 'age': 20 + i % 60, 'latitude': 10 + i * 1e-3, 'longitude': 20 + i * 1e-3}
+            for i in range(100)]
+        for i, item in enumerate(inserted_items):
+            item.update({'id': 'new_' + str(i), 'name': 'inserted ' + str(i)})
+        for build_subtrees in (True, False):
+            items = [dict(item, id=item['id'] + '_' + str(build_subtrees)) for item in inserted_items]
+            round_trips = writer.redis_nodes.round_trips
+            writer.insert_items_bulk(items, build_subtrees=build_subtrees)
+            if build_subtrees:
+                # at most one read per level of the tree, and the new nodes written in bulk, instead of a few round
+                # trips per item
+                self.assertLess(writer.redis_nodes.round_trips - round_trips, 20)
+            self.data_list.extend(items)
+
+            for target in generate_data_list(10, seed=7) + [{'latitude': 10.05, 'longitude': 20.05, 'age': 40}]:
+                self.target = target
+                self.assertEqual(self.neighbor_names(reader), self.expected_names())
+                self.assertEqual(self.neighbor_names(writer), self.expected_names())
+        self.assertEqual(reader.get_node_from_id('new_150_True')['name'], 'inserted 150')
+
+    def test_node_cache_sees_other_writers(self):
+        writer = self.create_store(rebuild_index=True, pinned_levels=3)
+        reader = self.create_store(pinned_levels=3)
+        self.assertEqual(reader.node_cache.stats()['pinned'], 7)
+        self.assertEqual(self.neighbor_names(reader), self.expected_names())
+
+        # the new leaf is linked from a node the reader has cached
+        item = {'id': 'new', 'name': 'new person', 'age': 40, 'latitude': 10.0, 'longitude': 20.0}
+        writer.insert_item(dict(item))
+        self.data_list.append(item)
+        self.assertEqual(self.neighbor_names(reader), self.expected_names())
+        self.assertEqual(reader.node_cache.stats()['pinned'], 7)
+
+        writer.delete_item('new')
+        self.data_list.pop()
+        self.assertEqual(self.neighbor_names(reader), self.expected_names())
+
+        # the writer's own writes go through its cache, which it keeps
+        writer.k_nearest_neighbors(self.target, 10, 5)
+        cached = writer.node_cache.stats()['cached']
+        writer.insert_item({'id': 'other', 'name': 'other person', 'age': 60, 'latitude': -30.0, 'longitude': 50.0})
+        self.assertGreaterEqual(writer.node_cache.stats()['cached'], cached)
+
+
+if __name__ == '__main__':
+    unittest.main()
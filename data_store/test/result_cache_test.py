@@ -0,0 +1,105 @@
+import unittest
+from data_store.grid_store import GridDataStore
+from data_store.kd_tree_store import KDTreeDataStore
+from data_store.result_cache import ResultCache
+from data_store.test.kd_tree_store_test import generate_data_list
+
+
+def neighbor(name, latitude, longitude, distance, age=30):
+    return {'distance': distance, 'latitude': latitude, 'longitude': longitude, 'name': name, 'age': age}
+
+
+class ResultCacheTest(unittest.TestCase):
+    def test_quantization_expiry_and_eviction(self):
+        cache = ResultCache(grid_degrees=0.1, ttl=60)
+        target = {'latitude': 10.01, 'longitude': 20.01, 'age': 30}
+        cache.put(target, 2, 5, [neighbor('a', 10.02, 20.01, 1.1), neighbor('b', 10.05, 20.04, 5.5)], True)
+
+        # a target in the same cell gets the same neighbors, at their distances from it, which are not exact anymore
+        result, exact = cache.get({'latitude': 10.04, 'longitude': 20.04, 'age': 30}, 2, 5)
+        self.assertFalse(exact)
+        self.assertTrue(cache.get(target, 2, 5)[1])
+        self.assertEqual([item['name'] for item in result], ['b', 'a'])
+        self.assertAlmostEqual(result[0]['distance'], 1.11, places=2)
+        # other cell, age, or search parameters
+        self.assertIsNone(cache.get({'latitude': 10.11, 'longitude': 20.01, 'age': 30}, 2, 5))
+        self.assertIsNone(cache.get(dict(target, age=31), 2, 5))
+        self.assertIsNone(cache.get(target, 3, 5))
+        self.assertIsNone(cache.get(target, 2, 5, max_radius=10))
+
+        cache.ttl = 0
+        cache.put(target, 2, 5, [], True)
+        self.assertIsNone(cache.get(target, 2, 5))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+        # the least recently used entries are evicted beyond the memory cap
+        cache = ResultCache(grid_degrees=0.1)
+        cache.put(target, 1, 5, [neighbor('a', 10.02, 20.01, 1.1)], True)
+        cache.max_bytes = 2 * cache.nbytes
+        cache.put(dict(target, age=31), 1, 5, [neighbor('a', 10.02, 20.01, 1.1)], True)
+        cache.get(target, 1, 5)
+        cache.put(dict(target, age=32), 1, 5, [neighbor('a', 10.02, 20.01, 1.1)], True)
+        self.assertIsNotNone(cache.get(target, 1, 5))
+        self.assertIsNone(cache.get(dict(target, age=31), 1, 5))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+
+    def test_invalidation(self):
+        cache = ResultCache(grid_degrees=0.1)
+        target = {'latitude': 10.05, 'longitude': 20.05, 'age': 30}
+        cache.put(target, 1, 5, [neighbor('a', 10.05, 20.15, 11.0)], True)
+        # too far, or out of the age window
+        cache.invalidate(10.05, 20.5, 30)
+        cache.invalidate(10.05, 20.1, 40)
+        self.assertEqual(len(cache), 1)
+        cache.invalidate([10.05, 10.05], [20.5, 20.1], [30, 30])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+        # an entry with fewer than k neighbors is changed by anybody in its age window
+        cache.put(target, 2, 5, [neighbor('a', 10.05, 20.15, 11.0)], True)
+        cache.invalidate(-50, -100, 33)
+        self.assertEqual(len(cache), 0)
+
+    def test_store_cache(self):
+        target = {'latitude': 10.0, 'longitude': 20.0, 'age': 40}
+        for store in (KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=generate_data_list(2000),
+                                      compact_mode=True, bucket_size=32, result_cache_bytes=2 ** 20),
+                      KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=generate_data_list(2000),
+                                      result_cache_bytes=2 ** 20),
+                      GridDataStore(data_from_file=False, data_list=generate_data_list(2000),
+                                    result_cache_bytes=2 ** 20)):
+            expected = store.k_nearest_neighbors(target, 10, 5)
+            self.assertEqual(store.k_nearest_neighbors(target, 10, 5), expected)
+            self.assertEqual(store.result_cache.stats()['hits'], 1)
+            # only the target the result was cached for gets an exact result
+            self.assertTrue(store.k_nearest_neighbors(target, 10, 5, return_exact=True)[1])
+            self.assertFalse(store.k_nearest_neighbors(dict(target, latitude=10.001), 10, 5, return_exact=True)[1])
+            self.assertEqual(store.result_cache.stats()['hits'], 3)
+
+            # somebody far away does not change the result
+            store.insert_item({'id': 'far', 'name': 'far', 'age': 40, 'latitude': -60.0, 'longitude': -150.0})
+            self.assertEqual(store.k_nearest_neighbors(target, 10, 5), expected)
+            self.assertEqual(store.result_cache.stats()['hits'], 4)
+
+            newcomer = {'id': 'newcomer', 'name': 'newcomer', 'age': 40, 'latitude': 10.001, 'longitude': 20.001}
+            store.insert_item(newcomer)
+            self.assertEqual(store.k_nearest_neighbors(target, 10, 5)[0]['name'], 'newcomer')
+
+            if isinstance(store, GridDataStore):
+                continue
+            # the compact store gives the newcomer the id of its row
+            newcomer_id = newcomer['id']
+            store.update_location(newcomer_id, -60.0, -150.0)
+            self.assertEqual(store.k_nearest_neighbors(target, 10, 5), expected)
+            store.update_location(newcomer_id, 10.001, 20.001)
+            self.assertEqual(store.k_nearest_neighbors(target, 10, 5)[0]['name'], 'newcomer')
+            store.delete_item(newcomer_id)
+            self.assertEqual(store.k_nearest_neighbors(target, 10, 5), expected)
+
+    def test_disabled_by_default(self):
+        kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=generate_data_list(100),
+                                   compact_mode=True)
+        target = {'latitude': 10.0, 'longitude': 20.0, 'age': 40}
+        self.assertEqual(kd_store.k_nearest_neighbors(target, 10, 5), kd_store.k_nearest_neighbors(target, 10, 5))
+        self.assertIsNone(kd_store.result_cache)
@@ -0,0 +1,88 @@
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.request
+from data_store.kd_tree_store import KDTreeDataStore
+from data_store.test.kd_tree_store_test import generate_data_list
+from data_store.worker_server import serve_workers
+
+
+def free_port():
+    """Port that nothing listens on"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def get_json(url, timeout=10):
+    """Gets the url until the server answers, and decodes the json response"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.URLError as e:
+            if isinstance(e, urllib.error.HTTPError) or time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'the workers are forked')
+class WorkerServerTest(unittest.TestCase):
+    def test_workers_serve_and_reload_the_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            kd_store = KDTreeDataStore(redis_mode=False, data_from_file=False, data_list=generate_data_list(2000),
+                                       compact_mode=True, bucket_size=32)
+            kd_store.data_filename = os.path.join(directory, 'index.snapshot')
+            port = free_port()
+            server = multiprocessing.get_context('fork').Process(target=serve_workers,
+                                                                 args=(kd_store, port, 2, '127.0.0.1', 0.05))
+            server.start()
+            num_queries_sent = [0]
+
+            def get_query(url):
+                num_queries_sent[0] += 1
+                return get_json(url)
+
+            try:
+                url = 'http://127.0.0.1:{}/query?latitude=10&longitude=20&age=40'.format(port)
+                names = [item['name'] for item in get_query(url)['result']]
+                self.assertEqual(names, [item['name'] for item in
+                                         kd_store.recommend({'latitude': 10, 'longitude': 20, 'age': 40}, 10, 5)
+                                         ['result']])
+
+                # the workers only serve the read endpoints
+                request = urllib.request.Request('http://127.0.0.1:{}/item/0'.format(port), method='DELETE')
+                with self.assertRaises(urllib.error.HTTPError) as context:
+                    urllib.request.urlopen(request)
+                self.assertIn(context.exception.code, (404, 405))
+
+                # a new snapshot, with somebody next to the target, is picked up by all the workers
+                kd_store.insert_item({'name': 'newcomer', 'age': 40, 'latitude': 10.001, 'longitude': 20.001})
+                kd_store.save_snapshot()
+                deadline = time.time() + 10
+                responses = []
+                while time.time() < deadline and len(responses) < 10:
+                    first_name = get_query(url)['result'][0]['name']
+                    responses = responses + [first_name] if first_name == 'newcomer' else []
+                self.assertEqual(responses, ['newcomer'] * 10)
+
+                # /metrics adds up the requests of both workers, whichever one answers, as of their last save
+                expected_line = 'geo_recommender_request_seconds_count{{endpoint="/query"}} {}'.format(
+                    num_queries_sent[0])
+                deadline = time.time() + 10
+                lines = []
+                while time.time() < deadline and expected_line not in lines:
+                    time.sleep(0.1)
+                    with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port)) as response:
+                        lines = response.read().decode('utf-8').splitlines()
+                self.assertIn(expected_line, lines)
+            finally:
+                server.terminate()
+                server.join(10)
+            self.assertEqual(server.exitcode, 0)
@@ -0,0 +1,186 @@
+"""Serves a compact index from several forked worker processes that all map the same snapshot file.
+
+The parent process maps the snapshot, binds the listening socket, and forks the workers, which accept the connections
+on the shared socket (the kernel hands each connection to one of them). The mapped pages are shared through the page
+cache, so the index takes the same memory whatever the number of workers. Between two requests, each worker checks
+whether the snapshot file was replaced (CompactNodeStore.save replaces it atomically) and maps the new one, without
+dropping any connection. The workers only serve the read endpoints: the index is updated by writing a new snapshot.
+Each worker records the metrics of its own requests, and saves them to a directory shared by the workers at the same
+interval, so that /metrics adds up all the workers (see StoreMetrics.share).
+"""
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+from data_store.metrics import StoreMetrics
+
+
+def _file_signature(filename):
+    """Identifies the current version of a file, which changes when the file is replaced
+
+    Args:
+        filename: path of the file
+
+    Returns: (inode, modification time, size) tuple, or None if the file does not exist
+
+    """
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        return None
+    return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler that does not log every request, which the workers would interleave on stderr"""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class SnapshotReloadingServer(WSGIServer):
+    """wsgiref server that maps the new snapshot of its store when the snapshot file is replaced, and saves the shared
+    metrics of its store"""
+
+    reload_interval = 1.0
+    # backlog of the listening socket, shared by the workers
+    request_queue_size = 128
+
+    def watch_snapshot(self, store, filename, reload_interval=None):
+        """Sets the store whose snapshot is watched
+
+        Args:
+            store: KDTreeDataStore in compact mode, serving the snapshot
+            filename: path of the snapshot file
+            reload_interval: (optional) minimum number of seconds between two checks of the file
+
+        Returns: None
+
+        """
+        self.store = store
+        self.snapshot_filename = filename
+        self.snapshot_signature = _file_signature(filename)
+        if reload_interval is not None:
+            self.reload_interval = reload_interval
+        self._last_check = time.time()
+
+    def service_actions(self):
+        """Called by serve_forever between requests: saves the shared metrics, and reloads the snapshot if it changed
+
+        Returns: None
+
+        """
+        now = time.time()
+        if now - self._last_check < self.reload_interval:
+            return
+        self._last_check = now
+        self.store.metrics.save_shared()
+        signature = _file_signature(self.snapshot_filename)
+        if signature is None or signature == self.snapshot_signature:
+            return
+        try:
+            self.store.load_snapshot(self.snapshot_filename)
+        except (OSError, ValueError) as e:
+            print('worker {}: could not load the new index snapshot ({})'.format(os.getpid(), e))
+            return
+        self.snapshot_signature = signature
+        print('worker {}: loaded the new index snapshot'.format(os.getpid()))
+
+
+def _run_worker(server, metrics_directory):
+    """Serves requests in a forked worker until it gets SIGTERM (after the current request) or SIGINT
+
+    Args:
+        server: SnapshotReloadingServer
+        metrics_directory: directory of the metrics shared by the workers
+
+    Returns: does not return
+
+    """
+    # the worker counts its own requests, from zero
+    server.store.metrics = StoreMetrics(prefix=server.store.metrics.prefix)
+    server.store.metrics.share(metrics_directory)
+    # shutdown waits for serve_forever to return, so it is called from another thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    exit_code = 0
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print('worker {} failed: {}'.format(os.getpid(), e))
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+
+def serve_workers(store, port, num_workers, host='0.0.0.0', reload_interval=None):
+    """Serves the store's read endpoints from num_workers forked processes sharing its memory-mapped snapshot. The
+    workers that exit unexpectedly are restarted, and SIGTERM or SIGINT stops all of them
+
+    Args:
+        store: KDTreeDataStore in compact mode
+        port: port to serve on
+        num_workers: number of worker processes
+        host: host to serve on
+        reload_interval: (optional) minimum number of seconds between two checks of the snapshot file by a worker
+
+    Returns: None
+
+    """
+    if not store.compact_mode:
+        raise AssertionError('the workers share the index through its snapshot, which needs compact mode')
+    if not hasattr(os, 'fork'):
+        raise AssertionError('serving with several workers needs os.fork')
+
+    filename = store.data_filename
+    if not store.use_snapshot:
+        store.save_snapshot(filename)
+    # the workers inherit the mapping, and share its pages
+    store.load_snapshot(filename)
+
+    server = make_server(host, port, store.create_app(read_only=True), server_class=SnapshotReloadingServer,
+                         handler_class=QuietRequestHandler)
+    server.watch_snapshot(store, filename, reload_interval=reload_interval)
+    # the metrics recorded before the workers start are shared once, by the parent
+    metrics_directory = tempfile.mkdtemp(prefix='geo_recommender_metrics_')
+    store.metrics.share(metrics_directory)
+
+    workers = set()
+    stopping = []
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(server, metrics_directory)
+        workers.add(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(num_workers):
+        start_worker()
+    print('serving on {}:{} with {} workers'.format(host, port, num_workers))
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except KeyboardInterrupt:
+            stop(signal.SIGINT, None)
+            continue
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            print('worker {} exited with status {}: restarting it'.format(pid, status))
+            # do not fork in a loop if the workers keep failing
+            time.sleep(1)
+            start_worker()
+    server.server_close()
+    shutil.rmtree(metrics_directory, ignore_errors=True)
@@ -0,0 +1,87 @@
+"""Vectorized distance kernels for scoring many stored points against queries.
+
+The great circle distance is 2 * r * asin(sqrt(h)), where h is the haversine term
+sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2 (a quarter of the squared chord between the points
+on the unit sphere). As the distance grows with h, candidates can be ranked and compared to a distance bound on h
+alone, and the arcsine is only taken for the few that are kept. The stored coordinates in radians and the cosines of
+their latitudes are precomputed once (see CompactNodeStore.get_kernel_columns), so that scoring a point only takes the
+two sines.
+"""
+import numpy as np
+
+EARTH_RADIUS = 6371  # Radius of earth in kilometers.
+
+
+def query_terms(latitudes, longitudes):
+    """Precomputes the terms of the query points used by haversine_terms
+
+    Args:
+        latitudes: latitude(s) of the queries, in degrees (scalar or numpy array)
+        longitudes: longitude(s) of the queries, in degrees
+
+    Returns: (latitudes in radians, longitudes in radians, cosines of the latitudes)
+
+    """
+    lat_radians = np.radians(latitudes)
+    return lat_radians, np.radians(longitudes), np.cos(lat_radians)
+
+
+def haversine_terms(query, radian_latitudes, radian_longitudes, cos_latitudes):
+    """Haversine terms between queries and stored points, following numpy broadcasting
+
+    Args:
+        query: query terms, from query_terms
+        radian_latitudes: precomputed latitudes of the points, in radians
+        radian_longitudes: precomputed longitudes of the points, in radians
+        cos_latitudes: precomputed cosines of the points' latitudes
+
+    Returns: numpy array of haversine terms, between 0 and 1
+
+    """
+    query_lat_radians, query_lon_radians, query_cos_latitudes = query
+    return (np.sin((radian_latitudes - query_lat_radians) * 0.5) ** 2 +
+            query_cos_latitudes * cos_latitudes * np.sin((radian_longitudes - query_lon_radians) * 0.5) ** 2)
+
+
+def haversine_distances(latitudes1, longitudes1, latitudes2, longitudes2):
+    """Great circle distances between points given in degrees, following numpy broadcasting. For the stored points,
+    haversine_terms with their precomputed columns avoids converting them at every call
+
+    Args:
+        latitudes1: latitude(s) of the first points, in degrees (scalar or numpy array)
+        longitudes1: longitude(s) of the first points
+        latitudes2: latitude(s) of the second points
+        longitudes2: longitude(s) of the second points
+
+    Returns: numpy array of distances in kilometers
+
+    """
+    radian_latitudes2 = np.radians(latitudes2)
+    return terms_to_distances(haversine_terms(query_terms(latitudes1, longitudes1), radian_latitudes2,
+                                              np.radians(longitudes2), np.cos(radian_latitudes2)))
+
+
+def terms_to_distances(terms):
+    """Converts haversine terms to great circle distances
+
+    Args:
+        terms: numpy array of haversine terms. Infinite terms, used to mask candidates out, stay infinite
+
+    Returns: numpy array of distances in kilometers
+
+    """
+    return np.where(np.isinf(terms), np.inf, 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(terms, 1.0))))
+
+
+def distance_to_term(distance):
+    """Converts a great circle distance to its haversine term, to compare distances to a bound with the terms only
+
+    Args:
+        distance: distance in kilometers (can be infinite)
+
+    Returns: haversine term (infinite beyond half the earth's circumference, which no distance exceeds)
+
+    """
+    if distance >= np.pi * EARTH_RADIUS:
+        return np.inf
+    return np.sin(distance / (2 * EARTH_RADIUS)) ** 2
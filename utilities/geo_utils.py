@@ -1,4 +1,8 @@
-from math import radians, cos, sin, asin, sqrt, pi
+from math import radians, degrees, cos, sin, tan, asin, atan, sqrt, pi
+
+import numpy as np
+
+from utilities.distance_kernels import EARTH_RADIUS, haversine_distances
 
 
 def haversine_distance(lat1, lon1, lat2, lon2):
@@ -7,15 +11,99 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     on the earth (specified in decimal degrees)
     """
     # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    lon1, lat1, lon2, lat2 = radians(lon1), radians(lat1), radians(lon2), radians(lat2)
 
     # haversine formula
     dlon = lon2 - lon1
     dlat = lat2 - lat1
     a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
     c = 2 * asin(sqrt(a))
-    r = 6371  # Radius of earth in kilometers.
-    return c * r
+    return c * EARTH_RADIUS
+
+
+def _meridian_arc_distance(lat, lon, meridian_lon, lat_min, lat_max):
+    """
+    Calculate the shortest distance between a point and the arc of the given meridian
+    between lat_min and lat_max
+    """
+    lat_min, lat_max = max(lat_min, -90), min(lat_max, 90)
+    dlon = radians(lon - meridian_lon)
+    if cos(dlon) <= 0:
+        # the meridian is on the other side of the globe: the closest point is one of the arc ends
+        return min(haversine_distance(lat, lon, lat_min, meridian_lon),
+                   haversine_distance(lat, lon, lat_max, meridian_lon))
+
+    # latitude of the closest point on the whole meridian
+    closest_lat = degrees(atan(tan(radians(lat)) / cos(dlon)))
+    return haversine_distance(lat, lon, min(max(closest_lat, lat_min), lat_max), meridian_lon)
+
+
+def box_distance(lat, lon, lat_min, lat_max, lon_min, lon_max):
+    """
+    Calculate the shortest great circle distance between a point and a box delimited by
+    two parallels and two meridians (all specified in decimal degrees). The latitude bounds
+    can be infinite, the longitude bounds should be within [-180, 180]
+    """
+    if lon_min <= lon <= lon_max:
+        # the closest point of the box is on the same meridian as the point
+        if lat_min <= lat <= lat_max:
+            return 0.0
+        return radians(lat_min - lat if lat < lat_min else lat - lat_max) * EARTH_RADIUS
+
+    # otherwise, it lies on one of the two meridians delimiting the box
+    return min(_meridian_arc_distance(lat, lon, lon_min, lat_min, lat_max),
+               _meridian_arc_distance(lat, lon, lon_max, lat_min, lat_max))
+
+
+def _meridian_arc_distances(lats, lons, meridian_lon, lat_min, lat_max):
+    """
+    Vectorized _meridian_arc_distance
+    """
+    lat_min, lat_max = max(lat_min, -90), min(lat_max, 90)
+    cos_dlon = np.cos(np.radians(lons - meridian_lon))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        closest_lats = np.clip(np.degrees(np.arctan(np.tan(np.radians(lats)) / cos_dlon)), lat_min, lat_max)
+
+    arc_end_distances = np.minimum(haversine_distances(lats, lons, lat_min, meridian_lon),
+                                   haversine_distances(lats, lons, lat_max, meridian_lon))
+    return np.where(cos_dlon > 0, haversine_distances(lats, lons, closest_lats, meridian_lon), arc_end_distances)
+
+
+def box_distances(lats, lons, lat_min, lat_max, lon_min, lon_max):
+    """
+    Vectorized box_distance: calculate the shortest distances between the points of numpy
+    arrays of coordinates and a single box
+    """
+    distances = np.radians(np.maximum(np.maximum(lat_min - lats, lats - lat_max), 0)) * EARTH_RADIUS
+
+    outside = (lons < lon_min) | (lons > lon_max)
+    if outside.any():
+        distances[outside] = np.minimum(
+            _meridian_arc_distances(lats[outside], lons[outside], lon_min, lat_min, lat_max),
+            _meridian_arc_distances(lats[outside], lons[outside], lon_max, lat_min, lat_max))
+    return distances
+
+
+def box_boundary_distances(lats, lons, lat_min, lat_max, lon_min, lon_max):
+    """
+    Calculate the shortest distances from points inside boxes (numpy arrays of coordinates and
+    box bounds, following numpy broadcasting) to the boundaries of the boxes. Any point outside
+    of a box is at least that far from the points inside it. Boxes covering all the longitudes
+    are only bounded by their parallels, and infinite latitude bounds are not boundaries
+    """
+    boundary_distances = np.radians(np.minimum(lats - lat_min, lat_max - lats)) * EARTH_RADIUS
+
+    # the antimeridian is not a boundary for boxes covering all the longitudes
+    bounded = (lon_max - lon_min) < 360
+    cos_lats = np.cos(np.radians(lats))
+    for lon_edge in (lon_min, lon_max):
+        edge_distances = np.arcsin(np.minimum(1.0, np.abs(np.sin(np.radians(lons - lon_edge))) * cos_lats)) * \
+            EARTH_RADIUS
+        # beyond a quarter of the globe, the closest point of a meridian is one of the poles
+        edge_distances = np.where(np.cos(np.radians(lons - lon_edge)) > 0, edge_distances,
+                                  np.radians(90 - np.abs(lats)) * EARTH_RADIUS)
+        boundary_distances = np.where(bounded, np.minimum(boundary_distances, edge_distances), boundary_distances)
+    return boundary_distances
 
 
 def get_geo_offsets(lat, lon):
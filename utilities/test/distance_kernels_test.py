@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+from utilities.distance_kernels import query_terms, haversine_terms, haversine_distances, terms_to_distances, \
+    distance_to_term
+from utilities.geo_utils import haversine_distance
+
+
+class DistanceKernelsTest(unittest.TestCase):
+    def test_matches_haversine_distance(self):
+        rng = np.random.RandomState(1437)
+        latitudes, longitudes = rng.uniform(-90, 90, 1000), rng.uniform(-180, 180, 1000)
+        cos_latitudes = np.cos(np.radians(latitudes))
+
+        for query_latitude, query_longitude in ((46.5, 6.6), (-89.9, 179.9), (0, -180)):
+            terms = haversine_terms(query_terms(query_latitude, query_longitude), np.radians(latitudes),
+                                    np.radians(longitudes), cos_latitudes)
+            expected = [haversine_distance(query_latitude, query_longitude, latitude, longitude)
+                        for latitude, longitude in zip(latitudes, longitudes)]
+            np.testing.assert_allclose(terms_to_distances(terms), expected, atol=1e-6)
+            np.testing.assert_allclose(haversine_distances(query_latitude, query_longitude, latitudes, longitudes),
+                                       expected, atol=1e-6)
+            # the terms rank the points like the distances, and compare to distance bounds the same way
+            self.assertEqual(np.argsort(terms, kind='stable').tolist(), np.argsort(expected, kind='stable').tolist())
+            bound = float(np.median(expected))
+            np.testing.assert_array_equal(terms < distance_to_term(bound), np.array(expected) < bound)
+
+    def test_broadcasting_and_infinite_terms(self):
+        queries = query_terms(np.array([[10.0], [20.0]]), np.array([[30.0], [40.0]]))
+        latitudes, longitudes = np.array([10.0, 0.0, 20.0]), np.array([30.0, 0.0, 40.0])
+        terms = haversine_terms(queries, np.radians(latitudes), np.radians(longitudes), np.cos(np.radians(latitudes)))
+        self.assertEqual(terms.shape, (2, 3))
+        self.assertAlmostEqual(terms[0, 0], 0)
+        self.assertAlmostEqual(terms[1, 2], 0)
+
+        terms[:, 1] = np.inf
+        self.assertTrue(np.all(np.isinf(terms_to_distances(terms)[:, 1])))
+        self.assertEqual(distance_to_term(np.inf), np.inf)
+
+
+if __name__ == '__main__':
+    unittest.main()